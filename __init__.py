@@ -19,3 +19,8 @@ __version__ = '0.3'
 
 import inbound
 import outbound
+import originate
+import pool
+import cluster
+import workers
+import offload
@@ -0,0 +1,77 @@
+#!/usr/bin/python
+"""Commands per second of a sendAPI loop against sendAPIBatch, through a local mock FreeSWITCH
+
+The mock server answers every api command line with an api/response. Each run connects a new client,
+issues count uuid_exists commands and waits for all the replies.
+
+Run: python bench/batch_bench.py [count]
+"""
+
+import sys
+import time
+
+from twisted.internet import reactor, defer, protocol
+from twisted.protocols import basic
+
+import samples #puts the checkout on sys.path
+from fsprotocol import FSProtocol
+
+REPLY = "Content-Type: api/response\nContent-Length: 6\n\ntrue\n\n"
+
+
+class MockFreeSWITCH(basic.LineReceiver):
+    delimiter = "\n\n"
+    MAX_LENGTH = 2**31
+
+    def lineReceived(self, line):
+        if line.startswith("api "):
+            self.transport.write(REPLY)
+
+
+class CountingClient(FSProtocol):
+    """FSProtocol counting its transport writes"""
+    def connectionMade(self):
+        FSProtocol.connectionMade(self)
+        self.writes = 0
+        write = self.transport.write
+        def countingWrite(data):
+            self.writes += 1
+            write(data)
+        self.transport.write = countingWrite
+
+
+def loop(client, commands):
+    return defer.DeferredList([client.sendAPI(command) for command in commands])
+
+
+def batch(client, commands):
+    return client.sendAPIBatch(commands)
+
+
+@defer.inlineCallbacks
+def run(port, count):
+    commands = ["uuid_exists %08x-2b9a-11e0-a6f1-1f3e2b0d4a11"%i for i in xrange(count)]
+    for label, send in (("sendAPI loop", loop), ("sendAPIBatch", batch)):
+        client = yield protocol.ClientCreator(reactor, CountingClient).connectTCP('127.0.0.1', port.getHost().port)
+        start = time.time()
+        df = send(client, commands)
+        issued = time.time() - start
+        results = yield df
+        elapsed = time.time() - start
+        assert len(results) == count and all([ok for ok, result in results])
+        print "%-13s %7.0f cmds/s  issued in %6.1fms with %5d writes"%(label, count/elapsed, issued*1000,
+                                                                      client.writes)
+        client.transport.loseConnection()
+    reactor.stop()
+
+
+def main(count):
+    factory = protocol.ServerFactory()
+    factory.protocol = MockFreeSWITCH
+    port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+    reactor.callWhenRunning(run, port, count)
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,59 @@
+#!/usr/bin/python
+"""Memory held per parsed event: the slotted Event against the email Message it replaced
+
+Each kind is measured in its own process, as the growth of its max RSS while count events are
+parsed and kept.
+
+Run: python bench/event_memory.py [count]
+"""
+
+import os
+import resource
+import subprocess
+import sys
+from email.message import Message
+from email.feedparser import FeedParser
+
+from samples import CHANNEL_EVENT
+from fsprotocol import parseEvent
+
+
+class MessageEvent(Message):
+    """Event as it was before the slotted class, an email Message"""
+    pass
+
+
+def feedParse(data):
+    parser = FeedParser(MessageEvent)
+    parser.feed(data)
+    return parser.close()
+
+
+def measure(kind, count):
+    """Return bytes of max RSS gained by keeping count events parsed by kind"""
+    parse = {'message':feedParse, 'slotted':parseEvent}[kind]
+    #every event gets its own value strings, as events read from the socket do
+    frames = [CHANNEL_EVENT.replace('9b2f8e5a', '%08x'%i) for i in xrange(count)]
+    parse(frames[0])
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    events = [parse(frame) for frame in frames]
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #ru_maxrss is in kilobytes on Linux and in bytes on Mac OS X
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (after - before)*scale
+
+
+def main(count):
+    results = {}
+    for kind in ('message', 'slotted'):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), kind, str(count)])
+        results[kind] = int(output)
+        print "%-8s %6d bytes/event"%(kind, results[kind]//count)
+    print "saved %d%%"%(100 - 100*results['slotted']//results['message'])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        print measure(sys.argv[1], int(sys.argv[2]))
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
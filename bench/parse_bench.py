@@ -0,0 +1,36 @@
+#!/usr/bin/python
+"""Cost of parsing ESL frames: parseEvent against the email.feedparser path it replaced
+
+Run: python bench/parse_bench.py [iterations]
+"""
+
+import sys
+from email.message import Message
+from email.feedparser import FeedParser
+
+from samples import COMMAND_REPLY, CHANNEL_EVENT, best
+from fsprotocol import parseEvent
+
+
+class MessageEvent(Message):
+    """Event as it was before parseEvent, an email Message"""
+    pass
+
+
+def feedParse(data):
+    parser = FeedParser(MessageEvent)
+    parser.feed(data)
+    return parser.close()
+
+
+def main(iterations):
+    for label, frame in (("command/reply (2 headers)", COMMAND_REPLY),
+                         ("channel event (%d headers)"%len(CHANNEL_EVENT.split('\n')), CHANNEL_EVENT)):
+        assert feedParse(frame)['Unique-ID'] == parseEvent(frame)['Unique-ID']
+        old = best(lambda: feedParse(frame), iterations)
+        new = best(lambda: parseEvent(frame), iterations)
+        print "%-28s FeedParser %7.1fus  parseEvent %6.1fus  x%.1f"%(label, old*1e6, new*1e6, old/new)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,98 @@
+#!/usr/bin/python
+"""Frames shared by the benchmarks, as FreeSWITCH sends them"""
+
+import os
+import sys
+
+#the benchmarks run from a checkout, import the modules next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+COMMAND_REPLY = "Content-Type: command/reply\nReply-Text: +OK accepted"
+
+#header block of a CHANNEL_ANSWER event, 63 headers
+CHANNEL_EVENT = "\n".join([
+    "Event-Name: CHANNEL_ANSWER",
+    "Core-UUID: 6e2d8c3c-2b9a-11e0-a6c9-1f3e2b0d4a11",
+    "FreeSWITCH-Hostname: fs1.example.com",
+    "FreeSWITCH-Switchname: fs1",
+    "FreeSWITCH-IPv4: 10.0.0.10",
+    "FreeSWITCH-IPv6: %3A%3A1",
+    "Event-Date-Local: 2011-01-28%2012%3A40%3A12",
+    "Event-Date-GMT: Fri,%2028%20Jan%202011%2007%3A10%3A12%20GMT",
+    "Event-Date-Timestamp: 1296198612442921",
+    "Event-Calling-File: mod_sofia.c",
+    "Event-Calling-Function: sofia_answer_channel",
+    "Event-Calling-Line-Number: 454",
+    "Channel-State: CS_EXECUTE",
+    "Channel-Call-State: ACTIVE",
+    "Channel-State-Number: 4",
+    "Channel-Name: sofia/internal/1000%4010.0.0.10",
+    "Unique-ID: 9b2f8e5a-2b9a-11e0-a6f1-1f3e2b0d4a11",
+    "Call-Direction: inbound",
+    "Presence-Call-Direction: inbound",
+    "Channel-HIT-Dialplan: true",
+    "Channel-Presence-ID: 1000%4010.0.0.10",
+    "Channel-Call-UUID: 9b2f8e5a-2b9a-11e0-a6f1-1f3e2b0d4a11",
+    "Answer-State: answered",
+    "Channel-Read-Codec-Name: PCMU",
+    "Channel-Read-Codec-Rate: 8000",
+    "Channel-Write-Codec-Name: PCMU",
+    "Channel-Write-Codec-Rate: 8000",
+    "Caller-Direction: inbound",
+    "Caller-Username: 1000",
+    "Caller-Dialplan: XML",
+    "Caller-Caller-ID-Name: 1000",
+    "Caller-Caller-ID-Number: 1000",
+    "Caller-Network-Addr: 10.0.0.21",
+    "Caller-ANI: 1000",
+    "Caller-Destination-Number: 9196",
+    "Caller-Unique-ID: 9b2f8e5a-2b9a-11e0-a6f1-1f3e2b0d4a11",
+    "Caller-Source: mod_sofia",
+    "Caller-Context: default",
+    "Caller-Channel-Name: sofia/internal/1000%4010.0.0.10",
+    "Caller-Profile-Index: 1",
+    "Caller-Profile-Created-Time: 1296198612422933",
+    "Caller-Channel-Created-Time: 1296198612422933",
+    "Caller-Channel-Answered-Time: 1296198612442921",
+    "Caller-Channel-Progress-Time: 0",
+    "Caller-Channel-Progress-Media-Time: 0",
+    "Caller-Channel-Hangup-Time: 0",
+    "Caller-Channel-Transfer-Time: 0",
+    "Caller-Screen-Bit: true",
+    "Caller-Privacy-Hide-Name: false",
+    "Caller-Privacy-Hide-Number: false",
+    "variable_direction: inbound",
+    "variable_uuid: 9b2f8e5a-2b9a-11e0-a6f1-1f3e2b0d4a11",
+    "variable_session_id: 12",
+    "variable_sip_from_user: 1000",
+    "variable_sip_from_uri: 1000%4010.0.0.10",
+    "variable_sip_from_host: 10.0.0.10",
+    "variable_channel_name: sofia/internal/1000%4010.0.0.10",
+    "variable_sip_call_id: 4c2d1e0f-8d7a%4010.0.0.21",
+    "variable_sip_local_network_addr: 10.0.0.10",
+    "variable_sip_network_ip: 10.0.0.21",
+    "variable_sip_network_port: 5060",
+    "variable_sip_received_ip: 10.0.0.21",
+    "variable_endpoint_disposition: ANSWER",
+])
+
+
+def plainEvent(headers, body=None):
+    """Return a text/event-plain frame carrying the header block headers and an optional body"""
+    if body is not None:
+        headers = "%s\nContent-Length: %d\n\n%s"%(headers, len(body), body)
+    else:
+        headers = headers + "\n\n"
+    return "Content-Length: %d\nContent-Type: text/event-plain\n\n%s"%(len(headers), headers)
+
+
+def best(func, iterations, repeat=3):
+    """Return the best time of repeat runs of func called iterations times, in seconds per call"""
+    import time
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        for j in xrange(iterations):
+            func()
+        times.append(time.time() - start)
+    return min(times)/iterations
@@ -0,0 +1,57 @@
+#!/usr/bin/python
+"""Cost of serializing a sendmsg execute message: executeMessage against building and flattening an Event
+
+The email Message with Generator path it replaced is rebuilt here, its output is checked to be the
+same bytes as executeMessage.
+
+Run: python bench/sendmsg_bench.py [iterations]
+"""
+
+import sys
+from cStringIO import StringIO
+from email.message import Message
+from email.generator import Generator
+
+from samples import best
+from fsprotocol import Event, executeMessage
+
+UUID = "9b2f8e5a-2b9a-11e0-a6f1-1f3e2b0d4a11"
+
+
+class MessageEvent(Message):
+    """Event as it was before the slotted class, an email Message"""
+    def as_string(self, unixfrom=False):
+        fp = StringIO()
+        g = Generator(fp, maxheaderlen=0)
+        g.flatten(self, unixfrom=unixfrom)
+        return fp.getvalue()
+
+
+def buildMessage(cls, cmd, args='', uuid='', lock=True):
+    """Build and serialize the message as sendCommand did before executeMessage"""
+    msg = cls()
+    if uuid:
+        msg.set_unixfrom("SendMsg %s"%uuid)
+    else:
+        msg.set_unixfrom("SendMsg")
+    msg['call-command'] = "execute"
+    msg['execute-app-name'] = cmd
+    if args:
+        msg['execute-app-arg'] = args
+    if lock:
+        msg['event-lock'] = "true"
+    return msg.as_string(True)
+
+
+def main(iterations):
+    for args in (("playback", "/tmp/welcome.wav", UUID), ("answer",), ("bridge", "user/1000", UUID, False)):
+        assert buildMessage(MessageEvent, *args) == executeMessage(*args), args
+    args = ("playback", "/tmp/welcome.wav", UUID)
+    for label, func in (("Message + email Generator", lambda: buildMessage(MessageEvent, *args)),
+                        ("slotted Event.as_string", lambda: buildMessage(Event, *args)),
+                        ("executeMessage", lambda: executeMessage(*args))):
+        print "%-26s %6.2fus"%(label, best(func, iterations)*1e6)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,303 @@
+#!/usr/bin/python
+
+import inspect
+
+from fsprotocol import *
+from inbound import InboundProtocol
+from pool import PoolMember, NoConnection
+
+log = logging.getLogger("Cluster")
+
+
+class UnknownChannel(CommandError):
+    """No node of the cluster is known to own the channel"""
+    pass
+
+
+class ClusterEventCallback(EventCallback):
+    """Event callback registered on every node of a Cluster"""
+    def __init__(self, eventname, subscribe, func, *args, **kwargs):
+        EventCallback.__init__(self, eventname, func, *args, **kwargs)
+        self.subscribe = subscribe
+        self.nodeCallbacks = {} #node name -> EventCallback registered on the node protocol
+
+
+class ClusterNode(PoolMember):
+    """Connection to one FreeSWITCH of a Cluster and what is known about its load
+
+    channels -- (set) Unique-IDs of the channels on the node
+    maxSessions -- (int) Max-Sessions of the last HEARTBEAT, None until one arrives
+    idleCPU -- (float) Idle-CPU of the last HEARTBEAT, None until one arrives
+    originating -- (int) originates sent to the node that did not finish yet
+    """
+    def __init__(self, cluster, name, host, port, password):
+        PoolMember.__init__(self, cluster, name, host, port, password)
+        self.channels = set()
+        self.maxSessions = None
+        self.idleCPU = None
+        self.originating = 0
+
+    def usage(self, ratio):
+        """Return channels in use plus originates in flight, as a fraction of Max-Sessions if ratio is True"""
+        used = len(self.channels) + self.originating
+        if ratio:
+            return float(used)/self.maxSessions
+        return used
+
+    def stats(self):
+        stats = PoolMember.stats(self)
+        stats.update({'channels':len(self.channels), 'maxSessions':self.maxSessions, 'idleCPU':self.idleCPU,
+                      'originating':self.originating})
+        return stats
+
+
+class Cluster(object):
+    """Inbound connections to several FreeSWITCH nodes used as one.
+
+    The owner of every channel is learned from the CHANNEL_CREATE and CHANNEL_DESTROY events of
+    each node, and from "show channels" when a node connects. Channel scoped methods, the ones
+    taking a uuid such as apiUUIDKill or sendCommand(..., uuid=...), run on the node owning the
+    channel and fail with UnknownChannel when no node owns it.
+
+    apiOriginate runs on the least loaded node: the one with the fewest channels and originates in
+    flight relative to the Max-Sessions of its HEARTBEAT, then the one with the most Idle-CPU. An
+    origination_uuid channel variable is owned by that node right away.
+
+    Callbacks registered with registerEvent receive the events of every node, called as
+    function(event, node, *args, **kwargs).
+    """
+    protocol = InboundProtocol
+    commandTimeout = None #seconds to wait for a command reply on the nodes, None waits forever
+    clusterEvents = "CHANNEL_CREATE CHANNEL_DESTROY HEARTBEAT BACKGROUND_JOB"
+
+    def __init__(self, nodes, password, eventFormat="plain", retryDelay=5, maxFailures=3):
+        """
+        nodes -- (list) (host, port) or (host, port, password) of every node
+        password -- (str) EventSocket password of the nodes that do not give their own
+        eventFormat -- (str) plain or json
+        retryDelay -- (int/float) seconds to wait before reconnecting a lost node
+        maxFailures -- (int) timeouts in a row after which a node gets no new originates
+        """
+        self.eventFormat = eventFormat
+        self.retryDelay = retryDelay
+        self.maxFailures = maxFailures
+        self.members = []
+        self.nodes = {} #name -> ClusterNode
+        for node in nodes:
+            host, port = node[:2]
+            name = "%s:%s"%(host, port)
+            member = ClusterNode(self, name, host, port, node[2] if len(node) > 2 else password)
+            self.members.append(member)
+            self.nodes[name] = member
+        self.owners = {} #channel uuid -> ClusterNode
+        self.eventCallbacks = []
+        self.running = False
+        self._readyDeferreds = []
+
+    def start(self):
+        """Connect every node
+
+        returns deferred fired with the cluster once a node is authenticated
+        """
+        self.running = True
+        for node in self.members:
+            node.connect()
+        return self.whenReady()
+
+    def stop(self):
+        """Disconnect every node"""
+        self.running = False
+        for node in self.members:
+            node.stop()
+
+    def whenReady(self):
+        """Return deferred fired with the cluster once a node is authenticated"""
+        for node in self.members:
+            if node.state == 'ready':
+                return defer.succeed(self)
+        df = defer.Deferred()
+        self._readyDeferreds.append(df)
+        return df
+
+    def stats(self):
+        """Return dict of node name -> node stats"""
+        return dict([(node.index, node.stats()) for node in self.members])
+
+    def memberReady(self, node):
+        protocol = node.protocol
+        protocol.registerEvent("CHANNEL_CREATE", False, self._channelCreated, node)
+        protocol.registerEvent("CHANNEL_DESTROY", False, self._channelDestroyed, node)
+        protocol.registerEvent("HEARTBEAT", False, self._heartbeat, node)
+        protocol.subscribeEvents(self.clusterEvents)
+        for ecb in self.eventCallbacks:
+            self._registerOnNode(ecb, node)
+        #channels created before the node connected
+        df = protocol.sendAPI("show channels as json")
+        df.addCallbacks(self._channelList, self._channelListFailed, callbackArgs=(node,), errbackArgs=(node,))
+        readyDeferreds, self._readyDeferreds = self._readyDeferreds, []
+        for df in readyDeferreds:
+            df.callback(self)
+
+    def memberDown(self, node):
+        for uuid in node.channels:
+            if self.owners.get(uuid) is node:
+                del self.owners[uuid]
+        node.channels.clear()
+        for ecb in self.eventCallbacks:
+            ecb.nodeCallbacks.pop(node.index, None)
+
+    def _setOwner(self, uuid, node):
+        self.owners[uuid] = node
+        node.channels.add(uuid)
+
+    def _dropOwner(self, uuid, node):
+        node.channels.discard(uuid)
+        if self.owners.get(uuid) is node:
+            del self.owners[uuid]
+
+    def _channelCreated(self, event, node):
+        self._setOwner(event['Unique-ID'], node)
+
+    def _channelDestroyed(self, event, node):
+        self._dropOwner(event['Unique-ID'], node)
+
+    def _heartbeat(self, event, node):
+        node.maxSessions = int(event['Max-Sessions'] or 0) or None
+        if event['Idle-CPU']:
+            node.idleCPU = float(event['Idle-CPU'])
+
+    def _channelList(self, message, node):
+        try:
+            rows = json.loads(message.get_payload() or '{}').get('rows') or []
+        except ValueError:
+            log.error("Could not read the channels of node %s", node.index)
+            return
+        for row in rows:
+            if row.get('uuid'):
+                self._setOwner(str(row['uuid']), node)
+
+    def _channelListFailed(self, error, node):
+        log.error("Could not list the channels of node %s: %s", node.index, error.getErrorMessage())
+
+    def owner(self, uuid):
+        """Return the ClusterNode owning the channel, None if unknown"""
+        return self.owners.get(uuid)
+
+    def pickNode(self):
+        """Return the node the next originate runs on, None if no node is connected"""
+        ready = [node for node in self.members if node.state == 'ready']
+        candidates = [node for node in ready if node.failures < self.maxFailures] or ready
+        if not candidates:
+            return None
+        ratio = all([node.maxSessions for node in candidates])
+        return min(candidates, key=lambda node: (node.usage(ratio), -(node.idleCPU or 0)))
+
+    def _call(self, node, method, args, kwargs):
+        if node.state != 'ready':
+            return defer.fail(NoConnection("Node %s is not connected"%node.index))
+        node.sent += 1
+        result = getattr(node.protocol, method)(*args, **kwargs)
+        if isinstance(result, defer.Deferred):
+            result.addBoth(node.replied)
+        return result
+
+    def callNode(self, name, method, *args, **kwargs):
+        """Call method of the protocol connected to the named node
+
+        name -- (str) node name eg: 10.0.0.1:8021
+        method -- (str) name of the InboundProtocol method eg: apiStatus
+        """
+        return self._call(self.nodes[name], method, args, kwargs)
+
+    def callAll(self, method, *args, **kwargs):
+        """Call method on every connected node eg: callAll('apiHupAll')
+
+        returns DeferredList fired with a list of (success, result) tuples in the order of the nodes
+        """
+        dfs = [self._call(node, method, args, kwargs) for node in self.members if node.state == 'ready']
+        return defer.DeferredList(dfs, consumeErrors=True)
+
+    def _callChannel(self, uuid, method, args, kwargs):
+        """Call method on the node owning the channel
+
+        returns the result of method, or deferred failed with UnknownChannel or NoConnection
+        """
+        node = self.owners.get(uuid)
+        if node is None:
+            return defer.fail(UnknownChannel("No node owns channel %s"%uuid))
+        return self._call(node, method, args, kwargs)
+
+    def apiOriginate(self, *args, **kwargs):
+        """Originate on the least loaded node, takes the same arguments as FSProtocol.apiOriginate"""
+        node = self.pickNode()
+        if node is None:
+            return defer.fail(NoConnection("No FreeSWITCH node available"))
+        callargs = inspect.getcallargs(self.protocol.apiOriginate.im_func, None, *args, **kwargs)
+        originationUUID = (callargs['channelvars'] or {}).get('origination_uuid')
+        if originationUUID:
+            self._setOwner(originationUUID, node)
+        node.originating += 1
+        df = self._call(node, 'apiOriginate', args, kwargs)
+        df.addBoth(self._originateDone, node, originationUUID)
+        return df
+
+    def _originateDone(self, result, node, originationUUID):
+        node.originating -= 1
+        if originationUUID and not (isinstance(result, Event) and result.get_payload().startswith('+OK')):
+            self._dropOwner(originationUUID, node)
+        return result
+
+    def registerEvent(self, event, subscribe, function, *args, **kwargs):
+        """Register a callback for the event on every node
+
+        function is called as function(event, node, *args, **kwargs), node being the ClusterNode the
+        event came from. See FSProtocol.registerEvent for the other arguments
+
+        returns instance of ClusterEventCallback, keep a reference of this around if you want to deregister it later
+        """
+        executor = kwargs.pop('executor', None)
+        ecb = ClusterEventCallback(event, subscribe, function, *args, **kwargs)
+        ecb.executor = executor
+        self.eventCallbacks.append(ecb)
+        for node in self.members:
+            if node.state == 'ready':
+                self._registerOnNode(ecb, node)
+        return ecb
+
+    def deregisterEvent(self, ecb):
+        """Deregister a callback registered with registerEvent on every node"""
+        try:
+            self.eventCallbacks.remove(ecb)
+        except ValueError:
+            log.error("%s already deregistered "%ecb)
+            return
+        for name, nodeCallback in ecb.nodeCallbacks.items():
+            node = self.nodes[name]
+            if node.state == 'ready':
+                node.protocol.deregisterEvent(nodeCallback)
+        ecb.nodeCallbacks.clear()
+
+    def _registerOnNode(self, ecb, node):
+        ecb.nodeCallbacks[node.index] = node.protocol.registerEvent(ecb.eventname, ecb.subscribe, self._nodeEvent,
+                                                                    ecb, node, executor=ecb.executor)
+
+    def _nodeEvent(self, event, ecb, node):
+        ecb.func(event, node, *ecb.args, **ecb.kwargs)
+
+    def __getattr__(self, name):
+        method = getattr(self.protocol, name, None)
+        if name.startswith('_') or not callable(method):
+            raise AttributeError(name)
+        argnames = inspect.getargspec(method).args
+        if 'uuid' in argnames:
+            argname = 'uuid'
+        elif 'uuid1' in argnames:
+            argname = 'uuid1'
+        else:
+            raise AttributeError(name)
+        def callChannel(*args, **kwargs):
+            uuid = inspect.getcallargs(method.im_func, None, *args, **kwargs)[argname]
+            if not uuid:
+                return defer.fail(UnknownChannel("%s needs the uuid of a channel"%name))
+            return self._callChannel(uuid, name, args, kwargs)
+        return callChannel
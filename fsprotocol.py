@@ -2,58 +2,372 @@
 
 
 import urllib
+import json
+import re
 import logging
 import sys
 import traceback 
-import uuid 
+import uuid
+from collections import deque, OrderedDict
 
 from twisted.protocols import basic
 from twisted.internet import reactor, defer, protocol
 
 
-if sys.hexversion < 0x020500f0:
-    from email.Message import Message
-    from email.FeedParser import FeedParser
-else:
-    from email.message import Message
-    from email.feedparser import FeedParser
-
 log = logging.getLogger("PySWITCH")
     
 
 class CommandError(Exception):
     """Failed to execute the given command"""
     pass
+
+
+class CommandTimeout(CommandError):
+    """No result arrived for the given command in time"""
+    pass
+
+
+class Disconnected(CommandError):
+    """The connection to FreeSWITCH was lost before the result of the command arrived"""
+    pass
+
+
+def _newUUID():
+    """Return a new unique id for jobs and application executions"""
+    return str(uuid.uuid1())
+    
+
+#canonical interned spelling of the header names seen, keyed by the name as given and by its lower case form
+_headerNames = {}
+#entries of _headerNames after which new names are no longer interned, variable_ and sip_h_ names are unbounded
+_maxHeaderNames = 8192
+
+def _headerName(name):
+    """Return the canonical interned spelling of header name, registering it if unseen
+
+    Once _headerNames is full unseen names are returned as given and looked up case insensitively by Event._scanKey
+    """
+    try:
+        return _headerNames[name]
+    except KeyError:
+        pass
+    full = len(_headerNames) >= _maxHeaderNames
+    lower = name.lower()
+    key = _headerNames.get(lower)
+    if key is None:
+        if full:
+            return name
+        key = _headerNames[lower] = intern(name)
+    if not full:
+        _headerNames[name] = key
+    return key
     
+def _findHeaderName(name):
+    """Return the canonical spelling of header name or None if no such header was ever seen"""
+    key = _headerNames.get(name)
+    if key is None:
+        key = _headerNames.get(name.lower())
+    return key
 
-class Event(Message):
+#headers of the protocol and of the events handlers use most, always interned
+for _name in ("Content-Type", "Content-Length", "Reply-Text", "Job-UUID", "Event-Name", "Event-Subclass",
+              "Core-UUID", "Event-Date-Timestamp", "Event-Sequence", "Unique-ID", "Channel-State",
+              "Channel-Call-State", "Channel-Name", "Channel-Presence-ID", "Answer-State", "Call-Direction",
+              "Caller-Caller-ID-Name", "Caller-Caller-ID-Number", "Caller-Destination-Number",
+              "Caller-Context", "Caller-Unique-ID", "Other-Leg-Unique-ID", "Hangup-Cause", "Application",
+              "Application-Data", "Application-Response", "Application-UUID", "Event-UUID", "DTMF-Digit",
+              "Max-Sessions", "Idle-CPU", "Controlled-Session-UUID", "Socket-Mode", "Control",
+              "variable_uuid", "variable_read_result", "variable_playback_terminator_used"):
+    _headerName(_name)
+del _name
+
+
+class Event(object):
     """Event - represents an event object .
-    Extends python's email.message.Message class. so all methods that are 
-    available on Message object are available on Event object
+    Headers are kept in a dict keyed by interned header names and are looked up case insensitively.
+    Provides the parts of python's email.message.Message API that are used on FreeSWITCH messages
+    (msg['Header'], get, has_key, items, get_payload, set_unixfrom, as_string ...)
     """        
+    __slots__ = ('_headers', '_decoded', '_payload', '_unixfrom', '_lowerKeys')
+    
+    def __init__(self, headers=None, payload=''):
+        if headers is None:
+            headers = {}
+        self._headers = headers
+        self._decoded = None #memo of URL decoded values, None until decode() is called
+        self._payload = payload
+        self._unixfrom = None
+        self._lowerKeys = None #lower case header name -> header, built by _scanKey once _headerNames is full
+        
     def decode(self):
-        """Rebuild the event headers with with URL format decoded values"""
-        for k,v in self.items():
-            del self[k]
-            self[k] = urllib.unquote(v)
+        """Return URL format decoded header values from now on.
+        
+        The raw values are kept and each header is decoded the first time it is read, 
+        so the cost depends on the headers a handler actually uses. Values set afterwards are
+        taken as already decoded
+        """
+        if self._decoded is None:
+            self._decoded = {}
+            
+    def _scanKey(self, name):
+        """Return the spelling a header name missing from _headerNames is kept under, None if absent"""
+        if len(_headerNames) < _maxHeaderNames:
+            return None
+        #names that came after the table filled up are kept as given
+        lowerKeys = self._lowerKeys
+        if lowerKeys is None:
+            lowerKeys = self._lowerKeys = dict([(header.lower(), header) for header in self._headers])
+        return lowerKeys.get(name.lower())
+
+    def get(self, name, failobj=None):
+        key = _findHeaderName(name) or self._scanKey(name)
+        if key is None:
+            return failobj
+        decoded = self._decoded
+        if decoded is None:
+            return self._headers.get(key, failobj)
+        try:
+            return decoded[key]
+        except KeyError:
+            pass
+        try:
+            value = self._headers[key]
+        except KeyError:
+            return failobj
+        value = decoded[key] = urllib.unquote(value)
+        return value
+
+    def getDecoded(self, name, failobj=None):
+        """Return the URL decoded value of a header whether decode() was called or not"""
+        value = self.get(name, failobj)
+        if self._decoded is None and value is not failobj and '%' in value:
+            value = urllib.unquote(value)
+        return value
+        
+    def __getitem__(self, name):
+        return self.get(name)
+        
+    def __setitem__(self, name, value):
+        key = _findHeaderName(name) or self._scanKey(name) or _headerName(name)
+        if self._lowerKeys is not None and key not in self._headers:
+            self._lowerKeys[key.lower()] = key
+        self._headers[key] = value
+        if self._decoded is not None:
+            #set values are taken as already decoded
+            self._decoded[key] = value
+            
+    def __delitem__(self, name):
+        key = _findHeaderName(name) or self._scanKey(name)
+        if key is None:
+            return
+        self._headers.pop(key, None)
+        if self._lowerKeys is not None:
+            self._lowerKeys.pop(key.lower(), None)
+        if self._decoded is not None:
+            self._decoded.pop(key, None)
+            
+    def __contains__(self, name):
+        key = _findHeaderName(name) or self._scanKey(name)
+        return key is not None and key in self._headers
+        
+    has_key = __contains__
+    
+    def __len__(self):
+        return len(self._headers)
+        
+    def __iter__(self):
+        return iter(self._headers)
+        
+    def keys(self):
+        return self._headers.keys()
+            
+    def values(self):
+        if self._decoded is None:
+            return self._headers.values()
+        return [v for k, v in self.items()]
+        
+    def items(self):
+        decoded = self._decoded
+        if decoded is None:
+            return self._headers.items()
+        return [(k, decoded[k] if k in decoded else urllib.unquote(v)) for k, v in self._headers.iteritems()]
+        
+    def get_payload(self, i=None, decode=False):
+        """Return the payload, '' when the message has none
+
+        i and decode are accepted for compatibility with email.message.Message and ignored, FreeSWITCH
+        payloads are neither multipart nor transfer encoded
+        """
+        return self._payload
+        
+    def set_payload(self, payload):
+        self._payload = payload
+        
+    def get_unixfrom(self):
+        return self._unixfrom
+        
+    def set_unixfrom(self, unixfrom):
+        self._unixfrom = unixfrom
             
-    #Overriding this method was required as default python lib wraps headers with length greater than 78 chars which is bad for FreeSWITCH
     def as_string(self, unixfrom=False):
         """Return the entire formatted message as a string.
-        Optional `unixfrom' when True, means include the Unix From_ envelope
-        header.
-
-        This is a convenience method and may not generate the message exactly
-        as you intend because by default it mangles lines that begin with
-        "From ".  For more flexibility, use the flatten() method of a
-        Generator instance.
+        Optional `unixfrom' when True, means include the envelope line set by set_unixfrom 
+        (eg: SendMsg <uuid>). Headers are never wrapped as FreeSWITCH does not unfold them
         """
-        from email.Generator import Generator
-        from cStringIO import StringIO
-        fp = StringIO()
-        g = Generator(fp, maxheaderlen=0)
-        g.flatten(self, unixfrom=unixfrom)
-        return fp.getvalue()
+        lines = ['%s: %s\n'%item for item in self.items()]
+        if unixfrom and self._unixfrom:
+            lines.insert(0, self._unixfrom+'\n')
+        lines.append('\n')
+        if self._payload:
+            lines.append(self._payload)
+        return ''.join(lines)
+        
+    __str__ = as_string
+
+
+def parseEvent(data):
+    """Parse an EventSocket header block into an Event
+    
+    data -- (str) newline separated "Name: value" lines as sent by FreeSWITCH
+    
+    returns Event
+    """
+    headers = {}
+    names = _headerNames
+    for line in data.split('\n'):
+        name, sep, value = line.partition(':')
+        if sep:
+            key = names.get(name) or _headerName(name)
+            headers[key] = value.lstrip()
+    return Event(headers)
+
+
+class JSONEvent(Event):
+    """Event received as text/event-json, its header values arrive already decoded"""
+    __slots__ = ()
+
+    def decode(self):
+        pass
+
+    def getDecoded(self, name, failobj=None):
+        return self.get(name, failobj)
+
+
+def parseJSONEvent(data):
+    """Build an Event from a text/event-json payload
+
+    data -- (str) JSON object as sent by FreeSWITCH, the "_body" member becomes the payload
+
+    returns JSONEvent
+    """
+    headers = {}
+    names = _headerNames
+    payload = ''
+    for name, value in json.loads(data).iteritems():
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        if name == '_body':
+            payload = value
+            continue
+        key = names.get(name) or _headerName(name.encode('utf-8'))
+        headers[key] = value
+    return JSONEvent(headers, payload)
+
+
+#sendmsg header lines of the applications executed most often, others are built when sent
+_executeHeads = dict([(app, "call-command: execute\nexecute-app-name: %s\n"%app) for app in
+                      ("answer", "hangup", "playback", "set", "bridge", "play_and_get_digits")])
+
+
+def executeMessage(app, args='', uuid='', lock=True, eventUUID=''):
+    """Serialize a sendmsg execute message directly, without building an Event
+
+    returns (str) message ready to be written to FreeSWITCH
+    """
+    if uuid:
+        lines = ["SendMsg %s\n"%uuid]
+    else:
+        lines = ["SendMsg\n"]
+    head = _executeHeads.get(app)
+    if head is None:
+        head = "call-command: execute\nexecute-app-name: %s\n"%app
+    lines.append(head)
+    if args:
+        lines.append("execute-app-arg: %s\n"%args)
+    if lock:
+        lines.append("event-lock: true\n")
+    if eventUUID:
+        lines.append("Event-UUID: %s\n"%eventUUID)
+    lines.append("\n")
+    return ''.join(lines)
+
+
+#command lanes, drained in this order of priority
+LANE_CONTROL = 0
+LANE_CALL = 1
+LANE_BULK = 2
+
+#event priorities, events below PRIORITY_NORMAL are shed under overload
+PRIORITY_LOW = 0
+PRIORITY_NORMAL = 1
+PRIORITY_HIGH = 2
+
+#kinds of header predicates
+_EQUAL = 0
+_MEMBER = 1
+_PREFIX = 2
+
+
+class Prefix(object):
+    """Header predicate of registerPredicateEvent matching values starting with prefix"""
+    __slots__ = ('prefix',)
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+    def __repr__(self):
+        return "Prefix(%r)"%self.prefix
+
+
+def _indexAdd(root, path, ecb):
+    """Append ecb to the list at path in nested dicts"""
+    for key in path[:-1]:
+        root = root.setdefault(key, {})
+    root.setdefault(path[-1], []).append(ecb)
+
+
+def _indexRemove(root, path, ecb):
+    """Remove ecb from the list at path in nested dicts, deleting the entries left empty
+
+    returns False if ecb was not there
+    """
+    nodes = [root]
+    for key in path[:-1]:
+        node = nodes[-1].get(key)
+        if node is None:
+            return False
+        nodes.append(node)
+    ecbs = nodes[-1].get(path[-1])
+    if not ecbs or ecb not in ecbs:
+        return False
+    ecbs.remove(ecb)
+    if not ecbs:
+        del nodes[-1][path[-1]]
+        for i in range(len(path)-1, 0, -1):
+            if nodes[i]:
+                break
+            del nodes[i-1][path[i-1]]
+    return True
+
+
+#header lookups on frames that are not parsed yet
+_plainEventName = re.compile(r'^Event-Name: *(\S+)', re.M)
+_plainUniqueID = re.compile(r'^Unique-ID: *(\S+)', re.M)
+_jsonEventName = re.compile(r'"Event-Name" *: *"([^"]+)"')
+_jsonUniqueID = re.compile(r'"Unique-ID" *: *"([^"]+)"')
+#presence entity of events without a channel eg: PRESENCE_IN of a registration
+_plainPresenceID = re.compile(r'^(?:Channel-Presence-ID|from): *(\S+)', re.M)
+_jsonPresenceID = re.compile(r'"(?:Channel-Presence-ID|from)" *: *"([^"]+)"')
 
 
 class EventCallback:
@@ -61,6 +375,11 @@ class EventCallback:
         self.func = func        
         self.eventname = eventname
         self.subclass = None #event subclass for CUSTOM event
+        self.header = None #header name for callbacks registered with registerHeaderEvent
+        self.value = None #header value for callbacks registered with registerHeaderEvent
+        self.filter = None #(header, value) of the filter installed for this callback by FSProtocol.autoFilter
+        self.executor = None #offload.ThreadExecutor running the callback, None runs it in the reactor thread
+        self.predicates = None #(header, kind, value) checked after the index lookup for registerPredicateEvent
         self.args = args
         self.kwargs = kwargs        
         
@@ -71,31 +390,127 @@ class FSProtocol(basic.LineReceiver):
     All the FreeSWITCH api and dptool commands are defined in this class
     """
     delimiter="\n\n"
+    eventFormat = "plain" #format events are subscribed in, plain or json
+    autoFilter = False #if True install FreeSWITCH event filters matching the registered callbacks
+    commandTimeout = None #default seconds to wait for a command or api reply, None waits forever
+    backgroundJobTimeout = None #default seconds to wait for the BACKGROUND_JOB of a bgapi, None waits forever
+    coalesceWrites = False #if True outgoing commands are buffered and written once per reactor iteration
+    coalesceLimit = 65536 #bytes of buffered commands that trigger an immediate write when coalescing
+    compactSize = 65536 #consumed bytes of receive buffer to keep around before compacting it
+    useLanes = False #if True outgoing commands are queued in priority lanes instead of being written at once
+    workerPool = None #workers.WorkerPool the events are also forwarded to
+    highWater = None #events queued in executors and workers at which reading from FreeSWITCH pauses, None never pauses
+    lowWater = None #queued events at which reading resumes, defaults to half of highWater
+    backlogPollInterval = 0.05 #seconds between checks of the queued events while reading is paused
+    shedLag = None #seconds of dispatch lag above which low priority events are shed, None never sheds
+    lagProbeInterval = 0.1 #seconds between measurements of the reactor lag when shedLag is set
+    eventPriorities = {'HEARTBEAT':PRIORITY_LOW, 'RE_SCHEDULE':PRIORITY_LOW, 'PRESENCE_IN':PRIORITY_LOW,
+                       'CHANNEL_CALLSTATE':PRIORITY_LOW, 'CHANNEL_HANGUP_COMPLETE':PRIORITY_HIGH,
+                       'BACKGROUND_JOB':PRIORITY_HIGH}
+    #low priority events shed by keeping the latest one per channel or presence entity instead of dropping them
+    coalesceEvents = frozenset(['PRESENCE_IN', 'CHANNEL_CALLSTATE'])
+    laneWeights = None #commands written per lane in turn, at least 1 each eg: (8, 4, 1), None drains lanes in strict priority order
+    maxOutstanding = 65536 #bytes of written commands waiting for their reply before the lanes stop draining
+    #api commands by lane, other api commands go to LANE_CALL and other commands to LANE_CONTROL
+    laneCommands = {'uuid_kill':LANE_CONTROL, 'hupall':LANE_CONTROL, 'uuid_break':LANE_CONTROL,
+                    'fsctl':LANE_CONTROL, 'originate':LANE_BULK, 'uuid_broadcast':LANE_BULK}
     jobType = False
     state = "READ_CONTENT"
         
     def connectionMade(self):
+        if self.laneWeights is not None and (len(self.laneWeights) != 3 or min(self.laneWeights) < 1):
+            #a lane without credits would never be drained
+            raise ValueError("laneWeights needs a weight of at least 1 for each of the 3 lanes, got %r"%(self.laneWeights,))
         self.contentCallbacks = {"auth/request":self.auth, 
                         "api/response":self.onAPIReply, 
                         "command/reply":self.onCommandReply, 
-                        "text/event-plain":self.onEvent, 
+                        "text/event-plain":self.onEvent,
+                        "text/event-json":self.onEventJSON,
                         "text/disconnect-notice":self.disconnectNotice
                         }
-        self.pendingJobs = []   
-        self.pendingBackgroundJobs = {}        
+        self.pendingJobs = deque() #deferreds waiting for replies, in the order the commands were sent
+        self.pendingBackgroundJobs = OrderedDict() #Job-UUID -> deferred waiting for the BACKGROUND_JOB event
         self.eventCallbacks = {}
         self.customEventCallbacks = {}
-        self.subscribedEvents = []        
+        self.headerEventCallbacks = {} #event -> header name -> header value -> [EventCallback]
+        self.prefixEventCallbacks = {} #event -> header name -> prefix length -> prefix -> [EventCallback]
+        self.subscribedEvents = []
+        self.subscriptions = [] #event and myevents command lines sent, to restore the subscriptions on a new connection
+        self.eventFilters = {} #(header, value) -> number of users of the filter
+        self._buffer = bytearray()
+        self._bufferOffset = 0 #start of unread data in self._buffer
+        self._searchOffset = 0 #position to resume looking for the delimiter from
+        self._writeBuffer = [] #outgoing data waiting for the end of the reactor iteration when coalescing writes
+        self._writeBufferSize = 0
+        self._flushCall = None
+        self.lanes = (deque(), deque(), deque()) #(data, deferred, Job-UUID) commands waiting for their turn
+        self._laneCredits = [0, 0, 0]
+        self._outstanding = 0 #bytes written in lanes mode and not answered yet
+        self._outstandingJobs = {} #Job-UUID -> size of the bgapi command written in lanes mode
+        self.executors = set() #executors of the registered callbacks
+        self.readPauses = 0 #times reading was paused because handlers fell behind
+        self._resumeCall = None
+        self.lag = 0.0 #reactor lag measured by the last probe
+        self.shedCounts = {} #event name -> events dropped
+        self.coalescedCounts = {} #event name -> events replaced by a later one of the same channel
+        self._coalesced = OrderedDict() #(event name, Unique-ID or presence, value) -> (frame, True if JSON) waiting for the overload to end
+        self._readStarted = None
+        self._lagCall = None
+        self.disconnected = False #True once the connection is lost, commands then fail at once
+        if self.shedLag is not None:
+            self._probeLag()
         log.info("Connected to FreeSWITCH")
         
     def connectionLost(self, reason):
         log.info("Cleaning up")
+        self.disconnected = True
+        if self._lagCall is not None and self._lagCall.active():
+            self._lagCall.cancel()
+        self._lagCall = None
+        if self._flushCall is not None and self._flushCall.active():
+            self._flushCall.cancel()
+        self._flushCall = None
+        self._writeBuffer = []
+        self._writeBufferSize = 0
+        if self._resumeCall is not None and self._resumeCall.active():
+            self._resumeCall.cancel()
+        self._resumeCall = None
+        self.failPendingJobs(Disconnected("Connection to FreeSWITCH lost"))
         self.disconnectedFromFreeSWITCH()
         
+    def failPendingJobs(self, error):
+        """Fail every command waiting for a reply, a BACKGROUND_JOB or its turn in the lanes, and the bgapi
+        jobs the worker processes of self.workerPool sent through this connection
+
+        error -- (Exception) error the deferreds fail with
+        """
+        dfs = list(self.pendingJobs) + self.pendingBackgroundJobs.values()
+        for lane in self.lanes:
+            dfs.extend([df for data, df, jobid in lane if df is not None])
+            lane.clear()
+        self.pendingJobs.clear()
+        self.pendingBackgroundJobs.clear()
+        self._outstanding = 0
+        self._outstandingJobs.clear()
+        if self.workerPool is not None and self.workerPool.protocol is self:
+            self.workerPool.failJobs(error)
+        for df in dfs:
+            if not df.called:
+                df.errback(error)
+
     def disconnectedFromFreeSWITCH(self):
         """Over-ride this to get notified of FreeSWITCH disconnection"""
         pass
     
+    def _makeCallback(self, event, function, args, kwargs):
+        """Return the EventCallback of function for event, run by the executor given in kwargs if any"""
+        executor = kwargs.pop('executor', None)
+        ecb = EventCallback(event, function, *args, **kwargs)
+        ecb.executor = executor
+        if executor is not None:
+            self.executors.add(executor)
+        return ecb
+
     def registerEvent(self, event,subscribe, function, *args, **kwargs):
         """Register a callback for the event 
         event -- (str) Event name as sent by FreeSWITCH , Custom events should give subclass also 
@@ -103,14 +518,15 @@ class FSProtocol(basic.LineReceiver):
         subsribe -- (bool) if True subscribe to this event
         function -- callback function accepts a event dictionary as first argument
         args -- argumnet to be passed to callback function
-        kwargs -- keyword arguments to be passed to callback function
+        kwargs -- keyword arguments to be passed to callback function, except executor which is an
+                  offload.ThreadExecutor to run the callback in
         
         returns instance of  EventCallback , keep a reference of this around if you want to deregister it later
         """
         if subscribe:
             if self.needToSubscribe(event):
                 self.subscribeEvents(event)
-        ecb = EventCallback(event, function, *args, **kwargs)
+        ecb = self._makeCallback(event, function, args, kwargs)
         ecb_list = self.eventCallbacks.get(event, [])
         event_callbacks = self.eventCallbacks
         #handle CUSTOM events 
@@ -122,8 +538,114 @@ class FSProtocol(basic.LineReceiver):
             event_callbacks = self.customEventCallbacks
         ecb_list.append(ecb)
         event_callbacks[event] = ecb_list
+        if self.autoFilter:
+            self._addEventFilter(ecb)
         return ecb
         
+    def registerHeaderEvent(self, event, header, value, subscribe, function, *args, **kwargs):
+        """Register a callback for the event only when the given header has the given value
+
+        Such callbacks are kept in an index looked up by header value, so dispatching an event
+        costs the same no matter how many channels have callbacks waiting
+
+        event -- (str) Event name as sent by FreeSWITCH, CUSTOM events should give subclass also.
+                        ALL matches every event
+        header -- (str) header name eg: Unique-ID
+        value -- (str) value the header should have, URL decoded eg: +4420 not %2B4420
+        subsribe -- (bool) if True subscribe to this event
+        function -- callback function accepts a event dictionary as first argument
+        args -- argumnet to be passed to callback function
+        kwargs -- keyword arguments to be passed to callback function, except executor which is an
+                  offload.ThreadExecutor to run the callback in
+
+        returns instance of  EventCallback , keep a reference of this around if you want to deregister it later
+        """
+        if subscribe:
+            if self.needToSubscribe(event):
+                self.subscribeEvents(event)
+        ecb = self._makeCallback(event, function, args, kwargs)
+        ecb.header = header
+        ecb.value = value
+        if event.upper() == 'ALL':
+            event = 'ALL'
+        values = self.headerEventCallbacks.setdefault(event, {}).setdefault(header, {})
+        values.setdefault(value, []).append(ecb)
+        if self.autoFilter:
+            ecb.filter = (header, value)
+            self.addFilter(header, value)
+        return ecb
+
+    def registerPredicateEvent(self, event, predicates, subscribe, function, *args, **kwargs):
+        """Register a callback for the event only when its headers match all the predicates
+
+        A predicate is a value the header should have, a set of values it should be one of or a Prefix
+        its value should start with, eg: {'Caller-Context':'default', 'variable_tenant_id':set(['1', '2']),
+        'Caller-Destination-Number':Prefix('+44')}. Values are compared URL decoded, also in plain
+        format where FreeSWITCH sends +44 as %2B44. One predicate of each callback goes in the header
+        index, the one sharing its entry with the fewest callbacks registered so far, so dispatching an
+        event costs one lookup per indexed header and prefix length whatever the number of callbacks,
+        the other predicates are only checked for the callbacks found.
+
+        event -- (str) Event name as sent by FreeSWITCH, CUSTOM events should give subclass also.
+                        ALL matches every event
+        predicates -- (dict) header name -> str, set of str or Prefix
+        See registerHeaderEvent for the other arguments
+
+        returns instance of  EventCallback , keep a reference of this around if you want to deregister it later
+        """
+        key = 'ALL' if event.upper() == 'ALL' else event
+        headers = self.headerEventCallbacks.get(key, {})
+        prefixHeaders = self.prefixEventCallbacks.get(key, {})
+        compiled = []
+        for header, value in predicates.items():
+            #the predicate sharing its index entry with the fewest callbacks is the anchor
+            if isinstance(value, Prefix):
+                shared = len(prefixHeaders.get(header, {}).get(len(value.prefix), {}).get(value.prefix, ()))
+                compiled.append((shared, _PREFIX, -len(value.prefix), header, value))
+            elif isinstance(value, (set, frozenset, list, tuple)):
+                value = frozenset(value)
+                values = headers.get(header, {})
+                shared = sum([len(values.get(member, ())) for member in value])
+                compiled.append((shared, _MEMBER, 0, header, value))
+            else:
+                shared = len(headers.get(header, {}).get(value, ()))
+                compiled.append((shared, _EQUAL, 0, header, value))
+        if not compiled:
+            raise ValueError("registerPredicateEvent needs at least one predicate")
+        compiled.sort()
+        if subscribe:
+            if self.needToSubscribe(event):
+                self.subscribeEvents(event)
+        ecb = self._makeCallback(event, function, args, kwargs)
+        ecb.header, ecb.value = compiled[0][3:]
+        if len(compiled) > 1:
+            ecb.predicates = tuple([(header, kind, value) for _, kind, _, header, value in compiled[1:]])
+        for root, path in self._headerIndexPaths(ecb):
+            _indexAdd(root, path, ecb)
+        if self.autoFilter:
+            self._addEventFilter(ecb)
+        return ecb
+
+    def _headerIndexPaths(self, ecb):
+        """Return (index, path) of every place a header callback is kept in the indexes"""
+        event = ecb.eventname
+        if event.upper() == 'ALL':
+            event = 'ALL'
+        value = ecb.value
+        if isinstance(value, Prefix):
+            return [(self.prefixEventCallbacks, (event, ecb.header, len(value.prefix), value.prefix))]
+        if isinstance(value, frozenset):
+            return [(self.headerEventCallbacks, (event, ecb.header, member)) for member in value]
+        return [(self.headerEventCallbacks, (event, ecb.header, value))]
+
+    def registerChannelEvent(self, event, uuid, subscribe, function, *args, **kwargs):
+        """Register a callback for the event of a single channel
+
+        uuid -- (str) Unique-ID of the channel
+        See registerHeaderEvent for the other arguments
+        """
+        return self.registerHeaderEvent(event, 'Unique-ID', uuid, subscribe, function, *args, **kwargs)
+
     def needToSubscribe(self, event):
         """Decide if we need to subscribe to an event or not by comparing the event provided against already subscribeEvents
         
@@ -145,53 +667,103 @@ class FSProtocol(basic.LineReceiver):
         
         ecb -- (EventCallback) instance of EventCallback object
         """
+        if ecb.header is not None:
+            return self._deregisterHeaderEvent(ecb)
         callbacks_list = self.eventCallbacks
-        if ecb.eventname == 'CUSTOM':
+        eventname = ecb.eventname
+        if ecb.subclass:
             callbacks_list = self.customEventCallbacks
-        ecbs = callbacks_list[ecb.eventname]
+            eventname = ecb.subclass
+        ecbs = callbacks_list.get(eventname, [])
         try:
             ecbs.remove(ecb)
         except ValueError:
             log.error("%s already deregistered "%ecb)
+            return
+        if ecb.filter:
+            self.removeFilter(*ecb.filter)
+
+    def _deregisterHeaderEvent(self, ecb):
+        """Remove a callback registered with registerHeaderEvent or registerPredicateEvent, dropping index entries left empty"""
+        removed = False
+        for root, path in self._headerIndexPaths(ecb):
+            removed = _indexRemove(root, path, ecb) or removed
+        if not removed:
+            log.error("%s already deregistered "%ecb)
+            return
+        if ecb.filter:
+            self.removeFilter(*ecb.filter)
 
     def dataReceived(self, data):
         """
         We override this twisted method to avoid being disconnected by default MAX_LENGTH for messages which cross
-        that limit
+        that limit.
+        
+        Received data is appended to a bytearray and frames are sliced out of it by advancing a read offset.
+        The delimiter search resumes where the previous one stopped and the consumed head of the buffer is only 
+        dropped once it outgrows the unread part, so a burst of frames costs time linear in its size
         """
         if self._busyReceiving:
-            self._buffer += data
+            self._buffer.extend(data)
             return
 
         try:
             self._busyReceiving = True
-            self._buffer += data
-            while self._buffer and not self.paused:
+            if self.shedLag is not None:
+                self._readStarted = reactor.seconds()
+            buf = self._buffer
+            buf.extend(data)
+            delimiter = self.delimiter
+            while len(buf) > self._bufferOffset and not self.paused:
+                start = self._bufferOffset
                 if self.line_mode:
-                    try:
-                        line, self._buffer = self._buffer.split(
-                            self.delimiter, 1)
-                    except ValueError:
+                    end = buf.find(delimiter, max(start, self._searchOffset))
+                    if end < 0:
+                        self._searchOffset = max(start, len(buf) - len(delimiter) + 1)
                         return
-                    else:
-                        why = self.lineReceived(line)
-                        if (why or self.transport and
-                            self.transport.disconnecting):
-                            return why
+                    line = str(buf[start:end])
+                    self._bufferOffset = end + len(delimiter)
+                    why = self.lineReceived(line)
+                    if (why or self.transport and
+                        self.transport.disconnecting):
+                        return why
                 else:
-                    data = self._buffer
-                    self._buffer = b''
+                    end = min(len(buf), start + self._rawBytesWanted())
+                    data = str(buf[start:end])
+                    self._bufferOffset = end
                     why = self.rawDataReceived(data)
                     if why:
                         return why
         finally:
             self._busyReceiving = False
+            self._readStarted = None
+            self._compactBuffer()
+            
+    def _compactBuffer(self):
+        """Drop the consumed head of the receive buffer when it is empty or mostly consumed"""
+        buf = self._buffer
+        offset = self._bufferOffset
+        if offset >= len(buf):
+            del buf[:]
+            self._bufferOffset = self._searchOffset = 0
+        elif offset >= self.compactSize and offset*2 >= len(buf):
+            del buf[:offset]
+            self._bufferOffset = 0
+            self._searchOffset = max(0, self._searchOffset-offset)
+            
+    def clearLineBuffer(self):
+        """Clear the unread part of the receive buffer and return it"""
+        data = str(self._buffer[self._bufferOffset:])
+        del self._buffer[:]
+        self._bufferOffset = self._searchOffset = 0
+        return data
 
     def lineReceived(self, line):
         log.debug("Line In: %s"%line)
-        self.parser = FeedParser(Event)        
-        self.parser.feed(line)
-        self.message = self.parser.close()
+        if self.state == "READ_EVENT" and self.shedLag is not None and self.shedEvent(line, False):
+            self.state = "READ_CONTENT"
+            return
+        self.message = parseEvent(line)
         #if self.state is not READ_CONTENT (i.e Content-Type is already read) and the Content-Length is present
         #read rest of the message and set it as payload
         if self.message.has_key('Content-Length') and self.state!= 'READ_CONTENT':
@@ -204,28 +776,51 @@ class FSProtocol(basic.LineReceiver):
             log.error("Exception in message processing ", exc_info=True)
         
     def rawDataReceived(self, data):
-        """Read length of raw data specified by self.contentLength and set it as message payload """
+        """Read length of raw data specified by self.contentLength and set it as message payload
+
+        Chunks are collected in a list and joined once the whole payload is in,
+        data beyond the payload goes back to line mode
+        """
         log.debug("Data In : %s"%data)
-        self.rawdataCache = ''.join([self.rawdataCache, data])
-        if len(self.rawdataCache) >= self.contentLength-1:
-            self.clearLineBuffer()
-            extra = self.rawdataCache[self.contentLength:]            
-            currentResult = self.rawdataCache[:self.contentLength]
+        wanted = self.contentLength - self.rawdataLength
+        if len(data) > wanted:
+            extra = data[wanted:]
+            data = data[:wanted]
+        else:
+            extra = ''
+        self.rawdataChunks.append(data)
+        self.rawdataLength += len(data)
+        if self.rawdataLength >= self.contentLength:
+            chunks = self.rawdataChunks
+            if len(chunks) == 1:
+                currentResult = chunks[0]
+            else:
+                currentResult = ''.join(chunks)
+            self.rawdataChunks = []
             self.message.set_payload(currentResult)
             try:
-                self.inspectMessage()   
+                self.inspectMessage()
             except:
-                log.error("Exception in message processing ", exc_info=True)        
+                log.error("Exception in message processing ", exc_info=True)
             self.setLineMode(extra)
 
+    def _rawBytesWanted(self):
+        """Number of payload bytes still to be read in raw mode"""
+        return self.contentLength - self.rawdataLength
+
+    def _startRawRead(self):
+        """Switch to raw mode to read self.contentLength bytes of payload"""
+        self.rawdataChunks = []
+        self.rawdataLength = 0
+        self.setRawMode()
+
     def enterRawMode(self):
         """
         Change to raw mode from line mode if self.contentLength > 0
         """
         self.contentLength = int(self.message['Content-Length'].strip())
         if self.contentLength > 0:
-            self.rawdataCache =''
-            self.setRawMode()
+            self._startRawRead()
             return True
         return False
 
@@ -233,6 +828,8 @@ class FSProtocol(basic.LineReceiver):
         """Inspect message and dispatch based on self.state or Content-Type of message """
         if self.state == "READ_EVENT":
             return self.dispatchEvent()
+        if self.state == "READ_EVENT_JSON":
+            return self.dispatchJSONEvent()
         if self.state == "READ_CHANNELINFO":
             return self.onConnect()
         if self.state == 'READ_API':
@@ -246,6 +843,112 @@ class FSProtocol(basic.LineReceiver):
         except KeyError:
             log.error("Got unimplemented Content-Type : %s"%ct)
             
+    def dispatchJSONEvent(self):
+        """Decode the JSON event read as payload and dispatch it like a plain event"""
+        payload = self.message.get_payload()
+        if self.shedLag is not None and self.shedEvent(payload, True):
+            self.state = "READ_CONTENT"
+            return
+        self.message = parseJSONEvent(payload)
+        return self.dispatchEvent()
+
+    def isOverloaded(self):
+        """Return True if events are dispatched more than self.shedLag seconds late
+
+        The lag is the larger of the reactor lag of the last probe and the time spent on the data being read
+        """
+        lag = self.lag
+        if self._readStarted is not None:
+            lag = max(lag, reactor.seconds() - self._readStarted)
+        return lag > self.shedLag
+
+    def shedEvent(self, frame, isJSON):
+        """Drop or coalesce a low priority event while overloaded, before its headers are parsed
+
+        Events listed in self.coalesceEvents are kept until the overload ends, only the latest one of each
+        channel, or of each presence entity for events without Unique-ID, is dispatched then. Those with
+        neither are dropped. Plain events with a body are never shed.
+
+        frame -- (str) header block of a plain event or payload of a JSON event
+        isJSON -- (bool) True for a JSON event
+
+        returns True if the event was shed
+        """
+        if self._lagCall is None:
+            #shedLag was set after connectionMade, eg: on the protocol built by an InboundFactory
+            self._probeLag()
+        if not self.isOverloaded():
+            return False
+        if isJSON:
+            match = _jsonEventName.search(frame)
+        else:
+            if frame.startswith('Content-Length:') or '\nContent-Length:' in frame:
+                return False
+            match = _plainEventName.search(frame)
+        if match is None:
+            return False
+        name = match.group(1)
+        if self.eventPriorities.get(name, PRIORITY_NORMAL) >= PRIORITY_NORMAL:
+            return False
+        if name in self.coalesceEvents:
+            key = self._coalesceKey(name, frame, isJSON)
+            if key is not None:
+                if self._coalesced.pop(key, None) is not None:
+                    self.coalescedCounts[name] = self.coalescedCounts.get(name, 0) + 1
+                self._coalesced[key] = (frame, isJSON)
+                return True
+        self.shedCounts[name] = self.shedCounts.get(name, 0) + 1
+        return True
+
+    def _coalesceKey(self, name, frame, isJSON):
+        """Return the key of the events replaced by this one, None if it names no channel nor presence entity"""
+        if isJSON:
+            patterns = ((_jsonUniqueID, 'Unique-ID'), (_jsonPresenceID, 'presence'))
+        else:
+            patterns = ((_plainUniqueID, 'Unique-ID'), (_plainPresenceID, 'presence'))
+        for pattern, kind in patterns:
+            match = pattern.search(frame)
+            if match is not None:
+                return (name, kind, match.group(1))
+        return None
+
+    def flushCoalesced(self):
+        """Dispatch the coalesced events kept while overloaded"""
+        coalesced, self._coalesced = self._coalesced, OrderedDict()
+        #keep the frame being read intact, this runs between reads
+        state, message = self.state, getattr(self, 'message', None)
+        for frame, isJSON in coalesced.itervalues():
+            if isJSON:
+                self.message = parseJSONEvent(frame)
+            else:
+                self.message = parseEvent(frame)
+            try:
+                self.dispatchEvent()
+            except:
+                log.error("Exception in message processing ", exc_info=True)
+        self.state, self.message = state, message
+
+    def _probeLag(self, expected=None):
+        self._lagCall = None
+        if self.shedLag is None:
+            #shedding was turned off, nothing is kept back any more
+            self.lag = 0.0
+            if self._coalesced:
+                self.flushCoalesced()
+            return
+        now = reactor.seconds()
+        if expected is not None:
+            self.lag = max(0.0, now - expected)
+        if self._coalesced and not self.isOverloaded():
+            self.flushCoalesced()
+        self._lagCall = reactor.callLater(self.lagProbeInterval, self._probeLag, now + self.lagProbeInterval)
+
+    def sheddingStats(self):
+        """Return the measured lag, whether events are being shed and the events dropped and coalesced by name"""
+        return {'lag':self.lag, 'overloaded':self.shedLag is not None and self.isOverloaded(),
+                'shed':dict(self.shedCounts), 'coalesced':dict(self.coalescedCounts),
+                'waiting':len(self._coalesced)}
+
     def dispatchEvent(self):
         self.state = "READ_CONTENT"
         eventname = self.message['Event-Name']        
@@ -255,22 +958,120 @@ class FSProtocol(basic.LineReceiver):
                 df = self.pendingBackgroundJobs.pop(self.message['Job-UUID'])
                 df.callback(self.message)
             except KeyError:
-                log.error("Stray BACKGROUND_JOB event received %s", self.message['Job-UUID'])
+                #BACKGROUND_JOB events are sent to every connection subscribed to them, not only to the one running the job
+                log.debug("Stray BACKGROUND_JOB event received %s", self.message['Job-UUID'])
             except:
                 log.error("Error in BACKGROUND_JOB event handler", exc_info=True)
+        if self.workerPool is not None:
+            try:
+                self.workerPool.forward(self.message)
+            except:
+                log.error("Error forwarding event to the worker processes", exc_info=True)
         if eventname == 'CUSTOM':
             self.message.decode()
-            ecbs = self.customEventCallbacks.get(self.message['Event-Subclass'], None)
+            subclass = self.message['Event-Subclass']
+            ecbs = self.customEventCallbacks.get(subclass, None)
+            if self.headerEventCallbacks or self.prefixEventCallbacks:
+                ecbs = self._matchHeaderCallbacks("CUSTOM %s"%subclass, ecbs)
         else:
             ecbs = self.eventCallbacks.get(eventname, None)
-        if ecbs is None:
-            return       
-                
-        for ecb in ecbs:
-            try:
-                ecb.func(self.message, *ecb.args, **ecb.kwargs)                
-            except:                
-                log.error("Message %s\nError in event handler %s on event %s:"%(self.message, ecb.func, eventname), exc_info=True)
+            if self.headerEventCallbacks or self.prefixEventCallbacks:
+                ecbs = self._matchHeaderCallbacks(eventname, ecbs)
+        if ecbs:
+            for ecb in tuple(ecbs):
+                try:
+                    if ecb.executor is not None:
+                        ecb.executor.submit(self.message, ecb)
+                    else:
+                        ecb.func(self.message, *ecb.args, **ecb.kwargs)
+                except:                
+                    log.error("Message %s\nError in event handler %s on event %s:"%(self.message, ecb.func, eventname), exc_info=True)
+        if not self.paused and (self.highWater is not None or self.executors):
+            self.checkBacklog()
+
+    def dispatchBacklog(self):
+        """Return the number of events waiting in the executors of the callbacks and in the worker processes"""
+        backlog = 0
+        for executor in self.executors:
+            backlog += executor.backlog()
+        if self.workerPool is not None:
+            backlog += self.workerPool.backlog()
+        return backlog
+
+    def executorsOverflowing(self):
+        """Return True if an executor with policy block holds events its queues have no room for"""
+        for executor in self.executors:
+            if executor.overflowing():
+                return True
+        return False
+
+    def checkBacklog(self):
+        """Stop reading from FreeSWITCH once self.highWater events are waiting to be handled, or while an
+        executor with policy block has events waiting for room
+
+        Frames already received stay in the receive buffer and FreeSWITCH queues the new ones, reading
+        resumes when no more than self.lowWater events are waiting
+        """
+        if not self.executorsOverflowing() and (self.highWater is None or self.dispatchBacklog() < self.highWater):
+            return
+        log.warning("Event handlers fell behind, pausing reads from FreeSWITCH")
+        self.readPauses += 1
+        self.pauseProducing()
+        self._resumeCall = reactor.callLater(self.backlogPollInterval, self._pollBacklog)
+
+    def _pollBacklog(self):
+        self._resumeCall = None
+        lowWater = self.lowWater
+        if lowWater is None and self.highWater is not None:
+            lowWater = self.highWater // 2
+        if self.executorsOverflowing() or (lowWater is not None and self.dispatchBacklog() > lowWater):
+            self._resumeCall = reactor.callLater(self.backlogPollInterval, self._pollBacklog)
+            return
+        log.info("Event handlers caught up, resuming reads from FreeSWITCH")
+        self.resumeProducing()
+
+    def _matchHeaderCallbacks(self, event, ecbs):
+        """Return ecbs extended with the header callbacks of event and ALL matching the current message"""
+        message = self.message
+        found = []
+        for key in (event, 'ALL'):
+            headers = self.headerEventCallbacks.get(key)
+            if headers:
+                for header, values in headers.iteritems():
+                    matched = values.get(message.getDecoded(header))
+                    if matched:
+                        found.extend(matched)
+            headers = self.prefixEventCallbacks.get(key)
+            if headers:
+                for header, lengths in headers.iteritems():
+                    value = message.getDecoded(header)
+                    if value is None:
+                        continue
+                    for length, prefixes in lengths.iteritems():
+                        matched = prefixes.get(value[:length])
+                        if matched:
+                            found.extend(matched)
+        if not found:
+            return ecbs
+        matched = list(ecbs or ())
+        for ecb in found:
+            if ecb.predicates is None or self._checkPredicates(ecb.predicates):
+                matched.append(ecb)
+        return matched
+
+    def _checkPredicates(self, predicates):
+        message = self.message
+        for header, kind, expected in predicates:
+            value = message.getDecoded(header)
+            if kind == _EQUAL:
+                if value != expected:
+                    return False
+            elif kind == _MEMBER:
+                if value not in expected:
+                    return False
+            elif value is None or not value.startswith(expected.prefix):
+                return False
+        return True
 
     def onConnect(self):
         """Channel Information is ready to be read.
@@ -283,35 +1084,51 @@ class FSProtocol(basic.LineReceiver):
         """
         pass
         
+    def _popPendingJob(self):
+        """Pop the deferred the current reply belongs to
+
+        returns the deferred or None if there is none or it already timed out or was cancelled
+        """
+        try:
+            df = self.pendingJobs.popleft()
+        except IndexError:
+            log.error("Reply received with out pending deferred %s"%self.message)
+            return None
+        if self._outstanding:
+            self._releaseOutstanding(getattr(df, 'frameSize', 0))
+        if df.called:
+            log.debug("Discarding reply to a timed out or cancelled command")
+            return None
+        return df
+
     def fireAPIDeferred(self):
         self.state = 'READ_CONTENT'
-        df = self.pendingJobs.pop(0)
-        df.callback(self.message)
-        
+        df = self._popPendingJob()
+        if df is not None:
+            df.callback(self.message)
+
     def onAPIReply(self):
         """
-        Handle API reply 
+        Handle API reply
         """
-        if not self.message.has_key("Content-Length"):            
-            self.currentDeferred = self.pendingJobs.pop(0)
-            return self.currentDeferred.callback(self.message)
-        if self.enterRawMode():
+        if self.message.has_key("Content-Length") and self.enterRawMode():
             self.state = "READ_API"
             log.debug("Entering raw mode to read API response")
             return
-        else:
-            self.currentDeferred.callback(self.message)
-        
+        df = self._popPendingJob()
+        if df is not None:
+            df.callback(self.message)
+
     def onCommandReply(self):
         """
-        Handle CommandReply        
+        Handle CommandReply
         """
         if self.message.has_key("Job-UUID"):
+            if self._outstandingJobs:
+                self._releaseOutstanding(self._outstandingJobs.pop(self.message['Job-UUID'], 0))
             return
-        try:
-            df = self.pendingJobs.pop(0)
-        except IndexError:
-            log.error("Command reply message received with out pending deferred %s"%self.message)
+        df = self._popPendingJob()
+        if df is None:
             return
         if self.message['Reply-Text'].startswith("+OK"):
             df.callback(self.message)        
@@ -324,7 +1141,15 @@ class FSProtocol(basic.LineReceiver):
         Handle a new event
         """
         self.state = "READ_EVENT"
-        
+
+    def onEventJSON(self):
+        """
+        Handle a new JSON event, the whole event is the payload of this message
+        """
+        self.state = "READ_EVENT_JSON"
+        if not self.enterRawMode():
+            self.state = "READ_CONTENT"
+
     def disconnectNotice(self):
         """
         Handle disconnect notice 
@@ -336,8 +1161,7 @@ class FSProtocol(basic.LineReceiver):
         if self.contentLength>0:
             self.currentDeferred = defer.Deferred()
             log.info("Enter raw mode to read disconnect notice")
-            self.rawdataCache = ''
-            self.setRawMode()
+            self._startRawRead()
         else:
             self.disconnectNoticeReceived(self.message)
        
@@ -346,83 +1170,407 @@ class FSProtocol(basic.LineReceiver):
         log.error("disconnectNoticeReceived not implemented")
         log.info(msg)
         
-    def sendData(self, cmd, args=''):
-        df = defer.Deferred()
-        #self.pendingJobs.append((cmd, df))
-        self.pendingJobs.append(df)
+    def _newJob(self, timeout, canceller=None, onTimeout=None):
+        """Create the deferred for a command, failing with CommandTimeout after timeout seconds
+
+        timeout -- (int/float) seconds to wait, None uses self.commandTimeout
+        canceller -- function called with the deferred when it is cancelled
+        onTimeout -- function called with the deferred when it times out, before it fails
+        """
+        df = defer.Deferred(canceller)
+        df.sentAt = reactor.seconds()
+        if timeout is None:
+            timeout = self.commandTimeout
+        if timeout:
+            timer = reactor.callLater(timeout, self._jobTimedOut, df, timeout, onTimeout)
+            df.addBoth(self._cancelJobTimer, timer)
+        return df
+
+    def _jobTimedOut(self, df, timeout, onTimeout):
+        if onTimeout is not None:
+            onTimeout(df)
+        df.errback(CommandTimeout("No reply from FreeSWITCH in %s seconds"%timeout))
+
+    def _cancelJobTimer(self, result, timer):
+        if timer.active():
+            timer.cancel()
+        return result
+
+    def pendingStats(self):
+        """Return the number of commands waiting for FreeSWITCH and how long the oldest ones have been waiting
+
+        returns dict with keys pendingJobs, oldestJob, pendingBackgroundJobs, oldestBackgroundJob and
+        queued (commands waiting in the lanes), ages are in seconds and None when nothing is waiting
+        """
+        now = reactor.seconds()
+        stats = {'pendingJobs':len(self.pendingJobs), 'oldestJob':None,
+                 'pendingBackgroundJobs':len(self.pendingBackgroundJobs), 'oldestBackgroundJob':None,
+                 'queued':sum([len(lane) for lane in self.lanes])}
+        if self.pendingJobs:
+            stats['oldestJob'] = now - self.pendingJobs[0].sentAt
+        if self.pendingBackgroundJobs:
+            stats['oldestBackgroundJob'] = now - next(self.pendingBackgroundJobs.itervalues()).sentAt
+        return stats
+
+    def sendLine(self, line):
+        return self.writeData(line+self.delimiter)
+
+    def writeData(self, data):
+        """Write data to FreeSWITCH
+
+        When self.coalesceWrites is set the data is buffered and written together with everything else
+        sent in the same reactor iteration, or as soon as self.coalesceLimit bytes are buffered
+        """
+        if not self.coalesceWrites:
+            return self.transport.write(data)
+        self._writeBuffer.append(data)
+        self._writeBufferSize += len(data)
+        if self._writeBufferSize >= self.coalesceLimit:
+            self.flushWrites()
+        elif self._flushCall is None:
+            self._flushCall = reactor.callLater(0, self.flushWrites)
+
+    def flushWrites(self):
+        """Write out the data buffered by write coalescing"""
+        if self._flushCall is not None and self._flushCall.active():
+            self._flushCall.cancel()
+        self._flushCall = None
+        if self._writeBuffer:
+            data = ''.join(self._writeBuffer)
+            self._writeBuffer = []
+            self._writeBufferSize = 0
+            self.transport.write(data)
+
+    def _queueCommands(self, commands):
+        """Write commands to FreeSWITCH, or queue them in their lanes when self.useLanes is set
+
+        commands -- (list) (data, deferred waiting for the reply or None, Job-UUID of a bgapi or None) tuples
+        """
+        if self.disconnected:
+            #a protocol kept around after its connection was lost, nothing would ever reply
+            error = Disconnected("Not connected to FreeSWITCH")
+            for data, df, jobid in commands:
+                if df is None and jobid is not None:
+                    df = self.pendingBackgroundJobs.pop(jobid, None)
+                    if df is None and self.workerPool is not None:
+                        self.workerPool.failJob(jobid, error)
+                if df is not None and not df.called:
+                    df.errback(error)
+            return
+        if not self.useLanes:
+            for data, df, jobid in commands:
+                if df is not None:
+                    self.pendingJobs.append(df)
+            self.writeData(''.join([command[0] for command in commands]))
+            return
+        for command in commands:
+            self.lanes[self.laneFor(command[0])].append(command)
+        self.drainLanes()
+
+    def laneFor(self, data):
+        """Return the lane a command is queued in
+
+        data -- (str) serialized command
+        """
+        if data.startswith('SendMsg'):
+            return LANE_CALL
+        verb, _, rest = data.partition(' ')
+        if verb not in ('api', 'bgapi'):
+            return LANE_CONTROL
+        return self.laneCommands.get(rest.split(None, 1)[0] if rest.strip() else '', LANE_CALL)
+
+    def drainLanes(self):
+        """Write queued commands, highest priority lane first, until self.maxOutstanding bytes are waiting for replies
+
+        Commands that timed out or were cancelled while queued are dropped without being sent
+        """
+        out = []
+        while self._outstanding < self.maxOutstanding:
+            command = self._nextCommand()
+            if command is None:
+                break
+            data, df, jobid = command
+            if df is not None:
+                if df.called:
+                    continue
+                df.frameSize = len(data)
+                self.pendingJobs.append(df)
+            elif jobid is not None:
+                #bgapi of this protocol that timed out or was cancelled, the ones of worker processes wait elsewhere
+                if jobid not in self.pendingBackgroundJobs and (self.workerPool is None or
+                                                                jobid not in self.workerPool.jobWorkers):
+                    continue
+                self._outstandingJobs[jobid] = len(data)
+            self._outstanding += len(data)
+            out.append(data)
+        if out:
+            self.writeData(''.join(out))
+
+    def _nextCommand(self):
+        if self.laneWeights is None:
+            for lane in self.lanes:
+                if lane:
+                    return lane.popleft()
+            return None
+        for attempt in (0, 1):
+            for i, lane in enumerate(self.lanes):
+                if lane and self._laneCredits[i] > 0:
+                    self._laneCredits[i] -= 1
+                    return lane.popleft()
+            if not any(self.lanes):
+                return None
+            #every lane with commands used its share, start a new round
+            self._laneCredits = list(self.laneWeights)
+        return None
+
+    def _releaseOutstanding(self, size):
+        if size:
+            self._outstanding -= size
+            self.drainLanes()
+
+    def sendData(self, cmd, args='', timeout=None):
+        """Send a command line to FreeSWITCH
+
+        cmd -- (str) command
+        args -- (str) command arguments
+        timeout -- (int/float) seconds to wait for the reply, defaults to self.commandTimeout
+
+        returns deferred fired with the reply, or failed with CommandTimeout
+        """
+        df = self._newJob(timeout)
         if args:
-            cmd = ' '.join([cmd, args])           
-        self.sendLine(cmd)
+            cmd = ' '.join([cmd, args])
+        self._queueCommands([(cmd+self.delimiter, df, None)])
         log.debug("Line Out: %r"%cmd)
         return df
         
-    def sendMsg(self, msg):
+    def sendMsg(self, msg, timeout=None):
         """Send message to FreeSWITCH
-        
-        msg -- (event) Event object 
-        
+
+        msg -- (event) Event object or an already serialized message
+        timeout -- (int/float) seconds to wait for the reply, defaults to self.commandTimeout
         """
-        df = defer.Deferred()        
-        self.pendingJobs.append(df)
-        msg = msg.as_string(True)
-        self.transport.write(msg)
+        df = self._newJob(timeout)
+        if isinstance(msg, Event):
+            msg = msg.as_string(True)
+        self._queueCommands([(msg, df, None)])
         log.debug("Line Out: %r"%msg)
         return df
         
-    def sendCommand(self, cmd, args='', uuid='', lock=True):
-        msg = Event()
-        if uuid:
-            msg.set_unixfrom("SendMsg %s"%uuid)
-        else:
-            msg.set_unixfrom("SendMsg")
-        msg['call-command'] = "execute"
-        msg['execute-app-name'] = cmd
-        if args:            
-            msg['execute-app-arg'] = args
-        if lock:
-            msg['event-lock'] = "true"        
-        return self.sendMsg(msg)        
-        
-    def sendAPI(self, apicmd, background=jobType):
-        if background:            
-            return self.sendBGAPI(apicmd)
-        else:
-            return self.sendData("api", apicmd)
+    def sendCommand(self, cmd, args='', uuid='', lock=True, eventUUID='', timeout=None):
+        """Execute a dialplan application on a channel using sendmsg
+
+        cmd -- (str) application name
+        args -- (str) application arguments
+        uuid -- (str) uuid of the target channel
+        lock -- (bool) lock the channel until execution is finished
+        eventUUID -- (str) id reported back as Application-UUID in the CHANNEL_EXECUTE events of this execution
+        timeout -- (int/float) seconds to wait for the reply, defaults to self.commandTimeout
+        """
+        return self.sendMsg(executeMessage(cmd, args, uuid, lock, eventUUID), timeout)
+
+    def executeSync(self, app, args='', uuid='', lock=True, timeout=None, sender=None):
+        """Execute a dialplan application and wait for it to finish
+
+        The sendmsg carries a new Event-UUID which FreeSWITCH reports back as Application-UUID,
+        so only the CHANNEL_EXECUTE_COMPLETE of this very execution fires the result
+
+        app -- (str) application name
+        args -- (str) application arguments
+        uuid -- (str) uuid of the target channel
+        lock -- (bool) lock the channel until execution is finished
+        timeout -- (int/float) seconds to wait for completion before failing with CommandTimeout
+        sender -- (FSProtocol) connection the sendmsg is written on, defaults to this one
+
+        returns deferred fired with the CHANNEL_EXECUTE_COMPLETE event, cancel it to stop waiting
+        """
+        appUUID = _newUUID()
+        finalDF = defer.Deferred(self._executeSyncDone)
+        finalDF.timer = None
+        finalDF.ecb = self.registerHeaderEvent("CHANNEL_EXECUTE_COMPLETE", "Application-UUID", appUUID, True,
+                                               self._executeSyncComplete, finalDF)
+        if timeout:
+            finalDF.timer = reactor.callLater(timeout, self._executeSyncTimeout, finalDF, app)
+        df = (sender or self).sendCommand(app, args, uuid, lock, appUUID)
+        df.addErrback(self._executeSyncFailed, finalDF)
+        return finalDF
+
+    def _executeSyncDone(self, finalDF):
+        """Stop waiting for the completion of an executeSync"""
+        if finalDF.ecb is not None:
+            self.deregisterEvent(finalDF.ecb)
+            finalDF.ecb = None
+        if finalDF.timer is not None and finalDF.timer.active():
+            finalDF.timer.cancel()
+        finalDF.timer = None
+
+    def _executeSyncComplete(self, event, finalDF):
+        self._executeSyncDone(finalDF)
+        finalDF.callback(event)
+
+    def _executeSyncFailed(self, error, finalDF):
+        if not finalDF.called:
+            self._executeSyncDone(finalDF)
+            finalDF.errback(error)
+
+    def _executeSyncTimeout(self, finalDF, app):
+        self._executeSyncDone(finalDF)
+        finalDF.errback(CommandTimeout("%s did not complete in time"%app))
         
-    def sendBGAPI(self, apicmd):
+    def sendAPI(self, apicmd, background=jobType, timeout=None):
+        if background:
+            return self.sendBGAPI(apicmd, timeout)
+        else:
+            return self.sendData("api", apicmd, timeout)
+
+    def sendBGAPI(self, apicmd, timeout=None):
+        """Run an api command in the background
+
+        apicmd -- (str) api command with arguments
+        timeout -- (int/float) seconds to wait for the BACKGROUND_JOB event, defaults to self.backgroundJobTimeout
+
+        returns deferred fired with the BACKGROUND_JOB event, or failed with CommandTimeout
+        """
+        apicmd, backgroundJobDeferred, jobid = self._prepareBGAPI(apicmd, timeout)
+        log.debug("Line Out: %r", apicmd)
+        self._queueCommands([(apicmd+self.delimiter, None, jobid)])
+        return backgroundJobDeferred
+
+    def _prepareBGAPI(self, apicmd, timeout):
+        """Build the bgapi command line for apicmd and register the deferred waiting for its BACKGROUND_JOB
+
+        returns (command line, deferred, Job-UUID)
+        """
         jobid = str(uuid.uuid1())
         apicmd = ' '.join(['bgapi', apicmd])
-        apicmd = '\n'.join([apicmd, "Job-UUID:%s"%jobid])                
-        
-        backgroundJobDeferred = defer.Deferred()
+        apicmd = '\n'.join([apicmd, "Job-UUID:%s"%jobid])
+
+        if timeout is None:
+            timeout = self.backgroundJobTimeout
+        forget = lambda df: self.pendingBackgroundJobs.pop(jobid, None)
+        #0 rather than None so a missing backgroundJobTimeout does not fall back to commandTimeout
+        backgroundJobDeferred = self._newJob(timeout or 0, forget, forget)
         self.pendingBackgroundJobs[jobid] = backgroundJobDeferred
-        
-        log.debug("Line Out: %r", apicmd)
-        self.sendLine(apicmd)
-        return backgroundJobDeferred
-    
-    def subscribeEvents(self, events):
+        if self.autoFilter and ('Event-Name', 'BACKGROUND_JOB') not in self.eventFilters:
+            self.addFilter('Event-Name', 'BACKGROUND_JOB')
+        return apicmd, backgroundJobDeferred, jobid
+
+    def sendBatch(self, lines, timeout=None):
+        """Send several command lines to FreeSWITCH in a single write
+
+        lines -- (list) command lines eg: ["api status", "event plain ALL"]
+        timeout -- (int/float) seconds to wait for each reply, defaults to self.commandTimeout
+
+        returns list of deferreds fired with the replies, in the order of lines
+        """
+        commands = [(line+self.delimiter, self._newJob(timeout), None) for line in lines]
+        if commands:
+            self._queueCommands(commands)
+            log.debug("Line Out: %r"%lines)
+        return [command[1] for command in commands]
+
+    def sendAPIBatch(self, apicmds, background=jobType, timeout=None):
+        """Run several api commands, writing all of them to FreeSWITCH at once
+
+        apicmds -- (list) api commands with arguments eg: ["uuid_kill <uuid>", "uuid_exists <uuid>"]
+        background -- (bool) run the commands with bgapi
+        timeout -- (int/float) seconds to wait for each result
+
+        returns DeferredList fired with a list of (success, result) tuples in the order of apicmds
+        """
+        if background:
+            commands = []
+            dfs = []
+            for apicmd in apicmds:
+                line, df, jobid = self._prepareBGAPI(apicmd, timeout)
+                commands.append((line+self.delimiter, None, jobid))
+                dfs.append(df)
+            if commands:
+                self._queueCommands(commands)
+                log.debug("Line Out: %r"%apicmds)
+        else:
+            dfs = self.sendBatch(['api %s'%apicmd for apicmd in apicmds], timeout)
+        return defer.DeferredList(dfs, consumeErrors=True)
+
+    def subscribeEvents(self, events, format=None):
         """Subscribe to FreeSWITCH events.
-        
+
         events -(str) 'all'  subscribe to all events or event names separated by space
         this method can subscribe to multiple events but if the event is of CUSTOM type
         then only one CUSTOM event with subclass should be given
+        format -- (str) plain or json, defaults to self.eventFormat
         """
-        _events = []
-        if not events.startswith("CUSTOM"):
-            _events = events.split(' ')
-        for event in _events:
+        if events.startswith("CUSTOM"):
             self.subscribedEvents.append(events)
-        
-        return self.sendData("event plain", events)
-        
+        else:
+            self.subscribedEvents.extend(events.split(' '))
+        line = "event %s %s"%(format or self.eventFormat, events)
+        if line not in self.subscriptions:
+            self.subscriptions.append(line)
+        return self.sendData(line)
+        
+    def subscriptionCommands(self):
+        """Return the command lines restoring the event subscriptions and filters of this connection on a new one"""
+        return self.subscriptions + ["filter %s %s"%key for key in self.eventFilters]
+
+    def addFilter(self, header, value):
+        """Ask FreeSWITCH to only send events with the given header value.
+
+        Once a filter is installed only events matching at least one of the filters are sent.
+        Filters are reference counted, the filter command is only sent for the first user of a header/value pair
+
+        header -- (str) header name eg: Event-Name, Unique-ID
+        value -- (str) value the header should have
+
+        returns deferred fired with the command reply
+        """
+        key = (header, value)
+        count = self.eventFilters.get(key, 0)
+        self.eventFilters[key] = count + 1
+        if count:
+            return defer.succeed(None)
+        return self.sendData("filter", "%s %s"%key)
+
+    def _addEventFilter(self, ecb):
+        """Install the Event-Name or Event-Subclass filter letting the events of ecb through, for autoFilter"""
+        event = ecb.eventname
+        if event.upper() == 'ALL':
+            return
+        if event.startswith("CUSTOM"):
+            ecb.filter = ('Event-Subclass', event.split(' ')[1])
+        else:
+            ecb.filter = ('Event-Name', event)
+        self.addFilter(*ecb.filter)
+
+    def removeFilter(self, header, value):
+        """Release a filter added with addFilter, the filter is deleted on FreeSWITCH when its last user releases it
+
+        header -- (str) header name
+        value -- (str) value of the header
+
+        returns deferred fired with the command reply
+        """
+        key = (header, value)
+        count = self.eventFilters.get(key, 0)
+        if count > 1:
+            self.eventFilters[key] = count - 1
+            return defer.succeed(None)
+        if not count:
+            log.error("Filter %s %s is not installed"%key)
+            return defer.succeed(None)
+        del self.eventFilters[key]
+        return self.sendData("filter delete", "%s %s"%key)
+
     def myevents(self, uuid=''):
         """Tie up the connection to particular channel events"""
-        self.subscribedEvents.append("myevents")        
+        self.subscribedEvents.append("myevents")
         if uuid:
-            return self.sendData("myevents %s"%uuid)
+            line = "myevents %s"%uuid
         else:
-            return self.sendData("myevents")
+            line = "myevents"
+        if line not in self.subscriptions:
+            self.subscriptions.append(line)
+        return self.sendData(line)
             
     def apiAvmd(self, uuid, start=True, background=jobType):
         """Execute avmd on provided channel. 
@@ -879,25 +2027,18 @@ class FSProtocol(basic.LineReceiver):
         self.set("playback_terminators", terminators or "none", uuid, lock)
         return self.sendCommand("playback", path, uuid, lock)
         
-    def playbackSync(self, *args, **kwargs):
-        finalDF = defer.Deferred()
-        df = self.playback(*args, **kwargs)
-        df.addCallback(self.playbackSyncSuccess, finalDF)
-        df.addErrback(self.playbackSyncFailed, finalDF)        
-        return finalDF
-        
-    def playbackSyncSuccess(self, result, finalDF):
-        ecb = self.registerEvent("CHANNEL_EXECUTE_COMPLETE", True, self.playbackSyncComplete, finalDF)
-        finalDF.ecb = ecb
-        
-    def playbackSyncFailed(self, error, finalDF):
-        finalDF.errback(error)
-        
-    def playbackSyncComplete(self, event, finalDF):
-        if event['Application'] == 'playback':
-            self.deregisterEvent(finalDF.ecb)
-            finalDF.callback(event)
-        
+    def playbackSync(self, path, terminators=None, uuid='', lock=True, timeout=None, sender=None):
+        """Playback given file name on channel and wait for the playback to finish
+
+        path -- (str) path of the file to be played
+        timeout -- (int/float) seconds to wait for the playback to finish
+        sender -- (FSProtocol) connection the commands are written on, see executeSync
+
+        returns deferred fired with the CHANNEL_EXECUTE_COMPLETE event of the playback
+        """
+        (sender or self).set("playback_terminators", terminators or "none", uuid, lock)
+        return self.executeSync("playback", path, uuid, lock, timeout, sender)
+
     def say(self, module='en', say_type='NUMBER', say_method="PRONOUNCED", text='', uuid='', lock=True):
         arglist = [module, say_type, say_method, text]
         arglist = map(str, arglist)
@@ -913,7 +2054,7 @@ class FSProtocol(basic.LineReceiver):
         args = '='.join([variable, value])
         return self.sendCommand("set", args, uuid, lock)
         
-    def playAndGetDigits(self, min, max, tries=3, timeout=4000,  terminators='#', filename='', invalidfile='', varname='', regexp='\d', uuid='', lock=True):
+    def playAndGetDigits(self, min, max, tries=3, timeout=4000,  terminators='#', filename='', invalidfile='', varname='', regexp='\d', uuid='', lock=True, sender=None):
         """Play the given sound file and get back caller's DTMF
         min -- (int) minimum digits length
         max -- (int) maximum digits length
@@ -922,9 +2063,10 @@ class FSProtocol(basic.LineReceiver):
         filename -- (str) name of the audio file to be played 
         varname -- (str) DTMF digit value will be set as value to the variable of this name
         regexp -- (str) regurlar expression to match the DTMF 
-        uuid -- (str) uuid of the target channel 
-        
-        Make sure CHANNEL_EXECUTE_COMPLETE  event is subcribed otherwise finalDF will never get invoked
+        uuid -- (str) uuid of the target channel
+        sender -- (FSProtocol) connection the command is written on, see executeSync
+
+        returns deferred fired with the collected digits or None
         """
         arglist = [min, max, tries, timeout, terminators, filename, invalidfile, varname, regexp]
         arglist = map(str, arglist)
@@ -932,29 +2074,15 @@ class FSProtocol(basic.LineReceiver):
         #arglist = map(repr, arglist)
         data = ' '.join(arglist)
         
-        finalDF = defer.Deferred()        
-        df = self.sendCommand("play_and_get_digits", data, uuid, lock)
-        df.addCallback(self._playAndGetDigitsSuccess, finalDF, varname)
-        df.addErrback(self._playAndGetDigitsFailure, finalDF)
-        return finalDF
-        
-    def _playAndGetDigitsSuccess(self, msg, finalDF, varname):
-        """Successfully executed playAndGetDigits. Register a callback to catch DTMF"""
+        df = self.executeSync("play_and_get_digits", data, uuid, lock, sender=sender)
+        df.addCallback(self._checkPlaybackResult, varname)
+        return df
 
-        ecb = self.registerEvent("CHANNEL_EXECUTE_COMPLETE", True, self._checkPlaybackResult, finalDF, varname)        
-        finalDF.ecb = ecb
-        
-    def _playAndGetDigitsFailure(self, error, finalDF):
-        """Failed to execute playAndGetDigits, invoke finalDF errback"""
-        finalDF.errback(error)
-        
-    def _checkPlaybackResult(self, event, finalDF, varname):        
-        if event['Application'] == "play_and_get_digits":
-            self.deregisterEvent(finalDF.ecb)
-            if event.has_key("variable_"+varname):
-                finalDF.callback(event['variable_'+varname])                
-            else:
-                finalDF.callback(None)
+    def _checkPlaybackResult(self, event, varname):
+        """Return the digits collected by play_and_get_digits from its CHANNEL_EXECUTE_COMPLETE event"""
+        if event.has_key("variable_"+varname):
+            return event['variable_'+varname]
+        return None
 
     def schedHangup(self, secs, uuid='', lock=True):
         """Schedule hangup 
@@ -24,29 +24,226 @@ class InboundProtocol(FSProtocol):
     def authSuccess(self, msg):
         """Override this for when authentication is sueccessful"""
         log.info("Successfully authenticated")
-        if hasattr(self.factory, "loginDeferred"):
+        if hasattr(self.factory, "loginDeferred") and not self.factory.loginDeferred.called:
             self.factory.loginDeferred.callback(self)
         
     def authFailed(self, error):
         """Override this for when authentication failed"""
         log.error("Login failed")
         log.error(error)
-        if hasattr(self.factory, "loginDeferred"):
+        if hasattr(self.factory, "loginDeferred") and not self.factory.loginDeferred.called:
             self.factory.loginDeferred.errback(error)
         
 
 class InboundFactory(protocol.ClientFactory):
     """A factory for InboundSocketProtocol
+
+    password -- (str) EventSocket password
+    eventFormat -- (str) plain or json, format used by subscribeEvents on the protocols built
     """
-    protocol = InboundProtocol    
-    def __init__(self, password):
+    protocol = InboundProtocol
+    def __init__(self, password, eventFormat="plain"):
         self.password = password
+        self.eventFormat = eventFormat
         self.loginDeferred = defer.Deferred()
+
+    def buildProtocol(self, addr):
+        p = protocol.ClientFactory.buildProtocol(self, addr)
+        p.eventFormat = self.eventFormat
+        return p
     
-    def clientConnetionFailed(self, connector, reason):
+    def clientConnectionFailed(self, connector, reason):
         log.info("Failed to connect to FreeSWITCH")
-        
-    
+
+
+class ReconnectingInboundProtocol(InboundProtocol):
+    """Inbound connection of a ReconnectingInboundFactory.
+
+    Takes over the settings, event callbacks, subscriptions and filters of the previous connection of
+    the factory and replays the subscriptions and filters in a single write once authenticated
+    """
+    #attributes set on a connection that its replacement keeps
+    settings = ('autoFilter', 'commandTimeout', 'backgroundJobTimeout', 'coalesceWrites', 'coalesceLimit',
+                'compactSize', 'useLanes', 'highWater', 'lowWater', 'backlogPollInterval', 'shedLag',
+                'lagProbeInterval', 'eventPriorities', 'coalesceEvents', 'laneWeights', 'maxOutstanding',
+                'laneCommands')
+
+    def connectionMade(self):
+        previous = self.factory.lastProtocol
+        if previous is not None:
+            #before connectionMade, which validates laneWeights and starts the lag probe of shedLag
+            for name in self.settings:
+                if name in previous.__dict__:
+                    setattr(self, name, previous.__dict__[name])
+        InboundProtocol.connectionMade(self)
+        if previous is not None:
+            self.eventCallbacks = previous.eventCallbacks
+            self.customEventCallbacks = previous.customEventCallbacks
+            self.headerEventCallbacks = previous.headerEventCallbacks
+            self.prefixEventCallbacks = previous.prefixEventCallbacks
+            self.subscribedEvents = previous.subscribedEvents
+            self.subscriptions = previous.subscriptions
+            self.eventFilters = previous.eventFilters
+            self.executors = previous.executors
+            if previous.workerPool is not None:
+                previous.workerPool.attach(self)
+        self.factory.lastProtocol = self
+
+    def authSuccess(self, msg):
+        self.factory.resetDelay()
+        lines = self.subscriptionCommands()
+        if lines:
+            log.info("Restoring %s subscriptions and filters", len(lines))
+            for df in self.sendBatch(lines):
+                df.addErrback(self.replayFailed)
+        InboundProtocol.authSuccess(self, msg)
+
+    def replayFailed(self, error):
+        log.error("Failed to restore a subscription: %s", error.getErrorMessage())
+
+
+class ReconnectingInboundFactory(InboundFactory, protocol.ReconnectingClientFactory):
+    """InboundFactory reconnecting to FreeSWITCH with jittered exponential backoff
+
+    Settings such as commandTimeout or highWater, event callbacks, subscriptions and filters survive
+    reconnections, see ReconnectingInboundProtocol.settings. Commands waiting for a reply
+    when the connection is lost fail with Disconnected. loginDeferred fires on the first login only,
+    the current connection is self.lastProtocol: commands sent on a previous protocol fail at once
+    with Disconnected. Call stopTrying to stop reconnecting.
+    """
+    protocol = ReconnectingInboundProtocol
+    maxDelay = 30 #seconds between attempts at most
+
+    def __init__(self, password, eventFormat="plain"):
+        InboundFactory.__init__(self, password, eventFormat)
+        self.lastProtocol = None
+
+    def clientConnectionFailed(self, connector, reason):
+        log.info("Failed to connect to FreeSWITCH: %s", reason.getErrorMessage())
+        protocol.ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
+
+    def clientConnectionLost(self, connector, reason):
+        log.info("Lost connection to FreeSWITCH: %s", reason.getErrorMessage())
+        protocol.ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
+
+
+class SplitInboundClient(object):
+    """Two inbound connections to one FreeSWITCH used as a single protocol.
+
+    Event callbacks, subscriptions and filters live on the event connection, every other method
+    runs on the command connection, which only subscribes BACKGROUND_JOB so bgapi results reach
+    its deferreds. A backlog of events therefore never delays the reply to a command.
+    executeSync, playbackSync and playAndGetDigits send on the command connection and wait for
+    CHANNEL_EXECUTE_COMPLETE on the event connection.
+
+    Both connections reconnect on their own, see ReconnectingInboundFactory.
+    """
+    factory = ReconnectingInboundFactory
+
+    def __init__(self, password, eventFormat="plain"):
+        """
+        password -- (str) EventSocket password
+        eventFormat -- (str) plain or json
+        """
+        self.eventFactory = self.factory(password, eventFormat)
+        self.commandFactory = self.factory(password, eventFormat)
+        self.commandFactory.loginDeferred.addCallback(self._commandLogin)
+
+    def connect(self, host, port=8021):
+        """Open both connections
+
+        returns deferred fired with this client once both are authenticated
+        """
+        reactor.connectTCP(host, port, self.eventFactory)
+        reactor.connectTCP(host, port, self.commandFactory)
+        df = defer.DeferredList([self.eventFactory.loginDeferred, self.commandFactory.loginDeferred],
+                                fireOnOneErrback=True, consumeErrors=True)
+        df.addCallbacks(lambda result: self, lambda error: error.value.subFailure)
+        return df
+
+    def disconnect(self):
+        """Close both connections and stop reconnecting"""
+        for factory in (self.eventFactory, self.commandFactory):
+            factory.stopTrying()
+            if factory.lastProtocol is not None and factory.lastProtocol.transport is not None:
+                factory.lastProtocol.transport.loseConnection()
+
+    def _commandLogin(self, protocol):
+        #recorded as a subscription, so it is restored on reconnection
+        protocol.subscribeEvents("BACKGROUND_JOB")
+        return protocol
+
+    @property
+    def eventProtocol(self):
+        return self.eventFactory.lastProtocol
+
+    @property
+    def commandProtocol(self):
+        return self.commandFactory.lastProtocol
+
+    def _connected(self, protocol):
+        if protocol is None:
+            raise Disconnected("Not connected to FreeSWITCH")
+        return protocol
+
+    #event callbacks, subscriptions and filters, on the event connection
+    def registerEvent(self, event, subscribe, function, *args, **kwargs):
+        return self._connected(self.eventProtocol).registerEvent(event, subscribe, function, *args, **kwargs)
+
+    def registerHeaderEvent(self, event, header, value, subscribe, function, *args, **kwargs):
+        return self._connected(self.eventProtocol).registerHeaderEvent(event, header, value, subscribe, function,
+                                                                       *args, **kwargs)
+
+    def registerPredicateEvent(self, event, predicates, subscribe, function, *args, **kwargs):
+        return self._connected(self.eventProtocol).registerPredicateEvent(event, predicates, subscribe, function,
+                                                                          *args, **kwargs)
+
+    def registerChannelEvent(self, event, uuid, subscribe, function, *args, **kwargs):
+        return self._connected(self.eventProtocol).registerChannelEvent(event, uuid, subscribe, function,
+                                                                        *args, **kwargs)
+
+    def deregisterEvent(self, ecb):
+        return self._connected(self.eventProtocol).deregisterEvent(ecb)
+
+    def needToSubscribe(self, event):
+        return self._connected(self.eventProtocol).needToSubscribe(event)
+
+    def subscribeEvents(self, events, format=None):
+        return self._connected(self.eventProtocol).subscribeEvents(events, format)
+
+    def addFilter(self, header, value):
+        return self._connected(self.eventProtocol).addFilter(header, value)
+
+    def removeFilter(self, header, value):
+        return self._connected(self.eventProtocol).removeFilter(header, value)
+
+    def myevents(self, uuid=''):
+        return self._connected(self.eventProtocol).myevents(uuid)
+
+    #sent on the command connection, completed by CHANNEL_EXECUTE_COMPLETE on the event connection
+    def executeSync(self, app, args='', uuid='', lock=True, timeout=None):
+        return self._connected(self.eventProtocol).executeSync(app, args, uuid, lock, timeout,
+                                                               self._connected(self.commandProtocol))
+
+    def playbackSync(self, path, terminators=None, uuid='', lock=True, timeout=None):
+        return self._connected(self.eventProtocol).playbackSync(path, terminators, uuid, lock, timeout,
+                                                                self._connected(self.commandProtocol))
+
+    def playAndGetDigits(self, min, max, tries=3, timeout=4000, terminators='#', filename='', invalidfile='',
+                         varname='', regexp='\d', uuid='', lock=True):
+        return self._connected(self.eventProtocol).playAndGetDigits(min, max, tries, timeout, terminators, filename,
+                                                                    invalidfile, varname, regexp, uuid, lock,
+                                                                    self._connected(self.commandProtocol))
+
+    def __getattr__(self, name):
+        #every other method is a command, run on the command connection
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if self.commandProtocol is None:
+            raise AttributeError("%s is not available before connecting"%name)
+        return getattr(self.commandProtocol, name)
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
     f = InboundFactory("ClueCon")
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+
+import threading
+import time
+import zlib
+import Queue
+
+from fsprotocol import *
+
+log = logging.getLogger("Offload")
+
+
+class ThreadExecutor(object):
+    """Run event handlers in threads so blocking handlers do not stall the reactor.
+
+    Pass it to registerEvent or registerHeaderEvent as executor=ThreadExecutor(...). Each thread
+    has its own queue and events are sharded by Unique-ID, so the handlers of a channel run in
+    order. When the queue of a thread is full, policy decides what happens:
+        drop -- the event is dropped for this handler and counted
+        block -- the event waits in the reactor thread for room in the queue and the protocols
+                 dispatching to this executor stop reading from FreeSWITCH until it is queued
+
+    The reactor thread never waits for the handlers, so handlers may use
+    twisted.internet.threads.blockingCallFromThread or reactor.callFromThread to send commands.
+    """
+    retryInterval = 0.01 #seconds between attempts to queue the events waiting for room with policy block
+
+    def __init__(self, threads=4, maxQueue=1000, policy='drop'):
+        """
+        threads -- (int) number of threads
+        maxQueue -- (int) events waiting per thread, 0 for no limit
+        policy -- (str) drop or block
+        """
+        self.threads = threads
+        self.maxQueue = maxQueue
+        self.policy = policy
+        self.queues = [Queue.Queue(maxQueue) for i in range(threads)]
+        self.waiting = [deque() for i in range(threads)] #events with policy block the queue had no room for
+        self.workers = []
+        self.submitted = 0
+        self.dropped = 0
+        self.handled = 0
+        self.totalLatency = 0.0
+        self.maxLatency = 0.0
+        self.totalWait = 0.0
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._retryCall = None
+        self._shutdownTrigger = None
+
+    def start(self):
+        """Start the threads, done on the first submit"""
+        if self.workers:
+            return
+        if self._stopping.is_set():
+            #threads of the previous run finish their own queues
+            self.queues = [Queue.Queue(self.maxQueue) for i in range(self.threads)]
+            self._stopping = threading.Event()
+        for queue in self.queues:
+            worker = threading.Thread(target=self._run, args=(queue, self._stopping))
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+        if self._shutdownTrigger is None:
+            self._shutdownTrigger = reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        """Stop the threads once the queued events are handled, events waiting for room are dropped"""
+        self._stopping.set()
+        if self._retryCall is not None and self._retryCall.active():
+            self._retryCall.cancel()
+        self._retryCall = None
+        for waiting in self.waiting:
+            self.dropped += len(waiting)
+            waiting.clear()
+        for queue in self.queues:
+            #a thread with a full queue sees the stop flag once it has emptied it
+            try:
+                queue.put_nowait(None)
+            except Queue.Full:
+                pass
+        self.workers = []
+
+    def submit(self, event, ecb):
+        """Queue a call of ecb for event on the thread owning the channel of event
+
+        returns True if queued or waiting for room, False if dropped
+        """
+        if not self.workers:
+            self.start()
+        key = event['Unique-ID'] or event['Event-Name'] or ''
+        index = (zlib.crc32(key) & 0xffffffff) % self.threads
+        item = (event, ecb, time.time())
+        self.submitted += 1
+        waiting = self.waiting[index]
+        if waiting:
+            #behind the events of the channel already waiting
+            waiting.append(item)
+            return True
+        try:
+            self.queues[index].put_nowait(item)
+        except Queue.Full:
+            if self.policy != 'block':
+                self.dropped += 1
+                return False
+            waiting.append(item)
+            if self._retryCall is None:
+                self._retryCall = reactor.callLater(self.retryInterval, self._queueWaiting)
+        return True
+
+    def _queueWaiting(self):
+        """Move the events waiting for room to the queues of their threads"""
+        self._retryCall = None
+        for queue, waiting in zip(self.queues, self.waiting):
+            while waiting:
+                try:
+                    queue.put_nowait(waiting[0])
+                except Queue.Full:
+                    break
+                waiting.popleft()
+        if self.overflowing():
+            self._retryCall = reactor.callLater(self.retryInterval, self._queueWaiting)
+
+    def overflowing(self):
+        """Return True if events are waiting in the reactor thread for room in the queues"""
+        for waiting in self.waiting:
+            if waiting:
+                return True
+        return False
+
+    def backlog(self):
+        """Return the number of events waiting in the queues and for room in them"""
+        return sum([queue.qsize() for queue in self.queues]) + sum([len(waiting) for waiting in self.waiting])
+
+    def stats(self):
+        """Return queue depths, counters and handler latency in seconds"""
+        with self._lock:
+            handled = self.handled
+            totalLatency = self.totalLatency
+            totalWait = self.totalWait
+            maxLatency = self.maxLatency
+        if handled:
+            averageLatency = totalLatency/handled
+            averageWait = totalWait/handled
+        else:
+            averageLatency = averageWait = 0.0
+        return {'queued':[queue.qsize() for queue in self.queues], 'waiting':[len(waiting) for waiting in self.waiting],
+                'submitted':self.submitted, 'dropped':self.dropped, 'handled':handled,
+                'averageLatency':averageLatency, 'maxLatency':maxLatency, 'averageWait':averageWait}
+
+    def _run(self, queue, stopping):
+        while True:
+            if stopping.is_set() and queue.empty():
+                return
+            item = queue.get()
+            if item is None:
+                return
+            event, ecb, queuedAt = item
+            started = time.time()
+            try:
+                ecb.func(event, *ecb.args, **ecb.kwargs)
+            except:
+                log.error("Error in event handler %s on event %s:"%(ecb.func, event['Event-Name']), exc_info=True)
+            finished = time.time()
+            latency = finished - started
+            with self._lock:
+                self.handled += 1
+                self.totalLatency += latency
+                self.totalWait += started - queuedAt
+                if latency > self.maxLatency:
+                    self.maxLatency = latency
@@ -0,0 +1,322 @@
+#!/usr/bin/python
+
+from twisted.python import failure
+
+from fsprotocol import *
+
+log = logging.getLogger("Originate")
+
+
+class QueueFull(CommandError):
+    """The originate queue is full"""
+    pass
+
+
+class OriginateScheduler:
+    """Rate limited originate queue in front of an FSProtocol.
+
+    Calls are released at no more than rate calls per second using a token bucket, with at most
+    maxInFlight of them waiting for their result. Requests beyond that wait in a queue of at most
+    maxQueue entries, overflow decides what happens when it is full:
+        reject -- the new request fails with QueueFull
+        dropOldest -- the oldest queued request fails with QueueFull and the new one is queued
+
+    The scheduler has the same apiOriginate and sendBGAPI methods as the protocol, so it can be
+    used wherever the protocol is used to originate calls.
+    """
+    def __init__(self, protocol, rate, burst=None, maxInFlight=None, maxQueue=None, overflow='reject'):
+        """
+        protocol -- (FSProtocol) connected protocol to originate calls on
+        rate -- (int/float) calls per second, eg: sessions-per-second of the switch
+        burst -- (int) calls that may be released at once, defaults to rate
+        maxInFlight -- (int) originates waiting for their result at a time, None for no limit
+        maxQueue -- (int) requests waiting for their turn, None for no limit
+        overflow -- (str) reject or dropOldest
+        """
+        self.protocol = protocol
+        self.rate = float(rate)
+        self.burst = burst or max(1, rate)
+        self.maxInFlight = maxInFlight
+        self.maxQueue = maxQueue
+        self.overflow = overflow
+        self.tokens = float(self.burst)
+        self.lastRefill = reactor.seconds()
+        self.queue = deque() #(deferred, method name, args, kwargs, time queued)
+        self.inFlight = 0
+        self.sent = 0
+        self.dropped = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+        self._drainCall = None
+        self._draining = False
+
+    def apiOriginate(self, *args, **kwargs):
+        """Queue an originate, takes the same arguments as FSProtocol.apiOriginate
+
+        returns deferred fired with the originate result, or failed with QueueFull
+        """
+        return self._enqueue('apiOriginate', args, kwargs)
+
+    def sendBGAPI(self, *args, **kwargs):
+        """Queue a bgapi command, takes the same arguments as FSProtocol.sendBGAPI"""
+        return self._enqueue('sendBGAPI', args, kwargs)
+
+    def stats(self):
+        """Return queue length, calls in flight, calls sent and dropped and queue wait times in seconds"""
+        if self.sent:
+            averageWait = self.totalWait/self.sent
+        else:
+            averageWait = 0.0
+        return {'queued':len(self.queue), 'inFlight':self.inFlight, 'sent':self.sent, 'dropped':self.dropped,
+                'averageWait':averageWait, 'maxWait':self.maxWait}
+
+    def _enqueue(self, method, args, kwargs):
+        if self.maxQueue is not None and len(self.queue) >= self.maxQueue:
+            self.dropped += 1
+            if self.overflow != 'dropOldest' or not self.queue:
+                return defer.fail(QueueFull("Originate queue is full"))
+            oldest = self.queue.popleft()
+            oldest[0].errback(QueueFull("Dropped from full originate queue"))
+        df = defer.Deferred(self._cancel)
+        df.released = None #deferred of the protocol call once released
+        self.queue.append((df, method, args, kwargs, reactor.seconds()))
+        self._drain()
+        return df
+
+    def _cancel(self, df):
+        """Drop a queued request
+
+        A released request fails with CancelledError but keeps its in flight slot: the originate runs on
+        FreeSWITCH whatever happens here, so the slot is only freed once its result arrives and is discarded
+        """
+        if df.released is not None:
+            return
+        for entry in self.queue:
+            if entry[0] is df:
+                self.queue.remove(entry)
+                break
+
+    def _refill(self, now):
+        self.tokens = min(float(self.burst), self.tokens + (now - self.lastRefill)*self.rate)
+        self.lastRefill = now
+
+    def _drain(self):
+        """Release queued requests while tokens and in flight slots are available"""
+        if self._draining:
+            return
+        self._draining = True
+        try:
+            while self.queue:
+                if self.maxInFlight is not None and self.inFlight >= self.maxInFlight:
+                    return
+                now = reactor.seconds()
+                self._refill(now)
+                if self.tokens < 1:
+                    if self._drainCall is None:
+                        self._drainCall = reactor.callLater((1 - self.tokens)/self.rate, self._drainLater)
+                    return
+                self.tokens -= 1
+                df, method, args, kwargs, queuedAt = self.queue.popleft()
+                wait = now - queuedAt
+                self.totalWait += wait
+                self.maxWait = max(self.maxWait, wait)
+                self.sent += 1
+                self.inFlight += 1
+                try:
+                    result = getattr(self.protocol, method)(*args, **kwargs)
+                except:
+                    result = defer.fail()
+                df.released = result
+                result.addBoth(self._done)
+                result.addBoth(self._forward, df)
+        finally:
+            self._draining = False
+
+    def _drainLater(self):
+        self._drainCall = None
+        self._drain()
+
+    def _done(self, result):
+        self.inFlight -= 1
+        self._drain()
+        return result
+
+    def _forward(self, result, df):
+        if df.called:
+            #cancelled while released, the failure of the cancelled call ends here
+            return None
+        if isinstance(result, failure.Failure):
+            df.errback(result)
+        else:
+            df.callback(result)
+
+
+class CampaignResult(object):
+    """Outcome of one campaign call
+
+    destination -- destination as given to the campaign
+    originationUUID -- (str) uuid the channel was created with
+    jobUUID -- (str) Job-UUID of the bgapi originate, None if it was never run
+    success -- (bool) True if the originate succeeded
+    reply -- (str) originate reply eg: "+OK <uuid>" or "-ERR NO_ANSWER", or the error message
+    """
+    __slots__ = ('destination', 'originationUUID', 'jobUUID', 'success', 'reply')
+
+    def __init__(self, destination, originationUUID, jobUUID, success, reply):
+        self.destination = destination
+        self.originationUUID = originationUUID
+        self.jobUUID = jobUUID
+        self.success = success
+        self.reply = reply
+
+
+class Campaign:
+    """Originate calls to a stream of destinations keeping a fixed number of them in flight.
+
+    Destinations are pulled from the iterable only when a call finishes, so memory use does not depend
+    on the number of destinations, eg: a generator reading millions of rows from a file. Every call
+    gets an origination_uuid and runs with bgapi, its result is reported to onResult as a
+    CampaignResult as soon as the BACKGROUND_JOB arrives.
+
+    When the originator fails a call at once with a CommandError, eg: QueueFull from a full
+    OriginateScheduler or NoConnection from a Cluster without nodes, the destination is kept and
+    placed again after retryDelay seconds instead of pulling the next ones. Any other error raised at
+    once, eg: a TypeError from bad originateArgs, would fail every destination alike: the campaign stops
+    and the deferred returned by start fails with it.
+    """
+    retryDelay = 1 #seconds to wait before placing calls again once the originator refused one
+
+    def __init__(self, originator, destinations, window=10, onResult=None, **originateArgs):
+        """
+        originator -- (FSProtocol or OriginateScheduler) object whose apiOriginate places the calls
+        destinations -- iterable of call urls or of dicts of apiOriginate keyword arguments
+        window -- (int) calls in flight at a time
+        onResult -- function called with a CampaignResult for every destination
+        originateArgs -- apiOriginate keyword arguments used for every call eg: application='park'
+        """
+        self.originator = originator
+        self.destinations = iter(destinations)
+        self.window = window
+        self.onResult = onResult
+        self.originateArgs = originateArgs
+        self.inFlight = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.stopped = False
+        self.exhausted = False
+        self.finished = None
+        self.refused = 0 #calls the originator failed at once and that were placed again later
+        self._filling = False
+        self._retry = None #destination refused by the originator, placed before the next ones
+        self._fillCall = None
+
+    def start(self):
+        """Start placing calls
+
+        returns deferred fired with (succeeded, failed) counts once every destination is done
+        """
+        self.finished = defer.Deferred()
+        self._fill()
+        return self.finished
+
+    def stop(self):
+        """Stop placing new calls, the deferred returned by start fires once the calls in flight are done"""
+        self.stopped = True
+        if self._fillCall is not None and self._fillCall.active():
+            self._fillCall.cancel()
+        self._fillCall = None
+        self._checkFinished()
+
+    def _fill(self):
+        if self._filling or self._fillCall is not None:
+            return
+        self._filling = True
+        try:
+            while not self.stopped and self.inFlight < self.window:
+                if self._retry is not None:
+                    destination, self._retry = self._retry, None
+                elif self.exhausted:
+                    break
+                else:
+                    try:
+                        destination = self.destinations.next()
+                    except StopIteration:
+                        self.exhausted = True
+                        break
+                if not self._originate(destination):
+                    if not self.stopped:
+                        self._fillCall = reactor.callLater(self.retryDelay, self._fillLater)
+                    break
+        finally:
+            self._filling = False
+        self._checkFinished()
+
+    def _fillLater(self):
+        self._fillCall = None
+        self._fill()
+
+    def _checkFinished(self):
+        if (self.stopped or (self.exhausted and self._retry is None)) and not self.inFlight:
+            if self.finished is not None and not self.finished.called:
+                self.finished.callback((self.succeeded, self.failed))
+
+    def _originate(self, destination):
+        """Place the call to destination
+
+        returns False if the originator failed it at once, stopping the campaign unless it failed with a CommandError
+        """
+        kwargs = dict(self.originateArgs)
+        if isinstance(destination, dict):
+            kwargs.update(destination)
+        else:
+            kwargs['url'] = destination
+        channelvars = dict(kwargs.get('channelvars') or {})
+        originationUUID = channelvars.setdefault('origination_uuid', str(uuid.uuid1()))
+        kwargs['channelvars'] = channelvars
+        kwargs['background'] = True
+        self.inFlight += 1
+        try:
+            df = self.originator.apiOriginate(**kwargs)
+        except:
+            df = defer.fail()
+        refused = df.called and isinstance(df.result, failure.Failure)
+        if refused and df.result.check(CommandError):
+            log.warning("Originator refused the call to %s: %s, retrying in %s seconds", destination,
+                        df.result.getErrorMessage(), self.retryDelay)
+            self.inFlight -= 1
+            self.refused += 1
+            self._retry = destination
+            df.addErrback(lambda error: None)
+            return False
+        if refused:
+            error = df.result
+            log.error("Stopping the campaign, the call to %s failed: %s", destination, error.getErrorMessage())
+            self.inFlight -= 1
+            self.stopped = True
+            df.addErrback(lambda error: None)
+            if self.finished is not None and not self.finished.called:
+                self.finished.errback(error)
+            return False
+        df.addCallbacks(self._originated, self._originateFailed,
+                        callbackArgs=(destination, originationUUID), errbackArgs=(destination, originationUUID))
+        return True
+
+    def _originated(self, event, destination, originationUUID):
+        reply = event.get_payload().strip()
+        self._report(CampaignResult(destination, originationUUID, event['Job-UUID'], reply.startswith('+OK'), reply))
+
+    def _originateFailed(self, error, destination, originationUUID):
+        self._report(CampaignResult(destination, originationUUID, None, False, error.getErrorMessage()))
+
+    def _report(self, result):
+        self.inFlight -= 1
+        if result.success:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+        if self.onResult is not None:
+            try:
+                self.onResult(result)
+            except:
+                log.error("Error in campaign result handler", exc_info=True)
+        self._fill()
@@ -0,0 +1,273 @@
+#!/usr/bin/python
+
+import inspect
+
+from twisted.python import failure
+
+from fsprotocol import *
+from inbound import InboundFactory, InboundProtocol
+
+log = logging.getLogger("InboundPool")
+
+
+class NoConnection(CommandError):
+    """None of the pool connections is authenticated"""
+    pass
+
+
+class PoolFactory(InboundFactory):
+    """InboundFactory reporting the state of its connection to a pool member"""
+    def __init__(self, member, password, eventFormat="plain"):
+        InboundFactory.__init__(self, password, eventFormat)
+        self.member = member
+
+    def buildProtocol(self, addr):
+        p = InboundFactory.buildProtocol(self, addr)
+        if self.member.pool.commandTimeout is not None:
+            p.commandTimeout = self.member.pool.commandTimeout
+        return p
+
+    def clientConnectionLost(self, connector, reason):
+        self.member.disconnected(reason)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.member.disconnected(reason)
+
+
+class PoolMember(object):
+    """One connection of an InboundPool and its health
+
+    state -- (str) connecting, ready or down
+    failures -- (int) commands that timed out in a row, reset by the next reply
+    sent -- (int) commands sent on the connection
+    timeouts -- (int) commands that timed out
+    lastError -- (str) reason of the last disconnection
+    """
+    def __init__(self, pool, index, host, port, password):
+        self.pool = pool
+        self.index = index
+        self.host = host
+        self.port = port
+        self.password = password
+        self.protocol = None
+        self.connector = None
+        self.state = 'down'
+        self.failures = 0
+        self.sent = 0
+        self.timeouts = 0
+        self.lastError = None
+        self._retryCall = None
+
+    def connect(self):
+        self._retryCall = None
+        self.state = 'connecting'
+        factory = PoolFactory(self, self.password, self.pool.eventFormat)
+        factory.protocol = self.pool.protocol
+        factory.loginDeferred.addCallbacks(self.authenticated, self.authFailed)
+        self.connector = reactor.connectTCP(self.host, self.port, factory)
+
+    def authenticated(self, protocol):
+        self.protocol = protocol
+        self.state = 'ready'
+        self.failures = 0
+        log.info("Pool connection %s ready", self.index)
+        self.pool.memberReady(self)
+
+    def authFailed(self, error):
+        self.lastError = error.getErrorMessage()
+        log.error("Pool connection %s failed to authenticate: %s", self.index, self.lastError)
+        if self.connector is not None:
+            self.connector.disconnect()
+
+    def disconnected(self, reason):
+        if self.state == 'down':
+            return
+        self.state = 'down'
+        self.protocol = None
+        self.lastError = reason.getErrorMessage()
+        log.warning("Pool connection %s down: %s", self.index, self.lastError)
+        self.pool.memberDown(self)
+        if self.pool.running:
+            self._retryCall = reactor.callLater(self.pool.retryDelay, self.connect)
+
+    def stop(self):
+        if self._retryCall is not None and self._retryCall.active():
+            self._retryCall.cancel()
+        self._retryCall = None
+        self.state = 'down'
+        if self.connector is not None:
+            self.connector.disconnect()
+
+    def healthy(self):
+        return self.state == 'ready' and self.failures < self.pool.maxFailures
+
+    def load(self, now):
+        """Return (number of commands waiting on this connection, seconds the oldest one has been waiting)"""
+        pendingJobs = self.protocol.pendingJobs
+        if pendingJobs:
+            age = now - pendingJobs[0].sentAt
+        else:
+            age = 0
+        return len(pendingJobs) + sum([len(lane) for lane in self.protocol.lanes]), age
+
+    def replied(self, result):
+        if isinstance(result, failure.Failure) and result.check(CommandTimeout):
+            self.failures += 1
+            self.timeouts += 1
+            if self.failures == self.pool.maxFailures:
+                log.warning("Pool connection %s unhealthy after %s timeouts", self.index, self.failures)
+        else:
+            self.failures = 0
+        return result
+
+    def stats(self):
+        stats = {'state':self.state, 'healthy':self.healthy(), 'failures':self.failures, 'sent':self.sent,
+                 'timeouts':self.timeouts, 'lastError':self.lastError}
+        if self.protocol is not None:
+            stats.update(self.protocol.pendingStats())
+        return stats
+
+
+class InboundPool(object):
+    """Several authenticated inbound connections to one FreeSWITCH.
+
+    Replies come back in order on each connection, so a slow api command such as "show channels"
+    delays every reply behind it. The pool sends each api command on the healthy connection with the
+    fewest commands waiting. A connection is unhealthy after maxFailures commands timed out in a
+    row, and is only used again once it replies or when no healthy connection is left. Commands
+    time out after commandTimeout seconds, without it a stuck connection is never found unhealthy.
+    Lost connections are reconnected after retryDelay seconds.
+
+    FreeSWITCH sends every BACKGROUND_JOB to every connection subscribed to it, so bgapi commands all
+    run on one connection, the only one subscribed to BACKGROUND_JOB. Another connection takes over
+    when it is lost or unhealthy.
+
+    The pool has the apiXxx, sendAPI, sendBGAPI and sendAPIBatch methods of InboundProtocol. Events
+    are not spread over the pool, use an InboundFactory connection for them.
+    """
+    protocol = InboundProtocol
+    def __init__(self, host, port, password, size=4, eventFormat="plain", retryDelay=5, maxFailures=3,
+                 backgroundJobs=True, commandTimeout=None):
+        """
+        host -- (str) FreeSWITCH address
+        port -- (int) EventSocket port
+        password -- (str) EventSocket password
+        size -- (int) number of connections
+        eventFormat -- (str) plain or json
+        retryDelay -- (int/float) seconds to wait before reconnecting a lost connection
+        maxFailures -- (int) timeouts in a row after which a connection is no longer used
+        backgroundJobs -- (bool) subscribe BACKGROUND_JOB on the connection running the bgapi commands so
+                          their results are received
+        commandTimeout -- (int/float) seconds to wait for a command reply, sets commandTimeout of the connections
+        """
+        self.host = host
+        self.port = port
+        self.password = password
+        self.eventFormat = eventFormat
+        self.retryDelay = retryDelay
+        self.maxFailures = maxFailures
+        self.backgroundJobs = backgroundJobs
+        self.commandTimeout = commandTimeout
+        self.backgroundMember = None #member running the bgapi commands
+        self.members = [PoolMember(self, i, host, port, password) for i in range(size)]
+        self.running = False
+        self._readyDeferreds = []
+
+    def start(self):
+        """Connect every member of the pool
+
+        returns deferred fired with the pool once a connection is authenticated
+        """
+        self.running = True
+        for member in self.members:
+            member.connect()
+        return self.whenReady()
+
+    def stop(self):
+        """Disconnect every member of the pool"""
+        self.running = False
+        for member in self.members:
+            member.stop()
+
+    def whenReady(self):
+        """Return deferred fired with the pool once a connection is authenticated"""
+        for member in self.members:
+            if member.state == 'ready':
+                return defer.succeed(self)
+        df = defer.Deferred()
+        self._readyDeferreds.append(df)
+        return df
+
+    def memberReady(self, member):
+        readyDeferreds, self._readyDeferreds = self._readyDeferreds, []
+        for df in readyDeferreds:
+            df.callback(self)
+
+    def memberDown(self, member):
+        pass
+
+    def stats(self):
+        """Return a list of per connection stats"""
+        return [member.stats() for member in self.members]
+
+    def pick(self):
+        """Return the member the next command is sent on, None if no connection is ready"""
+        ready = [member for member in self.members if member.state == 'ready']
+        healthy = [member for member in ready if member.failures < self.maxFailures]
+        candidates = healthy or ready
+        if not candidates:
+            return None
+        now = reactor.seconds()
+        #on equal counts prefer the connection whose oldest command is the most recent, it is less likely to be stuck
+        return min(candidates, key=lambda member: (member.load(now), member.sent))
+
+    def pickBackground(self):
+        """Return the member bgapi commands are sent on, subscribing BACKGROUND_JOB on it the first time"""
+        member = self.backgroundMember
+        if member is None or not member.healthy():
+            member = self.pick()
+            if member is None:
+                return None
+            self.backgroundMember = member
+        if member.protocol.needToSubscribe("BACKGROUND_JOB"):
+            member.protocol.subscribeEvents("BACKGROUND_JOB").addErrback(self.subscribeFailed, member)
+        return member
+
+    def subscribeFailed(self, error, member):
+        log.error("Failed to subscribe BACKGROUND_JOB on pool connection %s: %s", member.index,
+                  error.getErrorMessage())
+
+    def _isBackground(self, method, args, kwargs):
+        """Return True if method called with args and kwargs runs a bgapi command"""
+        if method == 'sendBGAPI':
+            return True
+        try:
+            callargs = inspect.getcallargs(getattr(self.protocol, method).im_func, None, *args, **kwargs)
+        except TypeError:
+            return False
+        return bool(callargs.get('background'))
+
+    def call(self, method, *args, **kwargs):
+        """Call method of the least loaded connection, or of the connection running the bgapi commands
+
+        method -- (str) name of the InboundProtocol method eg: apiStatus
+
+        returns deferred fired with the result of method, or failed with NoConnection
+        """
+        if self.backgroundJobs and self._isBackground(method, args, kwargs):
+            member = self.pickBackground()
+        else:
+            member = self.pick()
+        if member is None:
+            return defer.fail(NoConnection("No FreeSWITCH connection available"))
+        member.sent += 1
+        df = getattr(member.protocol, method)(*args, **kwargs)
+        df.addBoth(member.replied)
+        return df
+
+    def __getattr__(self, name):
+        if not (name.startswith('api') or name in ('sendAPI', 'sendBGAPI', 'sendAPIBatch')):
+            raise AttributeError(name)
+        if not callable(getattr(self.protocol, name, None)):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
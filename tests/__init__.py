@@ -0,0 +1,48 @@
+"""Tests of pyswitch, run them from the repository root: python -m unittest discover -s tests -t .
+
+The helpers below build frames the way FreeSWITCH sends them.
+"""
+
+import json
+
+AUTH_REQUEST = "Content-Type: auth/request\n\n"
+
+
+def plainEvent(headers, body=None):
+    """Return a text/event-plain frame
+
+    headers -- (list) (name, value) tuples, values as sent by FreeSWITCH ie URL encoded
+    body -- (str) payload of the event eg: the result of a BACKGROUND_JOB
+    """
+    data = ''.join(["%s: %s\n"%header for header in headers])
+    if body is not None:
+        data = "%sContent-Length: %d\n\n%s"%(data, len(body), body)
+    else:
+        data += "\n"
+    return "Content-Length: %d\nContent-Type: text/event-plain\n\n%s"%(len(data), data)
+
+
+def jsonEvent(headers, body=None):
+    """Return a text/event-json frame of the (name, value) headers"""
+    members = dict(headers)
+    if body is not None:
+        members['_body'] = body
+    data = json.dumps(members)
+    return "Content-Length: %d\nContent-Type: text/event-json\n\n%s"%(len(data), data)
+
+
+def backgroundJob(jobid, body):
+    """Return the BACKGROUND_JOB event of a bgapi"""
+    return plainEvent([("Event-Name", "BACKGROUND_JOB"), ("Job-UUID", jobid)], body)
+
+
+def commandReply(text="+OK", jobid=None):
+    """Return a command/reply, the reply of a bgapi carries its Job-UUID"""
+    if jobid is None:
+        return "Content-Type: command/reply\nReply-Text: %s\n\n"%text
+    return "Content-Type: command/reply\nReply-Text: %s\nJob-UUID: %s\n\n"%(text, jobid)
+
+
+def apiResponse(body):
+    """Return the api/response of an api command"""
+    return "Content-Type: api/response\nContent-Length: %d\n\n%s"%(len(body), body)
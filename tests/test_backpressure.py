@@ -0,0 +1,72 @@
+"""Tests of the read pauses of FSProtocol when event handlers fall behind"""
+
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import task
+
+import fsprotocol
+from fsprotocol import FSProtocol
+from tests import plainEvent
+
+
+class QueueingExecutor(object):
+    """Executor keeping the events submitted until the test handles them"""
+    def __init__(self):
+        self.queued = []
+
+    def submit(self, event, ecb):
+        self.queued.append(event['Unique-ID'])
+        return True
+
+    def backlog(self):
+        return len(self.queued)
+
+    def overflowing(self):
+        return False
+
+
+class BackpressureTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(fsprotocol, 'reactor', self.clock)
+        self.protocol = FSProtocol()
+        self.protocol.highWater = 4
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+        self.executor = QueueingExecutor()
+        self.protocol.registerEvent("CHANNEL_ANSWER", False, None, executor=self.executor)
+
+    def feed(self, count):
+        self.protocol.dataReceived(''.join([plainEvent([("Event-Name", "CHANNEL_ANSWER"), ("Unique-ID", str(i))])
+                                            for i in range(count)]))
+
+    def test_pauseAtHighWater(self):
+        """Reading stops once highWater events are queued, the frames left stay in the receive buffer"""
+        self.feed(10)
+        self.assertEqual(self.executor.queued, ['0', '1', '2', '3'])
+        self.assertTrue(self.protocol.paused)
+        self.assertEqual(self.transport.producerState, 'paused')
+        self.assertEqual(self.protocol.readPauses, 1)
+
+    def test_resumeAtLowWater(self):
+        """Reading resumes once no more than half of highWater events are queued"""
+        self.feed(10)
+        del self.executor.queued[:1]
+        self.clock.advance(self.protocol.backlogPollInterval)
+        self.assertTrue(self.protocol.paused)
+        del self.executor.queued[:1]
+        self.clock.advance(self.protocol.backlogPollInterval)
+        #the buffered frames are dispatched until highWater is reached again
+        self.assertEqual(self.executor.queued, ['2', '3', '4', '5'])
+        self.assertTrue(self.protocol.paused)
+        self.assertEqual(self.protocol.readPauses, 2)
+
+    def test_noPauseBelowHighWater(self):
+        self.feed(3)
+        self.assertFalse(self.protocol.paused)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_connectionLostWhilePaused(self):
+        self.feed(10)
+        self.protocol.connectionLost(None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
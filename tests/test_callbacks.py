@@ -0,0 +1,55 @@
+"""Tests of the per channel callbacks of FSProtocol"""
+
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+
+from fsprotocol import FSProtocol
+from tests import plainEvent
+
+
+def channelEvent(name, uuid):
+    return plainEvent([("Event-Name", name), ("Unique-ID", uuid)])
+
+
+class ChannelCallbackTestCase(unittest.TestCase):
+    def setUp(self):
+        self.protocol = FSProtocol()
+        self.protocol.makeConnection(proto_helpers.StringTransport())
+        self.received = []
+
+    def record(self, event, tag):
+        self.received.append((tag, event['Unique-ID']))
+
+    def test_routedByUniqueID(self):
+        """Channel callbacks only run for their channel, event callbacks for every channel"""
+        self.protocol.registerChannelEvent("CHANNEL_ANSWER", "a", False, self.record, 'a')
+        self.protocol.registerChannelEvent("CHANNEL_ANSWER", "b", False, self.record, 'b')
+        self.protocol.registerEvent("CHANNEL_ANSWER", False, self.record, 'all')
+        self.protocol.dataReceived(channelEvent("CHANNEL_ANSWER", "b") + channelEvent("CHANNEL_ANSWER", "c"))
+        self.assertEqual(self.received, [('all', 'b'), ('b', 'b'), ('all', 'c')])
+
+    def test_allEvents(self):
+        self.protocol.registerChannelEvent("ALL", "a", False, self.record, 'a')
+        self.protocol.dataReceived(channelEvent("CHANNEL_ANSWER", "a") + channelEvent("CHANNEL_HANGUP", "a") +
+                                   channelEvent("CHANNEL_HANGUP", "b"))
+        self.assertEqual(self.received, [('a', 'a'), ('a', 'a')])
+
+    def test_deregisterDropsIndexEntries(self):
+        """The index keeps no entry for channels whose callbacks were all deregistered"""
+        first = self.protocol.registerChannelEvent("CHANNEL_ANSWER", "a", False, self.record, 1)
+        second = self.protocol.registerChannelEvent("CHANNEL_ANSWER", "a", False, self.record, 2)
+        self.protocol.deregisterEvent(first)
+        self.protocol.dataReceived(channelEvent("CHANNEL_ANSWER", "a"))
+        self.assertEqual(self.received, [(2, 'a')])
+        self.protocol.deregisterEvent(second)
+        self.assertEqual(self.protocol.headerEventCallbacks, {})
+
+    def test_autoFilter(self):
+        """With autoFilter a filter on the Unique-ID is installed while the channel has callbacks"""
+        self.protocol.autoFilter = True
+        transport = self.protocol.transport
+        ecb = self.protocol.registerChannelEvent("CHANNEL_ANSWER", "a", False, self.record)
+        self.assertEqual(transport.value(), "filter Unique-ID a\n\n")
+        transport.clear()
+        self.protocol.deregisterEvent(ecb)
+        self.assertEqual(transport.value(), "filter delete Unique-ID a\n\n")
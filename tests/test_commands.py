@@ -0,0 +1,139 @@
+"""Tests of the command timeouts and of executeSync of FSProtocol"""
+
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import defer, task
+
+import fsprotocol
+from fsprotocol import FSProtocol, CommandError, CommandTimeout
+from tests import plainEvent, backgroundJob, commandReply, apiResponse
+
+
+class TimeoutTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(fsprotocol, 'reactor', self.clock)
+        self.protocol = FSProtocol()
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def test_timeout(self):
+        """commandTimeout applies to every command unless the call gives its own timeout"""
+        self.protocol.commandTimeout = 10
+        default = self.protocol.sendAPI("status")
+        own = self.protocol.sendAPI("version", timeout=2)
+        self.clock.advance(1)
+        stats = self.protocol.pendingStats()
+        self.assertEqual((stats['pendingJobs'], stats['oldestJob']), (2, 1))
+        self.clock.advance(1)
+        self.failureResultOf(own, CommandTimeout)
+        self.assertNoResult(default)
+        self.clock.advance(8)
+        self.failureResultOf(default, CommandTimeout)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_lateReply(self):
+        """The reply to a timed out command is discarded, the next reply goes to the next command"""
+        first = self.protocol.sendAPI("show channels", timeout=5)
+        second = self.protocol.sendAPI("status")
+        self.clock.advance(5)
+        self.failureResultOf(first, CommandTimeout)
+        self.protocol.dataReceived(apiResponse("0 total.\n"))
+        self.assertNoResult(second)
+        self.protocol.dataReceived(apiResponse("UP\n"))
+        self.assertEqual(self.successResultOf(second).get_payload(), "UP\n")
+        self.assertEqual(self.protocol.pendingStats()['pendingJobs'], 0)
+
+    def test_replyCancelsTimer(self):
+        df = self.protocol.sendData("event", "plain ALL", timeout=5)
+        self.protocol.dataReceived(commandReply())
+        self.successResultOf(df)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_backgroundJobTimeout(self):
+        """A bgapi whose BACKGROUND_JOB never comes fails and is forgotten"""
+        self.protocol.backgroundJobTimeout = 30
+        df = self.protocol.sendBGAPI("originate user/1000 &park")
+        jobid = self.transport.value().split("Job-UUID:")[1].split("\n")[0]
+        self.protocol.dataReceived(commandReply("+OK Job-UUID: %s"%jobid, jobid))
+        self.clock.advance(30)
+        self.failureResultOf(df, CommandTimeout)
+        self.assertEqual(self.protocol.pendingBackgroundJobs, {})
+        #a late BACKGROUND_JOB is ignored
+        self.protocol.dataReceived(backgroundJob(jobid, "+OK abc\n"))
+
+    def test_cancelBackgroundJob(self):
+        df = self.protocol.sendBGAPI("status", timeout=30)
+        df.cancel()
+        self.failureResultOf(df, defer.CancelledError)
+        self.assertEqual(self.protocol.pendingBackgroundJobs, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+def executeComplete(appUUID, app="playback", uuid="abc"):
+    return plainEvent([("Event-Name", "CHANNEL_EXECUTE_COMPLETE"), ("Unique-ID", uuid), ("Application", app),
+                       ("Application-UUID", appUUID)])
+
+
+class ExecuteSyncTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(fsprotocol, 'reactor', self.clock)
+        self.protocol = FSProtocol()
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def sentUUIDs(self):
+        """Return the Event-UUID of the sendmsg written since the last call"""
+        sent = self.transport.value()
+        self.transport.clear()
+        return [line.split(": ")[1] for line in sent.split("\n") if line.startswith("Event-UUID: ")]
+
+    def test_firedByItsOwnCompletion(self):
+        """Executions of the same application on a channel complete in any order"""
+        first = self.protocol.executeSync("playback", "/tmp/a.wav", "abc")
+        second = self.protocol.executeSync("playback", "/tmp/b.wav", "abc")
+        firstUUID, secondUUID = self.sentUUIDs()
+        #CHANNEL_EXECUTE_COMPLETE is subscribed once
+        self.protocol.dataReceived(commandReply()*3)
+        self.protocol.dataReceived(executeComplete("other"))
+        self.assertNoResult(first)
+        self.protocol.dataReceived(executeComplete(secondUUID))
+        self.assertEqual(self.successResultOf(second)['Application-UUID'], secondUUID)
+        self.assertNoResult(first)
+        self.protocol.dataReceived(executeComplete(firstUUID))
+        self.assertEqual(self.successResultOf(first)['Application-UUID'], firstUUID)
+        self.assertEqual(self.protocol.headerEventCallbacks, {})
+
+    def test_commandFailed(self):
+        df = self.protocol.executeSync("playback", "/tmp/a.wav", "abc")
+        self.protocol.dataReceived(commandReply() + commandReply("-ERR invalid session id [abc]"))
+        self.failureResultOf(df, CommandError)
+        self.assertEqual(self.protocol.headerEventCallbacks, {})
+
+    def test_timeout(self):
+        df = self.protocol.executeSync("playback", "/tmp/a.wav", "abc", timeout=10)
+        appUUID, = self.sentUUIDs()
+        self.protocol.dataReceived(commandReply()*2)
+        self.clock.advance(10)
+        self.failureResultOf(df, CommandTimeout)
+        self.assertEqual(self.protocol.headerEventCallbacks, {})
+        #a late completion is ignored
+        self.protocol.dataReceived(executeComplete(appUUID))
+
+    def test_cancel(self):
+        df = self.protocol.executeSync("playback", "/tmp/a.wav", "abc", timeout=10)
+        df.cancel()
+        self.failureResultOf(df, defer.CancelledError)
+        self.assertEqual(self.protocol.headerEventCallbacks, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_playbackSync(self):
+        """playbackSync sets the terminators first and fires on the completion of its playback"""
+        df = self.protocol.playbackSync("/tmp/a.wav", uuid="abc")
+        sent = self.transport.value()
+        self.assertTrue(sent.index("execute-app-name: set") < sent.index("execute-app-name: playback"))
+        appUUID = self.sentUUIDs()[-1]
+        self.protocol.dataReceived(commandReply()*3)
+        self.protocol.dataReceived(executeComplete(appUUID))
+        self.assertEqual(self.successResultOf(df)['Application'], "playback")
@@ -0,0 +1,102 @@
+"""Tests of the Event class and the header parsers"""
+
+from twisted.trial import unittest
+
+import fsprotocol
+from fsprotocol import parseEvent, parseJSONEvent, Event
+
+
+class EventTestCase(unittest.TestCase):
+    def test_caseInsensitiveLookup(self):
+        event = parseEvent("Event-Name: CHANNEL_ANSWER\nUnique-ID: abc\nvariable_sip_from_user: 1000")
+        self.assertEqual(event['event-name'], 'CHANNEL_ANSWER')
+        self.assertEqual(event['UNIQUE-ID'], 'abc')
+        self.assertTrue(event.has_key('Variable_Sip_From_User'))
+        self.assertEqual(event['Missing-Header'], None)
+        self.assertEqual(event.get('Missing-Header', 'x'), 'x')
+
+    def test_lazyDecode(self):
+        event = parseEvent("Event-Name: CUSTOM\nChannel-Name: sofia/internal/1000%4010.0.0.1")
+        self.assertEqual(event['Channel-Name'], 'sofia/internal/1000%4010.0.0.1')
+        self.assertEqual(event.getDecoded('Channel-Name'), 'sofia/internal/1000@10.0.0.1')
+        event.decode()
+        self.assertEqual(event['Channel-Name'], 'sofia/internal/1000@10.0.0.1')
+        self.assertEqual(event.getDecoded('Channel-Name'), 'sofia/internal/1000@10.0.0.1')
+        self.assertEqual(event.getDecoded('Missing-Header'), None)
+
+    def test_setAfterDecode(self):
+        """Values set once decode() was called are kept as given, not decoded again"""
+        event = parseEvent("Event-Name: CUSTOM\nChannel-Name: sofia/internal/1000%4010.0.0.1")
+        event.decode()
+        event['variable_rate'] = '100%25'
+        event['Channel-Name'] = 'sofia/internal/1000%40pbx'
+        self.assertEqual(event['variable_rate'], '100%25')
+        self.assertEqual(event.getDecoded('Channel-Name'), 'sofia/internal/1000%40pbx')
+        self.assertEqual(sorted(event.items()), [('Channel-Name', 'sofia/internal/1000%40pbx'),
+                                                 ('Event-Name', 'CUSTOM'), ('variable_rate', '100%25')])
+        self.assertEqual(sorted(event.values()), ['100%25', 'CUSTOM', 'sofia/internal/1000%40pbx'])
+
+    def test_json(self):
+        event = parseJSONEvent('{"Event-Name": "CHANNEL_ANSWER", "Unique-ID": "abc", "_body": "hi"}')
+        self.assertEqual(event['unique-id'], 'abc')
+        self.assertEqual(event.get_payload(), 'hi')
+
+    def test_payload(self):
+        """Messages without a body have an empty payload, as email.message.Message had"""
+        event = parseEvent("Content-Type: command/reply\nReply-Text: +OK")
+        self.assertEqual(event.get_payload(), '')
+        self.assertEqual(event.get_payload(None, True), '')
+        self.assertEqual(parseJSONEvent('{"Event-Name": "HEARTBEAT"}').get_payload(), '')
+        self.assertEqual(Event().get_payload(), '')
+
+    def test_asString(self):
+        event = Event()
+        event.set_unixfrom("SendMsg abc")
+        event['call-command'] = 'execute'
+        self.assertEqual(event.as_string(True), "SendMsg abc\ncall-command: execute\n\n")
+
+
+class HeaderNameTableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.names = dict(fsprotocol._headerNames)
+        self.patch(fsprotocol, '_headerNames', self.names)
+        self.patch(fsprotocol, '_maxHeaderNames', len(self.names) + 10)
+
+    def test_tableIsCapped(self):
+        """Dynamic header names stop being interned once the table is full"""
+        for i in range(100):
+            parseEvent("Event-Name: CHANNEL_DATA\nvariable_dynamic_%d: %d"%(i, i))
+        self.assertTrue(len(self.names) <= fsprotocol._maxHeaderNames + 1)
+        self.assertFalse('variable_dynamic_99' in self.names)
+
+    def test_lookupAfterTableIsFull(self):
+        """Headers that were not interned are still found case insensitively"""
+        for i in range(20):
+            parseEvent("variable_filler_%d: x"%i)
+        event = parseEvent("Event-Name: CHANNEL_DATA\nvariable_Late_Name: late\nUnique-ID: abc")
+        self.assertFalse('variable_late_name' in self.names)
+        self.assertEqual(event['variable_late_name'], 'late')
+        self.assertEqual(event['VARIABLE_LATE_NAME'], 'late')
+        self.assertEqual(event['Unique-ID'], 'abc')
+        self.assertEqual(event.keys().count('variable_Late_Name'), 1)
+        event['variable_late_NAME'] = 'changed'
+        self.assertEqual(event['variable_Late_Name'], 'changed')
+        self.assertEqual(len(event), 3)
+        del event['VARIABLE_late_name']
+        self.assertFalse('variable_late_name' in event)
+        self.assertEqual(event['variable_other'], None)
+
+    def test_lowerKeysIndex(self):
+        """Names missing from the full table are looked up in an index of the event built once"""
+        for i in range(20):
+            parseEvent("variable_filler_%d: x"%i)
+        event = parseEvent("\n".join(["variable_Late_%d: %d"%(i, i) for i in range(50)]))
+        self.assertEqual(event['VARIABLE_LATE_7'], '7')
+        lowerKeys = event._lowerKeys
+        self.assertEqual(event['variable_late_missing'], None)
+        self.assertIdentical(event._lowerKeys, lowerKeys)
+        event['variable_Late_New'] = 'new'
+        self.assertEqual(event['VARIABLE_LATE_NEW'], 'new')
+        del event['variable_late_7']
+        self.assertEqual(event['variable_Late_7'], None)
+        self.assertEqual(len(event._lowerKeys), 50)
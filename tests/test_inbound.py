@@ -0,0 +1,146 @@
+"""Tests of the inbound protocols and factories"""
+
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import error, task
+from twisted.python import failure
+
+import fsprotocol
+from fsprotocol import Disconnected, CommandTimeout
+from inbound import ReconnectingInboundFactory, SplitInboundClient
+from workers import WorkerPool
+from tests import AUTH_REQUEST, plainEvent, commandReply, apiResponse
+
+
+def login(factory):
+    """Return a new authenticated protocol of factory and its transport"""
+    protocol = factory.buildProtocol(None)
+    transport = proto_helpers.StringTransport()
+    protocol.makeConnection(transport)
+    protocol.dataReceived(AUTH_REQUEST)
+    transport.clear()
+    protocol.dataReceived(commandReply("+OK accepted"))
+    return protocol, transport
+
+
+class ReconnectingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.factory = ReconnectingInboundFactory("ClueCon")
+        self.logins = []
+        self.factory.loginDeferred.addCallback(self.logins.append)
+
+    def connect(self):
+        return login(self.factory)
+
+    def disconnect(self, protocol):
+        protocol.connectionLost(failure.Failure(error.ConnectionLost()))
+
+    def test_pendingFailOnDisconnect(self):
+        protocol, transport = self.connect()
+        df = protocol.sendAPI("status")
+        job = protocol.sendBGAPI("status")
+        self.disconnect(protocol)
+        self.failureResultOf(df, Disconnected)
+        self.failureResultOf(job, Disconnected)
+
+    def test_staleProtocolFailsAtOnce(self):
+        """Commands sent on the protocol loginDeferred fired with fail once its connection is lost"""
+        first, transport = self.connect()
+        self.disconnect(first)
+        second, secondTransport = self.connect()
+        self.assertEqual(self.logins, [first])
+        self.assertIdentical(self.factory.lastProtocol, second)
+        transport.clear()
+        self.failureResultOf(first.sendAPI("status"), Disconnected)
+        self.failureResultOf(first.sendBGAPI("status"), Disconnected)
+        self.failureResultOf(first.sendAPIBatch(["status", "version"]).addCallback(
+            lambda results: [result.raiseException() for ok, result in results]), Disconnected)
+        self.assertEqual(first.pendingJobs, type(first.pendingJobs)())
+        self.assertEqual(first.pendingBackgroundJobs, {})
+        self.assertEqual(transport.value(), "")
+
+    def test_subscriptionsRestored(self):
+        first, transport = self.connect()
+        dfs = [first.subscribeEvents("CHANNEL_ANSWER"), first.addFilter("Unique-ID", "abc")]
+        self.disconnect(first)
+        for df in dfs:
+            self.failureResultOf(df, Disconnected)
+        second, secondTransport = self.connect()
+        self.assertEqual(secondTransport.value(), "event plain CHANNEL_ANSWER\n\nfilter Unique-ID abc\n\n")
+        self.assertIdentical(second.eventFilters, first.eventFilters)
+
+    def test_settingsKept(self):
+        """Settings changed on a connection apply to the connections replacing it"""
+        self.patch(fsprotocol, 'reactor', task.Clock())
+        first, transport = self.connect()
+        first.commandTimeout = 5
+        first.highWater = 100
+        first.shedLag = 0.5
+        first.useLanes = True
+        first.laneWeights = (2, 1, 1)
+        pool = WorkerPool('setup:module', count=1)
+        pool.attach(first)
+        self.disconnect(first)
+        second, secondTransport = self.connect()
+        self.assertEqual((second.commandTimeout, second.highWater, second.shedLag, second.useLanes, second.laneWeights),
+                         (5, 100, 0.5, True, (2, 1, 1)))
+        self.assertIdentical(second.workerPool, pool)
+        self.assertIdentical(pool.protocol, second)
+        self.assertNotEqual(second._lagCall, None)
+        #settings left at their class default are not copied
+        self.assertNotIn('backgroundJobTimeout', second.__dict__)
+        df = second.sendAPI("status")
+        fsprotocol.reactor.advance(5)
+        self.failureResultOf(df, CommandTimeout)
+
+
+class SplitClientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = SplitInboundClient("ClueCon")
+        self.events, self.eventTransport = login(self.client.eventFactory)
+        self.commands, self.commandTransport = login(self.client.commandFactory)
+        self.assertEqual(self.commandTransport.value(), "event plain BACKGROUND_JOB\n\n")
+        self.commands.dataReceived(commandReply())
+        self.commandTransport.clear()
+
+    def test_notConnected(self):
+        client = SplitInboundClient("ClueCon")
+        self.assertRaises(Disconnected, client.registerEvent, "CHANNEL_ANSWER", True, None)
+        self.assertRaises(AttributeError, getattr, client, "apiStatus")
+
+    def test_commandsOnCommandConnection(self):
+        df = self.client.apiStatus()
+        self.assertEqual(self.commandTransport.value(), "api status\n\n")
+        self.assertEqual(self.eventTransport.value(), "")
+        self.commands.dataReceived(apiResponse("UP\n"))
+        self.assertEqual(self.successResultOf(df).get_payload(), "UP\n")
+
+    def test_eventsOnEventConnection(self):
+        """Callbacks, subscriptions and filters are kept and sent on the event connection"""
+        received = []
+        ecb = self.client.registerEvent("CHANNEL_ANSWER", True, received.append)
+        self.client.addFilter("Unique-ID", "abc")
+        self.assertEqual(self.eventTransport.value(), "event plain CHANNEL_ANSWER\n\nfilter Unique-ID abc\n\n")
+        self.assertEqual(self.commandTransport.value(), "")
+        self.assertEqual(self.commands.eventCallbacks, {})
+        self.assertEqual(self.commands.eventFilters, {})
+        self.commands.dataReceived(plainEvent([("Event-Name", "CHANNEL_ANSWER")]))
+        self.assertEqual(received, [])
+        self.events.dataReceived(plainEvent([("Event-Name", "CHANNEL_ANSWER")]))
+        self.assertEqual(len(received), 1)
+        self.client.deregisterEvent(ecb)
+        self.assertEqual(self.events.eventCallbacks["CHANNEL_ANSWER"], [])
+
+    def test_executeSync(self):
+        """The sendmsg is written on the command connection, its completion received on the event connection"""
+        df = self.client.playAndGetDigits(1, 4, varname="digits", uuid="abc")
+        sent = self.commandTransport.value()
+        self.assertTrue(sent.startswith("SendMsg abc\n"))
+        self.assertIn("execute-app-name: play_and_get_digits\n", sent)
+        self.assertEqual(self.eventTransport.value(), "event plain CHANNEL_EXECUTE_COMPLETE\n\n")
+        appUUID = sent.split("Event-UUID: ")[1].split("\n")[0]
+        self.commands.dataReceived(commandReply())
+        self.events.dataReceived(plainEvent([("Event-Name", "CHANNEL_EXECUTE_COMPLETE"),
+                                             ("Application-UUID", appUUID), ("variable_digits", "42")]))
+        self.assertEqual(self.successResultOf(df), "42")
+        self.assertEqual(self.events.headerEventCallbacks, {})
@@ -0,0 +1,93 @@
+"""Tests of the priority lanes of outgoing commands"""
+
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+
+from fsprotocol import FSProtocol
+from tests import commandReply, apiResponse, backgroundJob
+
+
+class LanesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.protocol = FSProtocol()
+        self.protocol.useLanes = True
+        self.transport = proto_helpers.StringTransport()
+
+    def connect(self, maxOutstanding=1, laneWeights=None):
+        self.protocol.maxOutstanding = maxOutstanding
+        self.protocol.laneWeights = laneWeights
+        self.protocol.makeConnection(self.transport)
+
+    def written(self):
+        """Return the api commands written since the last call"""
+        commands = [frame.split("\n")[0].split(' ')[1] for frame in self.transport.value().split("\n\n") if frame]
+        self.transport.clear()
+        return commands
+
+    def answer(self, count):
+        """Reply to the commands written one at a time, returning the commands in the order they were written"""
+        commands = self.written()
+        for i in range(count):
+            self.protocol.dataReceived(apiResponse("+OK\n"))
+            commands.extend(self.written())
+        return commands
+
+    def test_priorityOrder(self):
+        """Control commands go before calls and calls before bulk originates"""
+        self.connect()
+        self.protocol.sendAPI("status")
+        self.protocol.sendAPI("originate user/1 &park")
+        self.protocol.sendAPI("uuid_bridge a b")
+        self.protocol.sendAPI("uuid_kill a")
+        self.assertEqual(self.answer(4), ['status', 'uuid_kill', 'uuid_bridge', 'originate'])
+
+    def test_weightedFairness(self):
+        """With laneWeights each lane gets its share of every round, bulk commands are not starved"""
+        self.connect(laneWeights=(2, 1, 1))
+        self.protocol.sendAPI("status")
+        for i in range(4):
+            self.protocol.sendAPI("originate user/%d &park"%i)
+            self.protocol.sendAPI("uuid_bridge a b")
+            self.protocol.sendAPI("uuid_kill a")
+        #status took the call share of the first round
+        self.assertEqual(self.answer(13), ['status', 'uuid_kill', 'uuid_kill', 'originate',
+                                           'uuid_kill', 'uuid_kill', 'uuid_bridge', 'originate',
+                                           'uuid_bridge', 'originate', 'uuid_bridge', 'originate', 'uuid_bridge'])
+
+    def test_invalidWeights(self):
+        self.protocol.laneWeights = (4, 0, 1)
+        self.assertRaises(ValueError, self.protocol.makeConnection, self.transport)
+
+    def test_replyReleasesBytes(self):
+        self.connect(maxOutstanding=1024)
+        dfs = [self.protocol.sendAPI("status"), self.protocol.sendData("event plain", "ALL")]
+        self.assertTrue(self.protocol._outstanding > 0)
+        self.protocol.dataReceived(apiResponse("UP\n") + commandReply("+OK event listener enabled plain"))
+        self.assertEqual(self.protocol._outstanding, 0)
+        for df in dfs:
+            self.successResultOf(df)
+
+    def test_backgroundJobReleasesBytes(self):
+        """The bytes of a bgapi are released by its command reply, its BACKGROUND_JOB only fires the result"""
+        self.connect(maxOutstanding=1)
+        job = self.protocol.sendBGAPI("status")
+        self.protocol.sendAPI("version")
+        jobid = self.transport.value().split("Job-UUID:")[1].split("\n")[0]
+        self.assertEqual(self.written(), ['status'])
+        self.protocol.dataReceived(commandReply("+OK Job-UUID: %s"%jobid, jobid))
+        self.assertEqual(self.written(), ['version'])
+        self.assertEqual(self.protocol._outstandingJobs, {})
+        self.protocol.dataReceived(backgroundJob(jobid, "+OK UP\n"))
+        self.assertEqual(self.successResultOf(job).get_payload(), "+OK UP\n")
+        self.protocol.dataReceived(apiResponse("1.10\n"))
+        self.assertEqual(self.protocol._outstanding, 0)
+
+    def test_cancelledNotSent(self):
+        """Commands cancelled while queued are dropped from their lane"""
+        self.connect()
+        self.protocol.sendAPI("status")
+        for df in (self.protocol.sendAPI("uuid_kill a"), self.protocol.sendBGAPI("uuid_kill b")):
+            df.cancel()
+            self.failureResultOf(df)
+        self.protocol.sendAPI("version")
+        self.assertEqual(self.answer(2), ['status', 'version'])
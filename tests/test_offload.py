@@ -0,0 +1,193 @@
+"""Tests of the thread executor"""
+
+import threading
+import time
+
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import task
+
+import fsprotocol
+import offload
+from fsprotocol import FSProtocol, Event
+from offload import ThreadExecutor
+from tests import plainEvent
+
+
+def channelEvent(uuid, name="CHANNEL_ANSWER"):
+    event = Event()
+    event['Event-Name'] = name
+    event['Unique-ID'] = uuid
+    return event
+
+
+class ExecutorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        #the executors are stopped by the cleanups rather than on reactor shutdown
+        self.clock.addSystemEventTrigger = lambda *args: None
+        self.patch(offload, 'reactor', self.clock)
+        self.patch(fsprotocol, 'reactor', self.clock)
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.handled = []
+        self.executors = []
+        self.addCleanup(self.release.set)
+        self.slots = threading.Semaphore(0)
+        self.addCleanup(lambda: [self.slots.release() for i in range(10)])
+
+    def handler(self, event):
+        self.started.set()
+        self.release.wait()
+        self.handled.append(event['Unique-ID'])
+
+    def stepHandler(self, event):
+        """Handler running once per release of self.slots"""
+        self.started.set()
+        self.slots.acquire()
+        self.handled.append(event['Unique-ID'])
+
+    def executor(self, **kwargs):
+        executor = ThreadExecutor(**kwargs)
+        self.executors.append(executor)
+        self.addCleanup(executor.stop)
+        return executor
+
+    def inThread(self, func, *args):
+        """Run func in a thread and fail if it does not return quickly"""
+        runner = threading.Thread(target=func, args=args)
+        runner.setDaemon(True)
+        runner.start()
+        runner.join(2)
+        self.assertFalse(runner.isAlive(), "%s blocked"%func.__name__)
+
+    def waitFor(self, condition):
+        deadline = time.time() + 5
+        while not condition():
+            self.assertTrue(time.time() < deadline, "timed out")
+            self.clock.advance(ThreadExecutor.retryInterval)
+            time.sleep(0.001)
+
+    def test_dropWhenFull(self):
+        executor = self.executor(threads=1, maxQueue=1)
+        ecb = fsprotocol.EventCallback("CHANNEL_ANSWER", self.handler)
+        self.assertTrue(executor.submit(channelEvent('1'), ecb))
+        self.started.wait(2)
+        self.assertTrue(executor.submit(channelEvent('2'), ecb))
+        self.assertFalse(executor.submit(channelEvent('3'), ecb))
+        self.assertEqual(executor.dropped, 1)
+        self.release.set()
+        self.waitFor(lambda: len(self.handled) == 2)
+        self.assertEqual(self.handled, ['1', '2'])
+
+    def test_dropCounting(self):
+        """With policy drop every event finding the queue full is dropped and counted"""
+        executor = self.executor(threads=1, maxQueue=1)
+        ecb = fsprotocol.EventCallback("CHANNEL_ANSWER", self.handler)
+        executor.submit(channelEvent('1'), ecb)
+        self.started.wait(2)
+        results = [executor.submit(channelEvent(uuid), ecb) for uuid in '2345']
+        self.assertEqual(results, [True, False, False, False])
+        self.assertFalse(executor.overflowing())
+        self.release.set()
+        self.waitFor(lambda: len(self.handled) == 2)
+        stats = executor.stats()
+        self.assertEqual((stats['submitted'], stats['dropped'], stats['handled']), (5, 3, 2))
+        self.assertEqual(self.handled, ['1', '2'])
+
+    def test_blockThenResume(self):
+        """Events of a channel submitted while others wait for room queue up behind them"""
+        executor = self.executor(threads=1, maxQueue=1, policy='block')
+        ecb = fsprotocol.EventCallback("CHANNEL_ANSWER", self.stepHandler)
+        executor.submit(channelEvent('1'), ecb)
+        self.started.wait(2)
+        executor.submit(channelEvent('2'), ecb)
+        executor.submit(channelEvent('3'), ecb)
+        self.assertEqual(executor.stats()['waiting'], [1])
+        self.slots.release()
+        deadline = time.time() + 5
+        while self.handled != ['1'] or executor.queues[0].qsize():
+            self.assertTrue(time.time() < deadline, "timed out")
+            time.sleep(0.001)
+        #the queue has room but '3' is still waiting for the retry
+        executor.submit(channelEvent('4'), ecb)
+        self.assertEqual(executor.stats()['waiting'], [2])
+        self.clock.advance(ThreadExecutor.retryInterval)
+        self.assertEqual(executor.stats()['waiting'], [1])
+        for i in range(3):
+            self.slots.release()
+        self.waitFor(lambda: len(self.handled) == 4)
+        self.assertEqual(self.handled, ['1', '2', '3', '4'])
+        self.assertFalse(executor.overflowing())
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_stopWithQueuedWork(self):
+        """The queued events are still handled after stop, a later submit starts new threads"""
+        executor = self.executor(threads=1, maxQueue=0)
+        ecb = fsprotocol.EventCallback("CHANNEL_ANSWER", self.handler)
+        for uuid in '123':
+            executor.submit(channelEvent(uuid), ecb)
+        self.started.wait(2)
+        worker = executor.workers[0]
+        self.inThread(executor.stop)
+        self.release.set()
+        worker.join(2)
+        self.assertFalse(worker.isAlive())
+        self.assertEqual(self.handled, ['1', '2', '3'])
+        self.assertEqual(executor.dropped, 0)
+        executor.submit(channelEvent('4'), ecb)
+        self.assertEqual(len(executor.workers), 1)
+        self.assertNotIdentical(executor.workers[0], worker)
+        self.waitFor(lambda: len(self.handled) == 4)
+
+    def test_blockDoesNotBlockTheReactor(self):
+        """With policy block a full queue keeps events in order without waiting in submit"""
+        executor = self.executor(threads=1, maxQueue=1, policy='block')
+        ecb = fsprotocol.EventCallback("CHANNEL_ANSWER", self.handler)
+        executor.submit(channelEvent('1'), ecb)
+        self.started.wait(2)
+        self.inThread(lambda: [executor.submit(channelEvent(uuid), ecb) for uuid in '234'])
+        self.assertTrue(executor.overflowing())
+        self.assertEqual(executor.stats()['waiting'], [2])
+        self.assertEqual(executor.backlog(), 3)
+        self.release.set()
+        self.waitFor(lambda: len(self.handled) == 4)
+        self.assertEqual(self.handled, ['1', '2', '3', '4'])
+        self.assertFalse(executor.overflowing())
+        self.assertEqual(executor.dropped, 0)
+
+    def test_stopWithFullQueue(self):
+        """stop does not wait for room in a full queue, the thread ends once it emptied it"""
+        executor = self.executor(threads=1, maxQueue=1, policy='block')
+        ecb = fsprotocol.EventCallback("CHANNEL_ANSWER", self.handler)
+        executor.submit(channelEvent('1'), ecb)
+        self.started.wait(2)
+        executor.submit(channelEvent('2'), ecb)
+        executor.submit(channelEvent('3'), ecb)
+        worker = executor.workers[0]
+        self.inThread(executor.stop)
+        self.assertEqual(executor.dropped, 1)
+        self.release.set()
+        worker.join(2)
+        self.assertFalse(worker.isAlive())
+        self.assertEqual(self.handled, ['1', '2'])
+
+    def test_protocolPausesWhileOverflowing(self):
+        """The protocol stops reading while the executor holds events it has no room for"""
+        protocol = FSProtocol()
+        transport = proto_helpers.StringTransport()
+        protocol.makeConnection(transport)
+        executor = self.executor(threads=1, maxQueue=1, policy='block')
+        protocol.registerEvent("CHANNEL_ANSWER", False, self.handler, executor=executor)
+        protocol.dataReceived(''.join([plainEvent([("Event-Name", "CHANNEL_ANSWER"), ("Unique-ID", str(i))])
+                                       for i in range(10)]))
+        self.assertTrue(protocol.paused)
+        self.assertEqual(transport.producerState, 'paused')
+        self.assertTrue(executor.submitted < 10)
+        self.assertEqual(protocol.readPauses, 1)
+        self.release.set()
+        self.waitFor(lambda: len(self.handled) == 10)
+        self.assertEqual(self.handled, [str(i) for i in range(10)])
+        self.clock.advance(protocol.backlogPollInterval)
+        self.assertFalse(protocol.paused)
+        self.assertEqual(transport.producerState, 'producing')
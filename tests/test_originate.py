@@ -0,0 +1,170 @@
+"""Tests of the originate scheduler and of campaigns"""
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+import originate
+from originate import OriginateScheduler, QueueFull
+
+
+class FakeOriginator(object):
+    """Protocol whose apiOriginate deferreds are fired by the test"""
+    def __init__(self):
+        self.calls = []
+        self.cancelled = []
+
+    def apiOriginate(self, *args, **kwargs):
+        df = defer.Deferred(self.cancelled.append)
+        self.calls.append((df, args, kwargs))
+        return df
+
+
+class SchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(originate, 'reactor', self.clock)
+        self.protocol = FakeOriginator()
+
+    def test_rate(self):
+        """Requests beyond the burst are released at rate per second"""
+        scheduler = OriginateScheduler(self.protocol, 2, burst=2)
+        for i in range(5):
+            scheduler.apiOriginate('user/%d'%i)
+        self.assertEqual(len(self.protocol.calls), 2)
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.protocol.calls), 3)
+        self.clock.advance(1)
+        self.assertEqual(len(self.protocol.calls), 5)
+
+    def test_rejectWhenFull(self):
+        scheduler = OriginateScheduler(self.protocol, 1, maxQueue=1)
+        scheduler.apiOriginate('user/1')
+        scheduler.apiOriginate('user/2')
+        self.failureResultOf(scheduler.apiOriginate('user/3'), QueueFull)
+
+    def test_cancelQueued(self):
+        scheduler = OriginateScheduler(self.protocol, 1)
+        scheduler.apiOriginate('user/1')
+        df = scheduler.apiOriginate('user/2')
+        df.cancel()
+        self.failureResultOf(df, defer.CancelledError)
+        self.assertEqual(len(scheduler.queue), 0)
+        self.clock.advance(5)
+        self.assertEqual(len(self.protocol.calls), 1)
+
+    def test_cancelReleased(self):
+        """A cancelled request that was released keeps its slot until its result arrives"""
+        scheduler = OriginateScheduler(self.protocol, 10, maxInFlight=1)
+        df = scheduler.apiOriginate('user/1')
+        scheduler.apiOriginate('user/2')
+        inner = self.protocol.calls[0][0]
+        df.cancel()
+        self.failureResultOf(df, defer.CancelledError)
+        self.assertEqual(self.protocol.cancelled, [])
+        self.assertEqual(scheduler.inFlight, 1)
+        self.assertEqual(len(self.protocol.calls), 1)
+        inner.callback('+OK')
+        self.assertEqual(scheduler.inFlight, 1)
+        self.assertEqual(len(self.protocol.calls), 2)
+
+    def test_resultAfterCancel(self):
+        """A result arriving for a cancelled request is discarded without errors"""
+        scheduler = OriginateScheduler(self.protocol, 10)
+        df = scheduler.apiOriginate('user/1')
+        inner = self.protocol.calls[0][0]
+        df.cancel()
+        self.failureResultOf(df, defer.CancelledError)
+        inner.callback('+OK')
+        self.assertEqual(self.successResultOf(inner), None)
+        self.assertEqual(scheduler.inFlight, 0)
+
+
+class RefusingOriginator(object):
+    """Originator failing every call at once, like a Cluster without nodes"""
+    def __init__(self):
+        self.calls = 0
+
+    def apiOriginate(self, **kwargs):
+        self.calls += 1
+        return defer.fail(originate.CommandError("No FreeSWITCH node available"))
+
+
+class BrokenOriginator(object):
+    """Originator raising at once, like apiOriginate called with bad originateArgs"""
+    def __init__(self):
+        self.calls = 0
+
+    def apiOriginate(self, **kwargs):
+        self.calls += 1
+        raise TypeError("apiOriginate() got an unexpected keyword argument 'aplication'")
+
+
+class CampaignTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(originate, 'reactor', self.clock)
+        self.pulled = 0
+        self.results = []
+
+    def destinations(self, count):
+        for i in xrange(count):
+            self.pulled += 1
+            yield 'user/%d'%i
+
+    def test_window(self):
+        protocol = FakeOriginator()
+        campaign = originate.Campaign(protocol, self.destinations(5), window=2, onResult=self.results.append)
+        finished = campaign.start()
+        self.assertEqual(self.pulled, 2)
+        for i in range(5):
+            df, args, kwargs = protocol.calls[i]
+            self.assertEqual(kwargs['url'], 'user/%d'%i)
+            self.assertTrue(kwargs['background'])
+            event = originate.Event()
+            event.set_payload('+OK %s\n'%kwargs['channelvars']['origination_uuid'])
+            df.callback(event)
+        self.assertEqual(self.successResultOf(finished), (5, 0))
+        self.assertEqual([result.success for result in self.results], [True]*5)
+
+    def test_refusedCallsBackOff(self):
+        """An originator failing calls at once does not drain the destinations"""
+        originator = RefusingOriginator()
+        campaign = originate.Campaign(originator, self.destinations(1000000), window=10,
+                                      onResult=self.results.append)
+        finished = campaign.start()
+        self.assertEqual((self.pulled, originator.calls), (1, 1))
+        self.clock.advance(campaign.retryDelay)
+        self.assertEqual((self.pulled, originator.calls), (1, 2))
+        self.assertEqual(self.results, [])
+        campaign.stop()
+        self.assertEqual(self.successResultOf(finished), (0, 0))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_fullSchedulerBacksOff(self):
+        """Destinations refused by a full scheduler are placed once it has room"""
+        protocol = FakeOriginator()
+        scheduler = OriginateScheduler(protocol, 1, maxQueue=2)
+        campaign = originate.Campaign(scheduler, self.destinations(100), window=10, onResult=self.results.append)
+        campaign.start()
+        self.assertEqual(self.pulled, 4)
+        self.assertEqual(campaign.inFlight, 3)
+        self.assertEqual(self.results, [])
+        #one slot freed in a second, the refused destination takes it and the next one is refused
+        self.clock.advance(1)
+        self.assertEqual(len(protocol.calls), 2)
+        self.assertEqual(len(scheduler.queue), 2)
+        self.assertEqual(campaign.inFlight, 4)
+        self.assertEqual((self.pulled, campaign.refused), (5, 2))
+        self.assertEqual(self.results, [])
+
+    def test_errorStopsCampaign(self):
+        """An originator raising anything but a CommandError stops the campaign at the first destination"""
+        originator = BrokenOriginator()
+        campaign = originate.Campaign(originator, self.destinations(1000000), window=10,
+                                      onResult=self.results.append)
+        finished = campaign.start()
+        self.failureResultOf(finished, TypeError)
+        self.assertEqual((self.pulled, originator.calls), (1, 1))
+        self.assertTrue(campaign.stopped)
+        self.assertEqual(campaign.inFlight, 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,144 @@
+"""Tests of the inbound connection pool"""
+
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import error
+from twisted.python import failure
+
+import fsprotocol
+import pool
+from fsprotocol import CommandTimeout
+from pool import InboundPool, NoConnection
+from tests import AUTH_REQUEST, commandReply, apiResponse
+
+
+class PoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = proto_helpers.MemoryReactorClock()
+        self.patch(pool, 'reactor', self.clock)
+        self.patch(fsprotocol, 'reactor', self.clock)
+        self.transports = {} #member index -> transport of its current connection
+
+    def start(self, size=3, **kwargs):
+        self.pool = InboundPool("127.0.0.1", 8021, "ClueCon", size=size, retryDelay=5, **kwargs)
+        self.pool.start()
+        for member in self.pool.members:
+            self.connect(member)
+        return self.pool
+
+    def connect(self, member):
+        """Authenticate the last connection attempt of member"""
+        factory = [client[2] for client in self.clock.tcpClients if client[2].member is member][-1]
+        protocol = factory.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        protocol.makeConnection(transport)
+        protocol.dataReceived(AUTH_REQUEST)
+        protocol.dataReceived(commandReply("+OK accepted"))
+        transport.clear()
+        self.transports[member.index] = transport
+        self.assertEqual(member.state, 'ready')
+
+    def disconnect(self, member):
+        protocol = member.protocol
+        reason = failure.Failure(error.ConnectionLost())
+        protocol.connectionLost(reason)
+        protocol.factory.clientConnectionLost(None, reason)
+
+    def sentOn(self):
+        """Return the index of the members a command was written on since the last call"""
+        indexes = [index for index, transport in sorted(self.transports.items()) if transport.value()]
+        for transport in self.transports.values():
+            transport.clear()
+        return indexes
+
+    def test_leastLoaded(self):
+        """Commands go to the connection with the fewest commands waiting"""
+        self.start()
+        self.pool.apiStatus()
+        self.pool.apiStatus()
+        self.assertEqual(self.sentOn(), [0, 1])
+        self.pool.members[0].protocol.dataReceived(apiResponse("UP\n"))
+        #on equal loads the connection that got the fewest commands
+        self.pool.apiStatus()
+        self.assertEqual(self.sentOn(), [2])
+        self.pool.apiStatus()
+        self.assertEqual(self.sentOn(), [0])
+
+    def test_healthTransitions(self):
+        """A connection timing out maxFailures times in a row is avoided until it replies again"""
+        self.start(size=2, maxFailures=2, commandTimeout=5)
+        first, second = self.pool.members
+        self.assertEqual(first.protocol.commandTimeout, 5)
+        dfs = [self.pool.apiStatus(), self.pool.apiStatus()]
+        self.clock.advance(5)
+        for df in dfs:
+            self.failureResultOf(df, CommandTimeout)
+        self.assertEqual((first.failures, second.failures), (1, 1))
+        self.sentOn()
+        df = self.pool.apiStatus()
+        self.assertEqual(self.sentOn(), [0])
+        self.clock.advance(5)
+        self.failureResultOf(df, CommandTimeout)
+        self.assertFalse(first.healthy())
+        self.assertTrue(second.healthy())
+        for i in range(2):
+            self.pool.apiStatus()
+        self.assertEqual(self.sentOn(), [1])
+        #the late replies are discarded, a reply to a new command makes the connection healthy again
+        second.protocol.dataReceived(apiResponse("UP\n")*3)
+        self.assertEqual(second.failures, 0)
+        self.assertEqual(self.pool.stats()[0]['timeouts'], 2)
+
+    def test_noHealthyConnection(self):
+        """When no connection is healthy the ready ones are still used"""
+        self.start(size=1, maxFailures=1, commandTimeout=5)
+        df = self.pool.apiStatus()
+        self.clock.advance(5)
+        self.failureResultOf(df, CommandTimeout)
+        self.assertFalse(self.pool.members[0].healthy())
+        self.sentOn()
+        self.pool.apiStatus()
+        self.assertEqual(self.sentOn(), [0])
+
+    def test_reconnect(self):
+        """A lost connection is left out until it is reconnected retryDelay seconds later"""
+        self.start(size=2)
+        first = self.pool.members[0]
+        self.disconnect(first)
+        self.assertEqual(first.state, 'down')
+        for i in range(2):
+            self.pool.apiStatus()
+        self.assertEqual(self.sentOn(), [1])
+        attempts = len(self.clock.tcpClients)
+        self.clock.advance(5)
+        self.assertEqual(len(self.clock.tcpClients), attempts + 1)
+        self.assertEqual(first.state, 'connecting')
+        self.connect(first)
+        self.pool.apiStatus()
+        self.assertEqual(self.sentOn(), [0])
+
+    def test_noConnection(self):
+        self.start(size=1)
+        self.pool.stop()
+        self.disconnect(self.pool.members[0])
+        self.failureResultOf(self.pool.apiStatus(), NoConnection)
+
+    def test_backgroundJobsOnOneConnection(self):
+        """bgapi commands run on the only connection subscribed to BACKGROUND_JOB"""
+        self.start()
+        jobs = [self.pool.sendBGAPI("status"), self.pool.apiStatus(background=True),
+                self.pool.sendAPIBatch(["status", "version"], True)]
+        self.pool.apiStatus()
+        background = self.transports[0].value()
+        self.assertTrue(background.startswith("event plain BACKGROUND_JOB\n\n"))
+        self.assertEqual(background.count("bgapi "), 4)
+        self.assertEqual(background.count("event plain"), 1)
+        self.assertEqual(self.transports[1].value(), "api status\n\n")
+        self.assertEqual(self.transports[2].value(), "")
+        #another connection takes over once it is lost
+        self.disconnect(self.pool.members[0])
+        for df in jobs[:2]:
+            self.failureResultOf(df, fsprotocol.Disconnected)
+        self.sentOn()
+        self.pool.sendBGAPI("status")
+        self.assertTrue(self.transports[2].value().startswith("event plain BACKGROUND_JOB\n\nbgapi status"))
@@ -0,0 +1,66 @@
+"""Tests of header and predicate callbacks"""
+
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+
+from fsprotocol import FSProtocol, Prefix
+from tests import plainEvent, jsonEvent
+
+
+class PredicateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.protocol = FSProtocol()
+        self.protocol.makeConnection(proto_helpers.StringTransport())
+        self.addCleanup(self.protocol.connectionLost, None)
+        self.matched = []
+        self.protocol.registerPredicateEvent("CHANNEL_CREATE", {'Caller-Destination-Number':Prefix('+44'),
+                                             'Caller-Caller-ID-Name':'John Doe'}, False, self.matched.append)
+        self.protocol.registerHeaderEvent("CHANNEL_CREATE", 'Channel-Name', 'sofia/internal/1000@pbx', False,
+                                          self.matched.append)
+
+    def test_plainValuesAreDecoded(self):
+        """Predicates match the URL encoded values of plain events"""
+        self.protocol.dataReceived(plainEvent([("Event-Name", "CHANNEL_CREATE"),
+                                               ("Caller-Destination-Number", "%2B442071234567"),
+                                               ("Caller-Caller-ID-Name", "John%20Doe"),
+                                               ("Channel-Name", "sofia/internal/1000%40pbx")]))
+        self.assertEqual(len(self.matched), 2)
+        #handlers still get the raw values unless they decode the event
+        self.assertEqual(self.matched[0]['Caller-Destination-Number'], '%2B442071234567')
+
+    def test_json(self):
+        self.protocol.dataReceived(jsonEvent([("Event-Name", "CHANNEL_CREATE"),
+                                              ("Caller-Destination-Number", "+442071234567"),
+                                              ("Caller-Caller-ID-Name", "John Doe"),
+                                              ("Channel-Name", "sofia/internal/1000@pbx")]))
+        self.assertEqual(len(self.matched), 2)
+
+    def test_noMatch(self):
+        self.protocol.dataReceived(plainEvent([("Event-Name", "CHANNEL_CREATE"),
+                                               ("Caller-Destination-Number", "%2B332071234567"),
+                                               ("Caller-Caller-ID-Name", "John%20Doe")]))
+        self.assertEqual(self.matched, [])
+
+
+class AutoFilterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.protocol = FSProtocol()
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+        self.protocol.autoFilter = True
+
+    def test_eventFilters(self):
+        """registerEvent and registerPredicateEvent install the same filter, released by the last user"""
+        first = self.protocol.registerEvent("CHANNEL_CREATE", False, None)
+        second = self.protocol.registerPredicateEvent("CHANNEL_CREATE", {'Caller-Context':'default'}, False, None)
+        custom = self.protocol.registerPredicateEvent("CUSTOM sofia::register", {'from-user':'1000'}, False, None)
+        self.protocol.registerPredicateEvent("ALL", {'Caller-Context':'default'}, False, None)
+        self.assertEqual(self.transport.value(), "filter Event-Name CHANNEL_CREATE\n\n"
+                                                 "filter Event-Subclass sofia::register\n\n")
+        self.assertEqual((first.filter, second.filter, custom.filter),
+                         (('Event-Name', 'CHANNEL_CREATE'),)*2 + (('Event-Subclass', 'sofia::register'),))
+        self.transport.clear()
+        self.protocol.deregisterEvent(first)
+        self.assertEqual(self.transport.value(), "")
+        self.protocol.deregisterEvent(second)
+        self.assertEqual(self.transport.value(), "filter delete Event-Name CHANNEL_CREATE\n\n")
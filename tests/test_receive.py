@@ -0,0 +1,97 @@
+"""Tests of the receive buffer of FSProtocol"""
+
+import time
+
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+
+from fsprotocol import FSProtocol
+from tests import plainEvent, apiResponse
+
+CORE_UUID = "6e2d8c3c-2b9a-11e0-a6c9-1f3e2b0d4a11"
+
+
+def channelEvent(name, uuid, body=None):
+    return plainEvent([("Event-Name", name), ("Unique-ID", uuid), ("Core-UUID", CORE_UUID)], body)
+
+
+def burst(size):
+    """Return (data, number of events) of about size bytes of events, one with a body out of two"""
+    frames = []
+    length = 0
+    while length < size:
+        uuid = "%08d-2b9a-11e0-a6f1-1f3e2b0d4a11"%len(frames)
+        if len(frames)%2:
+            frame = channelEvent("BACKGROUND_JOB", uuid, "+OK %s\n"%uuid)
+        else:
+            frame = channelEvent("CHANNEL_ANSWER", uuid)
+        frames.append(frame)
+        length += len(frame)
+    return ''.join(frames), len(frames)
+
+
+class ReceiveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.protocol = FSProtocol()
+        self.protocol.makeConnection(proto_helpers.StringTransport())
+        self.received = []
+        for name in ("CHANNEL_ANSWER", "BACKGROUND_JOB"):
+            self.protocol.registerEvent(name, False, self.received.append)
+
+    def feed(self, data, chunkSize=None):
+        if chunkSize is None:
+            self.protocol.dataReceived(data)
+        else:
+            for i in xrange(0, len(data), chunkSize):
+                self.protocol.dataReceived(data[i:i+chunkSize])
+
+    def checkReceived(self, count):
+        self.assertEqual(len(self.received), count)
+        for i, event in enumerate(self.received):
+            uuid = "%08d-2b9a-11e0-a6f1-1f3e2b0d4a11"%i
+            self.assertEqual(event['Unique-ID'], uuid)
+            if i%2:
+                self.assertEqual(event.get_payload(), "+OK %s\n"%uuid)
+        self.assertEqual(self.protocol._bufferOffset, 0)
+        self.assertEqual(len(self.protocol._buffer), 0)
+
+    def test_burst(self):
+        """A 10 MB burst in one read dispatches every event in time linear in its size"""
+        small, smallCount = burst(1024*1024)
+        start = time.time()
+        self.feed(small)
+        smallTime = time.time() - start
+        self.checkReceived(smallCount)
+        del self.received[:]
+        data, count = burst(10*1024*1024)
+        start = time.time()
+        self.feed(data)
+        bigTime = time.time() - start
+        self.checkReceived(count)
+        #10 times the data, a quadratic buffer takes 100 times longer
+        self.assertTrue(bigTime < smallTime*25, "1 MB in %.2fs but 10 MB in %.2fs"%(smallTime, bigTime))
+
+    def test_chunked(self):
+        """Frames and payloads split over 7 byte reads are put back together"""
+        data, count = burst(256*1024)
+        self.feed(data, 7)
+        self.checkReceived(count)
+
+    def test_partialFrame(self):
+        """A frame cut in the middle of its delimiter is completed by the next read"""
+        data = channelEvent("CHANNEL_ANSWER", "00000000-2b9a-11e0-a6f1-1f3e2b0d4a11")
+        self.feed(data[:-1])
+        self.assertEqual(self.received, [])
+        self.feed(data[-1:])
+        self.checkReceived(1)
+
+    def test_apiResponse(self):
+        """An api/response payload arriving with the next frame is cut at its Content-Length"""
+        df = self.protocol.sendAPI("status")
+        replies = []
+        df.addCallback(replies.append)
+        body = "UP 0 years\n\n"
+        event = channelEvent("CHANNEL_ANSWER", "00000000-2b9a-11e0-a6f1-1f3e2b0d4a11")
+        self.feed(apiResponse(body) + event)
+        self.assertEqual(replies[0].get_payload(), body)
+        self.checkReceived(1)
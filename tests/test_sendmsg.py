@@ -0,0 +1,57 @@
+"""Tests of the sendmsg serializer"""
+
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+
+from fsprotocol import FSProtocol, Event, executeMessage
+
+
+def eventMessage(app, args='', uuid='', lock=True, eventUUID=''):
+    """Build the message as an Event the way sendCommand did before executeMessage"""
+    msg = Event()
+    if uuid:
+        msg.set_unixfrom("SendMsg %s"%uuid)
+    else:
+        msg.set_unixfrom("SendMsg")
+    msg['call-command'] = "execute"
+    msg['execute-app-name'] = app
+    if args:
+        msg['execute-app-arg'] = args
+    if lock:
+        msg['event-lock'] = "true"
+    if eventUUID:
+        msg['Event-UUID'] = eventUUID
+    return msg
+
+
+class ExecuteMessageTestCase(unittest.TestCase):
+    def test_format(self):
+        self.assertEqual(executeMessage("playback", "/tmp/a.wav", "abc", True, "e1"),
+                         "SendMsg abc\ncall-command: execute\nexecute-app-name: playback\n"
+                         "execute-app-arg: /tmp/a.wav\nevent-lock: true\nEvent-UUID: e1\n\n")
+        self.assertEqual(executeMessage("conference", lock=False),
+                         "SendMsg\ncall-command: execute\nexecute-app-name: conference\n\n")
+
+    def test_sameHeadersAsEvent(self):
+        """executeMessage sends the headers the Event it replaces sent, in its own order"""
+        for args in [("answer",), ("set", "a=b", "abc"), ("bridge", "user/1000", "", False),
+                     ("playback", "/tmp/a.wav", "abc", True, "e1")]:
+            message = executeMessage(*args)
+            expected = eventMessage(*args).as_string(True)
+            self.assertEqual(message.split("\n", 1)[0], expected.split("\n", 1)[0])
+            self.assertEqual(sorted(message.split("\n")[1:]), sorted(expected.split("\n")[1:]))
+
+    def test_sendCommand(self):
+        protocol = FSProtocol()
+        transport = proto_helpers.StringTransport()
+        protocol.makeConnection(transport)
+        protocol.sendCommand("hangup", "NORMAL_CLEARING", "abc")
+        self.assertEqual(transport.value(), executeMessage("hangup", "NORMAL_CLEARING", "abc"))
+
+    def test_eventWithPayload(self):
+        msg = Event()
+        msg.set_unixfrom("SendMsg abc")
+        msg['call-command'] = "sendevent"
+        msg.set_payload("hello")
+        self.assertEqual(msg.as_string(True), "SendMsg abc\ncall-command: sendevent\n\nhello")
+        self.assertEqual(msg.as_string(), "call-command: sendevent\n\nhello")
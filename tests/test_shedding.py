@@ -0,0 +1,67 @@
+"""Tests of load shedding"""
+
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import task
+
+import fsprotocol
+from fsprotocol import FSProtocol
+from tests import plainEvent
+
+
+class SheddingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(fsprotocol, 'reactor', self.clock)
+        self.protocol = FSProtocol()
+        self.protocol.makeConnection(proto_helpers.StringTransport())
+        self.addCleanup(self.protocol.connectionLost, None)
+        #set once connected, as on the protocol an InboundFactory builds
+        self.protocol.shedLag = 0.5
+        self.presence = []
+        self.protocol.registerEvent("PRESENCE_IN", False, self.presence.append)
+        self.protocol.registerEvent("CHANNEL_ANSWER", False, self.slowHandler)
+
+    def slowHandler(self, event):
+        self.clock.advance(1)
+
+    def overload(self, *frames):
+        """Feed frames in one read behind an event whose handler takes a second"""
+        answer = plainEvent([("Event-Name", "CHANNEL_ANSWER"), ("Unique-ID", "slow")])
+        self.protocol.dataReceived(answer + ''.join(frames))
+
+    def recover(self):
+        for i in range(3):
+            self.clock.advance(self.protocol.lagProbeInterval)
+
+    def test_coalescedFlushedAfterOverload(self):
+        """Coalesced events are dispatched once the overload ends, with shedLag set after connecting"""
+        self.overload(plainEvent([("Event-Name", "PRESENCE_IN"), ("Unique-ID", "a"), ("status", "ringing")]),
+                      plainEvent([("Event-Name", "PRESENCE_IN"), ("Unique-ID", "a"), ("status", "answered")]),
+                      plainEvent([("Event-Name", "HEARTBEAT")]))
+        self.assertEqual(self.presence, [])
+        self.assertEqual(self.protocol.shedCounts, {'HEARTBEAT':1})
+        self.recover()
+        self.assertEqual([event['status'] for event in self.presence], ['answered'])
+        self.assertEqual(self.protocol.coalescedCounts, {'PRESENCE_IN':1})
+        self.assertFalse(self.protocol.sheddingStats()['overloaded'])
+
+    def test_turnedOff(self):
+        """Turning shedding off dispatches the events kept back"""
+        self.overload(plainEvent([("Event-Name", "PRESENCE_IN"), ("Unique-ID", "a")]))
+        self.protocol.shedLag = None
+        self.recover()
+        self.assertEqual(len(self.presence), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_coalescedByPresence(self):
+        """Events without Unique-ID are coalesced per presence entity, and dropped when they name none"""
+        self.overload(plainEvent([("Event-Name", "PRESENCE_IN"), ("from", "1000%40pbx"), ("status", "away")]),
+                      plainEvent([("Event-Name", "PRESENCE_IN"), ("from", "1001%40pbx"), ("status", "away")]),
+                      plainEvent([("Event-Name", "PRESENCE_IN"), ("from", "1000%40pbx"), ("status", "online")]),
+                      plainEvent([("Event-Name", "PRESENCE_IN"), ("status", "unknown")]))
+        self.recover()
+        self.assertEqual([(event['from'], event['status']) for event in self.presence],
+                         [('1001%40pbx', 'away'), ('1000%40pbx', 'online')])
+        self.assertEqual(self.protocol.coalescedCounts, {'PRESENCE_IN':1})
+        self.assertEqual(self.protocol.shedCounts, {'PRESENCE_IN':1})
@@ -0,0 +1,150 @@
+"""Tests of the parent side of worker processes"""
+
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import task, error
+from twisted.python import failure
+
+import fsprotocol
+from fsprotocol import FSProtocol, Disconnected
+from workers import WorkerPool, WorkerProcess, WorkerProtocol, _unpack
+from tests import plainEvent, commandReply, backgroundJob
+
+
+class FakeChannel(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+
+class WorkerCommandsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(fsprotocol, 'reactor', self.clock)
+        self.protocol = FSProtocol()
+        self.protocol.useLanes = True
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+        self.pool = WorkerPool('setup:module', count=1)
+        self.pool.attach(self.protocol)
+        self.worker = WorkerProcess(self.pool, 0)
+        self.worker.channel = FakeChannel()
+        self.worker.running = True
+        self.pool.workers[0] = self.worker
+
+    def test_bgapiReleasesLanes(self):
+        """Bytes of the bgapi commands of a worker are released by their command replies"""
+        jobids = ["job-%d"%i for i in range(5)]
+        self.worker.messageReceived(('write', [(None, "bgapi status\nJob-UUID:%s\n\n"%jobid, jobid)
+                                               for jobid in jobids]))
+        self.assertEqual(self.transport.value().count("bgapi status"), 5)
+        self.assertTrue(self.protocol._outstanding > 0)
+        for jobid in jobids:
+            self.protocol.dataReceived(commandReply("+OK Job-UUID: %s"%jobid, jobid))
+        self.assertEqual(self.protocol._outstanding, 0)
+        self.assertEqual(self.protocol._outstandingJobs, {})
+        self.protocol.dataReceived(backgroundJob(jobids[0], "+OK UP\n"))
+        kind, packed = self.worker.channel.sent[-1]
+        self.assertEqual(kind, 'event')
+        self.assertEqual(_unpack(packed)['Job-UUID'], jobids[0])
+
+    def test_lanesKeepDraining(self):
+        """Worker bgapis answered past maxOutstanding bytes do not stop the lanes"""
+        self.protocol.maxOutstanding = 200
+        for i in range(20):
+            jobid = "job-%d"%i
+            self.worker.messageReceived(('write', [(None, "bgapi status\nJob-UUID:%s\n\n"%jobid, jobid)]))
+            self.protocol.dataReceived(commandReply("+OK Job-UUID: %s"%jobid, jobid))
+        self.worker.messageReceived(('write', [(1, "api uuid_kill abc\n\n", None)]))
+        self.assertTrue(self.transport.value().endswith("api uuid_kill abc\n\n"))
+
+    def test_pendingStats(self):
+        """Commands of a worker waiting for their reply are aged like the commands of the parent"""
+        self.worker.messageReceived(('write', [(1, "api status\n\n", None)]))
+        self.clock.advance(2)
+        self.protocol.sendAPI("version")
+        stats = self.protocol.pendingStats()
+        self.assertEqual((stats['pendingJobs'], stats['oldestJob']), (2, 2))
+        self.protocol.dataReceived(commandReply("+OK"))
+        self.assertEqual(self.worker.channel.sent[-1][:3], ('reply', 1, True))
+
+
+class ForwardTestCase(unittest.TestCase):
+    def setUp(self):
+        self.protocol = FSProtocol()
+        self.protocol.makeConnection(proto_helpers.StringTransport())
+        self.pool = WorkerPool('setup:module', count=2)
+        self.pool.attach(self.protocol)
+        self.received = []
+        self.protocol.registerEvent("CHANNEL_ANSWER", False, self.received.append)
+
+    def test_notStarted(self):
+        """Events for workers not started yet are dropped and local handlers still run"""
+        self.protocol.dataReceived(plainEvent([("Event-Name", "CHANNEL_ANSWER"), ("Unique-ID", "abc")]))
+        self.assertEqual(len(self.received), 1)
+        self.assertEqual(self.pool.dropped, 1)
+
+    def test_forwardError(self):
+        """An error forwarding an event does not keep it from the local handlers"""
+        def forward(event):
+            raise RuntimeError("broken channel")
+        self.pool.forward = forward
+        self.protocol.dataReceived(plainEvent([("Event-Name", "CHANNEL_ANSWER"), ("Unique-ID", "abc")]))
+        self.assertEqual(len(self.received), 1)
+
+
+class JobsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.protocol = FSProtocol()
+        self.protocol.makeConnection(proto_helpers.StringTransport())
+        self.pool = WorkerPool('setup:module', count=1)
+        self.pool.attach(self.protocol)
+        self.worker = WorkerProcess(self.pool, 0)
+        self.worker.channel = FakeChannel()
+        self.worker.running = True
+        self.pool.workers[0] = self.worker
+
+    def bgapi(self, jobid):
+        self.worker.messageReceived(('write', [(None, "bgapi status\nJob-UUID:%s\n\n"%jobid, jobid)]))
+
+    def test_workerEnded(self):
+        """Jobs and events of a worker that ended are forgotten"""
+        self.bgapi("job-1")
+        self.worker.forwarded = 5
+        self.assertEqual(self.pool.backlog(), 5)
+        self.worker.running = False
+        self.pool.workerEnded(self.worker, failure.Failure(error.ProcessDone(0)))
+        self.assertEqual(self.pool.jobWorkers, {})
+        self.assertEqual(self.pool.backlog(), 0)
+
+    def test_disconnect(self):
+        """Jobs of the workers fail once the parent connection is lost"""
+        self.bgapi("job-1")
+        self.protocol.connectionLost(None)
+        self.assertEqual(self.pool.jobWorkers, {})
+        self.assertEqual(self.worker.channel.sent, [('jobFailed', 'job-1', ('Disconnected', "Connection to FreeSWITCH lost"))])
+
+    def test_writeOnLostConnection(self):
+        self.protocol.connectionLost(None)
+        self.bgapi("job-1")
+        self.assertEqual(self.pool.jobWorkers, {})
+        self.assertEqual(self.worker.channel.sent, [('jobFailed', 'job-1', ('Disconnected', "Not connected to FreeSWITCH"))])
+
+    def test_noConnection(self):
+        self.pool.protocol = None
+        self.bgapi("job-1")
+        self.assertEqual(self.worker.channel.sent, [('jobFailed', 'job-1', ('Disconnected', "Not connected to FreeSWITCH"))])
+
+
+class WorkerProtocolTestCase(unittest.TestCase):
+    def test_jobFailed(self):
+        worker = WorkerProtocol()
+        worker.connectionMade()
+        worker.channel = FakeChannel()
+        df = worker.sendBGAPI("status")
+        kind, [(reqid, data, jobid)] = worker.channel.sent[0]
+        worker.messageReceived(('jobFailed', jobid, ('Disconnected', "Connection to FreeSWITCH lost")))
+        self.failureResultOf(df, Disconnected)
+        self.assertEqual(worker.pendingBackgroundJobs, {})
@@ -0,0 +1,368 @@
+#!/usr/bin/python
+
+import os
+import sys
+import zlib
+import cPickle as pickle
+
+from twisted.internet import stdio
+
+from fsprotocol import *
+from fsprotocol import _headerNames, _headerName
+import fsprotocol
+
+log = logging.getLogger("Workers")
+
+
+def _pack(event):
+    return (isinstance(event, JSONEvent), event._headers, event.get_payload())
+
+
+def _unpack(packed):
+    isJSON, headers, payload = packed
+    #header lookups only find names this process has seen
+    for name in headers:
+        if name not in _headerNames:
+            _headerName(name)
+    if isJSON:
+        return JSONEvent(headers, payload)
+    return Event(headers, payload)
+
+
+class Channel(basic.NetstringReceiver):
+    """Netstring framed pickles between the parent and a worker process"""
+    MAX_LENGTH = 2**31
+
+    def __init__(self, owner):
+        self.owner = owner
+
+    def stringReceived(self, string):
+        self.owner.messageReceived(pickle.loads(string))
+
+    def connectionLost(self, reason):
+        self.owner.channelLost(reason)
+
+    def send(self, message):
+        self.sendString(pickle.dumps(message, 2))
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """Parent side of a worker process, runs the commands the worker sends through the parent connection"""
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.channel = None
+        self.running = False
+        self.forwarded = 0
+        self.dropped = 0
+        self.acked = 0 #events the worker reported handled
+
+    def connectionMade(self):
+        self.channel = Channel(self)
+        self.channel.makeConnection(self.transport)
+        self.running = True
+
+    def outReceived(self, data):
+        self.channel.dataReceived(data)
+
+    def errReceived(self, data):
+        for line in data.splitlines():
+            log.info("worker %s: %s", self.index, line)
+
+    def processEnded(self, reason):
+        self.running = False
+        self.pool.workerEnded(self, reason)
+
+    def channelLost(self, reason):
+        pass
+
+    def send(self, message):
+        if not self.running:
+            self.dropped += 1
+            return
+        self.channel.send(message)
+
+    def forward(self, event):
+        if not self.running:
+            self.dropped += 1
+            return
+        self.forwarded += 1
+        self.channel.send(('event', _pack(event)))
+
+    def backlog(self):
+        """Return the number of events sent to the worker and not handled yet, 0 once it ended"""
+        if not self.running:
+            return 0
+        return self.forwarded - self.acked
+
+    def messageReceived(self, message):
+        kind = message[0]
+        if kind == 'ack':
+            self.acked = message[1]
+            return
+        protocol = self.pool.protocol
+        if protocol is None:
+            #commands sent while the parent has no connection fail like on a lost connection
+            if kind == 'write':
+                for reqid, data, jobid in message[1]:
+                    if reqid is not None:
+                        self.send(('reply', reqid, False, ('Disconnected', "Not connected to FreeSWITCH")))
+                    elif jobid is not None:
+                        self.send(('jobFailed', jobid, ('Disconnected', "Not connected to FreeSWITCH")))
+            elif kind == 'call':
+                self.send(('reply', message[1], False, ('Disconnected', "Not connected to FreeSWITCH")))
+            return
+        if kind == 'write':
+            commands = []
+            for reqid, data, jobid in message[1]:
+                if reqid is None:
+                    #the Job-UUID lets the lanes release the bytes of a bgapi on its command reply
+                    commands.append((data, None, jobid))
+                    if jobid is not None:
+                        self.pool.jobWorkers[jobid] = self
+                else:
+                    #timed and aged like the commands of the parent, see pendingStats
+                    df = protocol._newJob(None)
+                    df.addCallbacks(self._replied, self._failed, callbackArgs=(reqid,), errbackArgs=(reqid,))
+                    commands.append((data, df, None))
+            protocol._queueCommands(commands)
+        elif kind == 'call':
+            reqid, method, args, kwargs = message[1:]
+            df = defer.maybeDeferred(getattr(protocol, method), *args, **kwargs)
+            df.addCallbacks(self._replied, self._failed, callbackArgs=(reqid,), errbackArgs=(reqid,))
+
+    def _replied(self, result, reqid):
+        if isinstance(result, Event):
+            result = _pack(result)
+        self.send(('reply', reqid, True, result))
+
+    def _failed(self, error, reqid):
+        self.send(('reply', reqid, False, (error.type.__name__, error.getErrorMessage())))
+
+
+class WorkerPool(object):
+    """Forward the events of a protocol to worker processes so handlers use more than one core.
+
+    Events are sharded by Unique-ID, so the events of a channel are handled in order by one worker,
+    events without Unique-ID are sharded by Event-Name. Every worker runs setup, given as
+    "module:function", with its WorkerProtocol once started; setup registers the handlers with
+    registerEvent. Commands sent from the workers, api, bgapi, sendmsg and the dptools, are written
+    on the parent connection and their replies and BACKGROUND_JOB events are sent back to the
+    worker that sent them.
+
+    Workers that exit are restarted after restartDelay seconds, events sent to them meanwhile are
+    dropped and counted in stats.
+    """
+    def __init__(self, setup, count=2, restartDelay=1, python=sys.executable):
+        """
+        setup -- (str) module:function called with the WorkerProtocol in each worker, the module must be
+                 importable with the sys.path of this process
+        count -- (int) number of worker processes
+        restartDelay -- (int/float) seconds to wait before restarting a worker that exited
+        python -- (str) python interpreter running the workers
+        """
+        self.setup = setup
+        self.count = count
+        self.restartDelay = restartDelay
+        self.python = python
+        self.protocol = None
+        self.workers = [None]*count
+        self.jobWorkers = {} #Job-UUID of a bgapi sent by a worker -> WorkerProcess
+        self.dropped = 0 #events for workers that were not started yet
+        self.running = False
+
+    def attach(self, protocol):
+        """Forward the events of protocol to the workers"""
+        protocol.workerPool = self
+        self.protocol = protocol
+
+    def start(self):
+        """Start the worker processes"""
+        self.running = True
+        for index in range(self.count):
+            self._spawn(index)
+
+    def stop(self):
+        """Stop the worker processes"""
+        self.running = False
+        for worker in self.workers:
+            if worker is not None and worker.running:
+                worker.transport.closeStdin()
+
+    def _spawn(self, index):
+        worker = WorkerProcess(self, index)
+        self.workers[index] = worker
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([path for path in sys.path if path])
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'workers.py')
+        reactor.spawnProcess(worker, self.python, [self.python, script, self.setup], env=env)
+
+    def workerEnded(self, worker, reason):
+        log.error("Worker %s exited: %s", worker.index, reason.getErrorMessage())
+        #nobody is left to receive the results of its jobs
+        for jobid, jobWorker in self.jobWorkers.items():
+            if jobWorker is worker:
+                del self.jobWorkers[jobid]
+        if self.running and self.workers[worker.index] is worker:
+            reactor.callLater(self.restartDelay, self._restart, worker)
+
+    def _restart(self, worker):
+        if self.running and self.workers[worker.index] is worker:
+            self._spawn(worker.index)
+
+    def forward(self, event):
+        """Send event to the worker owning its channel, BACKGROUND_JOB events to the worker that ran the job
+
+        Events for a worker that was not started yet are dropped and counted in self.dropped
+        """
+        if event['Event-Name'] == 'BACKGROUND_JOB':
+            worker = self.jobWorkers.pop(event['Job-UUID'], None)
+            if worker is not None:
+                worker.forward(event)
+                return
+        key = event['Unique-ID'] or event['Event-Name'] or ''
+        worker = self.workers[(zlib.crc32(key) & 0xffffffff) % self.count]
+        if worker is None:
+            self.dropped += 1
+            return
+        worker.forward(event)
+
+    def failJob(self, jobid, error):
+        """Fail the bgapi jobid of a worker whose BACKGROUND_JOB will never come
+
+        error -- (Exception) error the deferred of the job fails with in the worker
+        """
+        worker = self.jobWorkers.pop(jobid, None)
+        if worker is not None:
+            worker.send(('jobFailed', jobid, (error.__class__.__name__, str(error))))
+
+    def failJobs(self, error):
+        """Fail the bgapi jobs of every worker, eg: once the parent connection is lost"""
+        for jobid in self.jobWorkers.keys():
+            self.failJob(jobid, error)
+
+    def backlog(self):
+        """Return the number of events sent to the workers and not handled yet"""
+        return sum([worker.backlog() for worker in self.workers if worker is not None])
+
+    def stats(self):
+        """Return a list of (events forwarded, events dropped, events waiting) per worker"""
+        return [(worker.forwarded, worker.dropped, worker.backlog()) for worker in self.workers if worker is not None]
+
+
+class WorkerProtocol(FSProtocol):
+    """FSProtocol of a worker process
+
+    Events forwarded by the parent are dispatched to the callbacks registered here, commands are
+    sent through the parent connection. Subscriptions and filters are made on the parent connection.
+    """
+    def __init__(self):
+        self.channel = None
+        self.calls = {} #request id -> deferred waiting for the parent's reply
+        self.lastCall = 0
+        self.handled = 0 #events dispatched, reported to the parent once per reactor iteration
+        self._ackCall = None
+
+    def messageReceived(self, message):
+        kind = message[0]
+        if kind == 'event':
+            self.message = _unpack(message[1])
+            try:
+                self.dispatchEvent()
+            except:
+                log.error("Exception in event dispatch", exc_info=True)
+            self.handled += 1
+            if self._ackCall is None:
+                self._ackCall = reactor.callLater(0, self._ack)
+        elif kind == 'reply':
+            reqid, ok, result = message[1:]
+            df = self.calls.pop(reqid, None)
+            if df is None or df.called:
+                return
+            if ok:
+                if isinstance(result, tuple):
+                    result = _unpack(result)
+                df.callback(result)
+            else:
+                name, text = result
+                df.errback(getattr(fsprotocol, name, CommandError)(text))
+        elif kind == 'jobFailed':
+            jobid, (name, text) = message[1:]
+            df = self.pendingBackgroundJobs.pop(jobid, None)
+            if df is not None and not df.called:
+                df.errback(getattr(fsprotocol, name, CommandError)(text))
+
+    def _ack(self):
+        self._ackCall = None
+        self.channel.send(('ack', self.handled))
+
+    def channelLost(self, reason):
+        calls, self.calls = self.calls, {}
+        for df in calls.values():
+            if not df.called:
+                df.errback(Disconnected("Worker lost its parent"))
+        self.failPendingJobs(Disconnected("Worker lost its parent"))
+        if reactor.running:
+            reactor.stop()
+
+    def checkBacklog(self):
+        #events come through the parent, which stops reading on the events its workers did not acknowledge
+        pass
+
+    def _newCall(self, df):
+        self.lastCall += 1
+        self.calls[self.lastCall] = df
+        return self.lastCall
+
+    def _queueCommands(self, commands):
+        message = []
+        for data, df, jobid in commands:
+            if df is not None:
+                message.append((self._newCall(df), data, None))
+            else:
+                message.append((None, data, jobid))
+        self.channel.send(('write', message))
+
+    def callParent(self, method, *args, **kwargs):
+        """Call method of the parent protocol
+
+        returns deferred fired with its result
+        """
+        df = defer.Deferred()
+        self.channel.send(('call', self._newCall(df), method, args, kwargs))
+        return df
+
+    def subscribeEvents(self, events, format=None):
+        if events.startswith("CUSTOM"):
+            self.subscribedEvents.append(events)
+        else:
+            self.subscribedEvents.extend(events.split(' '))
+        return self.callParent('subscribeEvents', events, format)
+
+    def addFilter(self, header, value):
+        return self.callParent('addFilter', header, value)
+
+    def removeFilter(self, header, value):
+        return self.callParent('removeFilter', header, value)
+
+    def myevents(self, uuid=''):
+        self.subscribedEvents.append("myevents")
+        return self.callParent('myevents', uuid)
+
+
+def main(setup):
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    worker = WorkerProtocol()
+    worker.connectionMade()
+    worker.channel = Channel(worker)
+    stdio.StandardIO(worker.channel)
+    #stdout carries the channel, keep prints of the handlers off it
+    sys.stdout = sys.stderr
+    moduleName, functionName = setup.split(':')
+    __import__(moduleName)
+    getattr(sys.modules[moduleName], functionName)(worker)
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])